@@ -1,21 +1,419 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
+from itertools import islice
+from pathlib import Path
 from sqlite3 import Error
 import sys
 import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+# Schema migrations, applied in order by LoansDB.migrate(). PRAGMA user_version records how many have run, so
+# append new migrations and never edit one that has shipped.
+MIGRATIONS = (
+    # 1: Normalized core schema fed from the staging tables by historical_gen.warehouse
+    (
+        """
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE COLLATE NOCASE
+        );
+        """,
+        """
+        CREATE TABLE submissions (
+            id TEXT PRIMARY KEY,
+            author_id INTEGER REFERENCES users (id),
+            created_utc INTEGER,
+            title TEXT,
+            link_flair_text TEXT,
+            num_comments INTEGER,
+            score INTEGER,
+            permalink TEXT
+        );
+        """,
+        "CREATE INDEX submissions_created ON submissions (created_utc);",
+        "CREATE INDEX submissions_author ON submissions (author_id, created_utc);",
+        """
+        CREATE TABLE comments (
+            id TEXT PRIMARY KEY,
+            submission_id TEXT,
+            parent_id TEXT,
+            author_id INTEGER REFERENCES users (id),
+            created_utc INTEGER,
+            body TEXT
+        );
+        """,
+        "CREATE INDEX comments_thread ON comments (submission_id, created_utc);",
+        "CREATE INDEX comments_author ON comments (author_id, created_utc);",
+        "CREATE INDEX comments_parent ON comments (parent_id);",
+        "CREATE INDEX comments_created ON comments (created_utc);",
+        """
+        CREATE TABLE loans (
+            id INTEGER PRIMARY KEY,
+            lender_id INTEGER REFERENCES users (id),
+            borrower_id INTEGER REFERENCES users (id),
+            currency_code TEXT,
+            principal_minor INTEGER,
+            principal_repayment_minor INTEGER,
+            created_at REAL,
+            last_repaid_at REAL,
+            repaid_at REAL,
+            unpaid_at REAL,
+            deleted_at REAL
+        );
+        """,
+        # By borrower / by lender cover the usual per-user history and totals without touching the table
+        """
+        CREATE INDEX loans_borrower ON loans (borrower_id, created_at, principal_minor, principal_repayment_minor,
+                                              repaid_at, unpaid_at);
+        """,
+        """
+        CREATE INDEX loans_lender ON loans (lender_id, created_at, principal_minor, principal_repayment_minor,
+                                            repaid_at, unpaid_at);
+        """,
+        "CREATE INDEX loans_created ON loans (created_at);",
+        """
+        CREATE TABLE loan_events (
+            loan_id INTEGER,
+            event_type TEXT,
+            occurred_at REAL,
+            creation_type INTEGER,
+            creation_permalink TEXT,
+            repayment_minor INTEGER,
+            old_principal_minor INTEGER,
+            new_principal_minor INTEGER,
+            old_principal_repayment_minor INTEGER,
+            new_principal_repayment_minor INTEGER,
+            PRIMARY KEY (loan_id, event_type, occurred_at)
+        ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX loan_events_occurred ON loan_events (occurred_at, event_type);",
+        """
+        CREATE TABLE warehouse_state (
+            source TEXT PRIMARY KEY,
+            last_rowid INTEGER,
+            updated_utc REAL
+        );
+        """
+    ),
+    # 2: Per-user loan aggregates, recomputed by historical_gen.aggregates for the users triggers mark dirty
+    (
+        "DROP INDEX loans_borrower;",
+        "DROP INDEX loans_lender;",
+        """
+        CREATE INDEX loans_borrower ON loans (borrower_id, created_at, principal_minor, principal_repayment_minor,
+                                              last_repaid_at, repaid_at, unpaid_at, deleted_at);
+        """,
+        """
+        CREATE INDEX loans_lender ON loans (lender_id, created_at, principal_minor, principal_repayment_minor,
+                                            last_repaid_at, repaid_at, unpaid_at, deleted_at);
+        """,
+        """
+        CREATE TABLE user_stats (
+            user_id INTEGER PRIMARY KEY,
+            loans_taken INTEGER,
+            loans_given INTEGER,
+            borrowed_minor INTEGER,
+            borrowed_repaid_minor INTEGER,
+            lent_minor INTEGER,
+            lent_repaid_minor INTEGER,
+            repaid_fraction REAL,
+            unpaid_taken INTEGER,
+            unpaid_given INTEGER,
+            median_days_to_repay REAL,
+            last_activity REAL
+        );
+        """,
+        "CREATE TABLE user_stats_dirty (user_id INTEGER PRIMARY KEY);",
+        # ON CONFLICT DO NOTHING, as the upsert firing a trigger would override an INSERT OR IGNORE in it
+        """
+        CREATE TRIGGER loans_stats_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO user_stats_dirty (user_id)
+            SELECT NEW.borrower_id WHERE NEW.borrower_id IS NOT NULL
+            UNION SELECT NEW.lender_id WHERE NEW.lender_id IS NOT NULL
+            ON CONFLICT (user_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_stats_update AFTER UPDATE ON loans BEGIN
+            INSERT INTO user_stats_dirty (user_id)
+            SELECT NEW.borrower_id WHERE NEW.borrower_id IS NOT NULL
+            UNION SELECT NEW.lender_id WHERE NEW.lender_id IS NOT NULL
+            UNION SELECT OLD.borrower_id WHERE OLD.borrower_id IS NOT NULL
+            UNION SELECT OLD.lender_id WHERE OLD.lender_id IS NOT NULL
+            ON CONFLICT (user_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_stats_delete AFTER DELETE ON loans BEGIN
+            INSERT INTO user_stats_dirty (user_id)
+            SELECT OLD.borrower_id WHERE OLD.borrower_id IS NOT NULL
+            UNION SELECT OLD.lender_id WHERE OLD.lender_id IS NOT NULL
+            ON CONFLICT (user_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loan_events_stats_insert AFTER INSERT ON loan_events BEGIN
+            INSERT INTO user_stats_dirty (user_id)
+            SELECT borrower_id FROM loans WHERE id = NEW.loan_id AND borrower_id IS NOT NULL
+            UNION SELECT lender_id FROM loans WHERE id = NEW.loan_id AND lender_id IS NOT NULL
+            ON CONFLICT (user_id) DO NOTHING;
+        END;
+        """,
+        # Loans loaded before this migration
+        """
+        INSERT INTO user_stats_dirty (user_id)
+        SELECT borrower_id FROM loans WHERE borrower_id IS NOT NULL
+        UNION SELECT lender_id FROM loans WHERE lender_id IS NOT NULL;
+        """
+    ),
+    # 3: Full-text index over submission titles / selftext and comment bodies, kept by historical_gen.search
+    (
+        """
+        CREATE VIRTUAL TABLE search_index USING fts5 (
+            kind UNINDEXED,
+            id UNINDEXED,
+            author UNINDEXED,
+            created_utc UNINDEXED,
+            title,
+            body,
+            prefix = '2 3',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        """,
+    ),
+    # 4: Per-loan realized returns, recomputed by historical_gen.returns for the loans triggers mark dirty
+    (
+        """
+        CREATE TABLE loan_returns (
+            loan_id INTEGER PRIMARY KEY,
+            status TEXT,
+            principal_minor INTEGER,
+            repaid_minor INTEGER,
+            profit_minor INTEGER,
+            term_days REAL,
+            days_to_repay REAL,
+            apr REAL,
+            irr REAL,
+            loss_given_default REAL
+        );
+        """,
+        "CREATE INDEX loan_returns_status ON loan_returns (status);",
+        "CREATE TABLE loan_returns_dirty (loan_id INTEGER PRIMARY KEY);",
+        """
+        CREATE TRIGGER loans_returns_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (NEW.id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_returns_update AFTER UPDATE ON loans BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (NEW.id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_returns_delete AFTER DELETE ON loans BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (OLD.id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loan_events_returns_insert AFTER INSERT ON loan_events BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (NEW.loan_id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loan_events_returns_update AFTER UPDATE ON loan_events BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (NEW.loan_id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """,
+        # Loans loaded before this migration
+        "INSERT INTO loan_returns_dirty (loan_id) SELECT id FROM loans;"
+    ),
+    # 5: Cached survival curves (historical_gen.survival), checked against a version per loan creation year that
+    # triggers bump whenever a loan created that year changes. A new or moved loan can change the borrower history
+    # of its borrower's later loans, so those writes bump every later year too.
+    (
+        "CREATE TABLE survival_versions (year INTEGER PRIMARY KEY, version INTEGER);",
+        """
+        CREATE TABLE survival_cache (
+            cohort TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            curves TEXT,
+            computed_utc REAL
+        );
+        """,
+        """
+        CREATE TRIGGER loans_survival_insert AFTER INSERT ON loans BEGIN
+            INSERT INTO survival_versions (year, version)
+            SELECT CAST(strftime('%Y', NEW.created_at, 'unixepoch') AS INTEGER), 1 WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT (year) DO UPDATE SET version = version + 1;
+            UPDATE survival_versions SET version = version + 1
+            WHERE year > CAST(strftime('%Y', NEW.created_at, 'unixepoch') AS INTEGER);
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_survival_update AFTER UPDATE OF principal_minor, currency_code, repaid_at, unpaid_at,
+                                                               deleted_at ON loans BEGIN
+            INSERT INTO survival_versions (year, version)
+            SELECT CAST(strftime('%Y', NEW.created_at, 'unixepoch') AS INTEGER), 1 WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT (year) DO UPDATE SET version = version + 1;
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_survival_move AFTER UPDATE OF created_at, borrower_id ON loans BEGIN
+            INSERT INTO survival_versions (year, version)
+            SELECT CAST(strftime('%Y', NEW.created_at, 'unixepoch') AS INTEGER), 1 WHERE NEW.created_at IS NOT NULL
+            ON CONFLICT (year) DO UPDATE SET version = version + 1;
+            UPDATE survival_versions SET version = version + 1
+            WHERE year >= min(CAST(strftime('%Y', OLD.created_at, 'unixepoch') AS INTEGER),
+                              CAST(strftime('%Y', NEW.created_at, 'unixepoch') AS INTEGER));
+        END;
+        """,
+        """
+        CREATE TRIGGER loans_survival_delete AFTER DELETE ON loans BEGIN
+            UPDATE survival_versions SET version = version + 1
+            WHERE year >= CAST(strftime('%Y', OLD.created_at, 'unixepoch') AS INTEGER);
+        END;
+        """,
+        # Loans loaded before this migration
+        """
+        INSERT INTO survival_versions (year, version)
+        SELECT DISTINCT CAST(strftime('%Y', created_at, 'unixepoch') AS INTEGER), 1 FROM loans
+        WHERE created_at IS NOT NULL;
+        """
+    ),
+    # 6: Staging rows changed or deleted in place, queued by triggers historical_gen.warehouse puts on the staging
+    # tables, and the loan a comment was linked to by historical_gen.links
+    (
+        """
+        CREATE TABLE warehouse_dirty (
+            source TEXT,
+            key,
+            PRIMARY KEY (source, key)
+        ) WITHOUT ROWID;
+        """,
+        "ALTER TABLE comments ADD COLUMN loan_id INTEGER;",
+        "CREATE INDEX comments_loan ON comments (loan_id);",
+        # Events the warehouse now deletes
+        """
+        CREATE TRIGGER loan_events_stats_delete AFTER DELETE ON loan_events BEGIN
+            INSERT INTO user_stats_dirty (user_id)
+            SELECT borrower_id FROM loans WHERE id = OLD.loan_id AND borrower_id IS NOT NULL
+            UNION SELECT lender_id FROM loans WHERE id = OLD.loan_id AND lender_id IS NOT NULL
+            ON CONFLICT (user_id) DO NOTHING;
+        END;
+        """,
+        """
+        CREATE TRIGGER loan_events_returns_delete AFTER DELETE ON loan_events BEGIN
+            INSERT INTO loan_returns_dirty (loan_id) VALUES (OLD.loan_id) ON CONFLICT (loan_id) DO NOTHING;
+        END;
+        """
+    ),
+    # 7: Digits after the decimal point of each loan's currency, filled by the next historical_gen.warehouse
+    # refresh, which merges loans in full
+    (
+        "ALTER TABLE loans ADD COLUMN currency_exponent INTEGER;",
+    ),
+    # 8: Indexes LoansDB.bulk_load dropped for a load, kept until it rebuilds them so a crashed load is healed when
+    # the database is next opened
+    (
+        """
+        CREATE TABLE deferred_indexes (
+            name TEXT PRIMARY KEY,
+            tbl_name TEXT,
+            sql TEXT
+        );
+        """,
+    ),
+)
 
 
 class LoansDB:
+    """
+    The writer connection is self.conn. Rows come back as sqlite3.Row, so they index by column name or position;
+    the query helpers below skip row objects entirely and build tuples, DataFrames or arrays straight from the
+    cursor. Each thread can also open its own read-only connection with reader(), which in WAL mode reads the last
+    committed state without waiting for, or blocking, the writer.
+    """
+
+    CACHED_STATEMENTS = 256
 
     def __init__(self, db_file: str):
+        self.db_file = db_file
         try:
-            conn = sqlite3.connect(db_file)
-            conn.row_factory = self.dict_factory
+            conn = sqlite3.connect(db_file, cached_statements=self.CACHED_STATEMENTS)
+            conn.row_factory = sqlite3.Row
+            if db_file != ':memory:':
+                conn.execute("PRAGMA journal_mode = WAL;")
             self.conn = conn
         except Error as e:
             logging.error(e)
             sys.exit(1)
+        self._bulk = None  # [rows loaded, uncommitted rows, start time] of the bulk load in progress
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self.migrate()
+        self.restore_deferred_indexes()
+
+    def migrate(self) -> int:
+        """
+        Apply the MIGRATIONS this database has not had yet, each in its own transaction.
+
+        :return: Schema version after migrating
+        """
+        version = self.conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version > len(MIGRATIONS):
+            logging.warning("%s has schema version %d, newer than this code's %d.", self.db_file, version,
+                            len(MIGRATIONS))
+            return version
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            started = time.monotonic()
+            self.conn.commit()
+            self.conn.execute("BEGIN;")  # DDL would otherwise run outside any transaction
+            try:
+                for sql in statements:
+                    self.conn.execute(sql)
+                self.conn.execute(f"PRAGMA user_version = {number};")
+                self.conn.commit()
+            except Error as e:
+                self.conn.rollback()
+                logging.error("Migration %d failed: %s", number, e)
+                raise
+            logging.info("Migrated %s to schema version %d in %.1fs.", self.db_file, number,
+                         time.monotonic() - started)
+        return len(MIGRATIONS)
+
+    def restore_deferred_indexes(self) -> int:
+        """
+        Recreate the indexes a bulk load dropped and did not get to rebuild, e.g. because the process was killed.
+
+        :return: Number of indexes recreated
+        """
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deferred_indexes';"
+                             ).fetchone() is None:
+            return 0
+        deferred = self.conn.execute("SELECT name, tbl_name, sql FROM deferred_indexes;").fetchall()
+        if not deferred:
+            return 0
+        started = time.monotonic()
+        with self.conn:
+            for index in deferred:
+                if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?;",
+                                     (index['name'],)).fetchone() is None:
+                    self.conn.execute(index['sql'])
+            self.conn.execute("DELETE FROM deferred_indexes;")
+        logging.warning("Recreated %d indexes an interrupted bulk load had dropped, in %.1fs.", len(deferred),
+                        time.monotonic() - started)
+        return len(deferred)
 
     def close(self):
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.close()
+            self._readers = []
         if self.conn is not None:
             self.conn.commit()
             self.conn.close()
@@ -23,17 +421,275 @@ class LoansDB:
             return
         logging.info("No db connection to close.")
 
-    def execute_query(self, query, params=list()):
+    def reader(self):
+        """
+        :return: This thread's read-only connection, opened on first use. An in-memory db has only self.conn.
+        """
+        if self.db_file == ':memory:':
+            return self.conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            uri = Path(self.db_file).resolve().as_uri() + '?mode=ro'
+            # Only ever used by this thread, but closed by whichever thread calls close()
+            conn = sqlite3.connect(uri, uri=True, cached_statements=self.CACHED_STATEMENTS, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only = ON;")
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def execute_query(self, query, params=()):
         try:
-            c = self.conn.cursor()
-            c.execute(query, params)
-            return c
+            return self.conn.execute(query, params)
         except Error as e:
-            logging.error(e)
+            logging.error("Query failed: %s", e)
+            raise
+
+    def executemany(self, query, rows, batch_size=5000) -> int:
+        """
+        Run query once per row, batch_size rows per executemany call, and commit at the end unless a bulk load
+        is in progress.
+
+        :param rows: Iterable of parameter tuples
+        :return: Number of rows
+        """
+        count = 0
+        it = iter(rows)
+        try:
+            while True:
+                batch = list(islice(it, batch_size))
+                if not batch:
+                    break
+                self.conn.executemany(query, batch)
+                count += len(batch)
+        except Error as e:
+            self.conn.rollback()
+            logging.error("Batch query failed: %s", e)
+            raise
+        if self._bulk is None:
+            self.conn.commit()
+        return count
+
+    @staticmethod
+    def _tuple_cursor(conn):
+        c = conn.cursor()
+        c.row_factory = None
+        return c
+
+    def iter_rows(self, query, params=(), chunk_rows=10000, conn=None):
+        """
+        Stream a query's rows as plain tuples, fetching chunk_rows at a time.
+
+        :param conn: Connection to read from, e.g. reader(). Defaults to self.conn.
+        """
+        c = self._tuple_cursor(conn or self.conn).execute(query, params)
+        while True:
+            rows = c.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_df(self, query, params=(), chunk_rows=100000, dtypes=None, conn=None):
+        """
+        Stream a query's rows as DataFrames of at most chunk_rows rows.
+
+        :param dtypes: Dict of column -> dtype to cast to, e.g. {'created_utc': 'Int64', 'body': 'string'}
+        :param conn: Connection to read from, e.g. reader(). Defaults to self.conn.
+        """
+        c = self._tuple_cursor(conn or self.conn).execute(query, params)
+        columns = [col[0] for col in c.description]
+        while True:
+            rows = c.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield self._frame(rows, columns, dtypes)
+
+    def query_df(self, query, params=(), dtypes=None, conn=None) -> pd.DataFrame:
+        """
+        :param dtypes: Dict of column -> dtype to cast to
+        :param conn: Connection to read from, e.g. reader(). Defaults to self.conn.
+        :return: Every row of the query as one DataFrame
+        """
+        c = self._tuple_cursor(conn or self.conn).execute(query, params)
+        return self._frame(c.fetchall(), [col[0] for col in c.description], dtypes)
+
+    def query_array(self, query, params=(), dtype=np.float64, conn=None) -> np.ndarray:
+        """
+        Read a query straight into a NumPy array without building rows or a DataFrame. A scalar dtype reads the
+        first column; a structured dtype reads one field per column. NULLs have no value in an int or float
+        array, so COALESCE them in the query.
+
+        :param conn: Connection to read from, e.g. reader(). Defaults to self.conn.
+        """
+        dtype = np.dtype(dtype)
+        c = self._tuple_cursor(conn or self.conn).execute(query, params)
+        return np.fromiter(c if dtype.names else (row[0] for row in c), dtype=dtype)
+
+    @staticmethod
+    def _frame(rows, columns, dtypes):
+        df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=False)
+        if dtypes:
+            df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
+        return df
+
+    # Pragmas for bulk loads: WAL so readers are not blocked, fsync only at checkpoints, a 256MB page cache
+    BULK_PRAGMAS = {
+        'synchronous': 'NORMAL',
+        'cache_size': -256 * 1024,
+        'temp_store': 'MEMORY'
+    }
+
+    @contextmanager
+    def bulk_load(self, table, defer_indexes=True):
+        """
+        Run bulk upserts into table with loading pragmas, then restore the previous pragmas and log rows/s.
+        Nested bulk loads just join the outer one.
+
+        :param table: Table being loaded
+        :param defer_indexes: If the table is empty, drop its secondary indexes for the load and rebuild them
+        once at the end, which is much faster than maintaining them row by row. UNIQUE indexes are kept, as they
+        may be what an upsert conflicts on. The dropped indexes are recorded in deferred_indexes in the same
+        transaction, so if the load never finishes they are recreated when the database is next opened.
+        """
+        if self._bulk is not None:
+            yield
+            return
+
+        self.conn.commit()
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        previous = {name: self.conn.execute(f"PRAGMA {name};").fetchone()[name] for name in self.BULK_PRAGMAS}
+        for name, value in self.BULK_PRAGMAS.items():
+            self.conn.execute(f"PRAGMA {name} = {value};")
+
+        deferred = []
+        if defer_indexes and self.conn.execute(f"SELECT 1 AS x FROM {table} LIMIT 1;").fetchone() is None:
+            deferred = self.conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                                         "AND sql IS NOT NULL AND upper(sql) NOT LIKE 'CREATE UNIQUE %';",
+                                         (table,)).fetchall()
+            with self.conn:
+                for index in deferred:
+                    self.conn.execute("INSERT OR REPLACE INTO deferred_indexes (name, tbl_name, sql) VALUES (?, ?, ?);",
+                                      (index['name'], table, index['sql']))
+                    self.conn.execute(f"DROP INDEX {index['name']};")
+
+        self._bulk = [0, 0, time.monotonic()]
+        try:
+            yield
+        finally:
+            rows, _, started = self._bulk
+            self._bulk = None
+            self.conn.commit()
+            if deferred:
+                index_started = time.monotonic()
+                with self.conn:
+                    for index in deferred:
+                        self.conn.execute(index['sql'])
+                    self.conn.executemany("DELETE FROM deferred_indexes WHERE name = ?;",
+                                          [(index['name'],) for index in deferred])
+                logging.info("Rebuilt %d indexes on %s in %.1fs.", len(deferred), table,
+                             time.monotonic() - index_started)
+            for name, value in previous.items():
+                self.conn.execute(f"PRAGMA {name} = {value};")
+            elapsed = time.monotonic() - started
+            logging.info("Loaded %d rows into %s in %.1fs (%.0f rows/s).", rows, table, elapsed,
+                         rows / elapsed if elapsed > 0 else 0)
+
+    def bulk_upsert(self, table, rows, columns=None, key=('id',), batch_size=5000, txn_size=50000,
+                    join_transaction=False) -> int:
+        """
+        Insert rows, updating the existing row wherever key already exists, so loading the same rows twice is
+        harmless. Inside a bulk_load, transactions span calls and the last one is committed when the load ends.
+
+        :param table: Target table
+        :param rows: DataFrame, or iterable of tuples in columns order
+        :param columns: Column names. Defaults to the DataFrame's.
+        :param key: Columns of the table's primary key or a unique index
+        :param batch_size: Rows per executemany call
+        :param txn_size: Rows per committed transaction
+        :param join_transaction: Write inside the caller's transaction, e.g. a with conn: block, without bulk
+        pragmas or commits, so the rows commit or roll back with the rest of it
+        :return: Number of rows written
+        """
+        if isinstance(rows, pd.DataFrame):
+            columns = list(rows.columns) if columns is None else columns
+            rows = self.df_rows(rows[columns])
+        updates = [col for col in columns if col not in key]
+        if updates:
+            on_conflict = "DO UPDATE SET " + ", ".join(f"{col} = excluded.{col}" for col in updates)
+        else:
+            on_conflict = "DO NOTHING"
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+               f"ON CONFLICT ({', '.join(key)}) {on_conflict};")
+
+        written = 0
+        it = iter(rows)
+        if join_transaction:
+            while True:
+                batch = list(islice(it, batch_size))
+                if not batch:
+                    break
+                self.conn.executemany(sql, batch)
+                written += len(batch)
+            return written
+        with self.bulk_load(table):
+            try:
+                while True:
+                    batch = list(islice(it, batch_size))
+                    if not batch:
+                        break
+                    self.conn.executemany(sql, batch)
+                    written += len(batch)
+                    self._bulk[0] += len(batch)
+                    self._bulk[1] += len(batch)
+                    if self._bulk[1] >= txn_size:
+                        self.conn.commit()
+                        self._bulk[1] = 0
+            except Error as e:
+                self.conn.rollback()
+                logging.error("Bulk upsert into %s failed: %s", table, e)
+                raise
+        return written
+
+    # Title matches count double
+    SEARCH_RANK = "bm25(search_index, 0, 0, 0, 0, 2.0, 1.0)"
+
+    def search(self, query, kind=None, author=None, since=None, until=None, limit=20, snippet_tokens=16,
+               conn=None) -> list:
+        """
+        Ranked full-text search over submissions and comments.
+
+        :param query: FTS5 query: words, "exact phrases", prefixes like repa*, AND / OR / NOT, NEAR(a b, 5)
+        :param kind: 'submission' or 'comment' to search only one
+        :param author: Only this author's posts
+        :param since: Only posts created at or after this epoch second
+        :param until: Only posts created before this epoch second
+        :param limit: Max results
+        :param snippet_tokens: Length of each snippet in tokens
+        :param conn: Connection to read from, e.g. reader(). Defaults to self.conn.
+        :return: Rows of kind, id, author, created_utc, snippet and score, best first. Matches in the snippet are
+        wrapped in [ ].
+        """
+        filters = ["search_index MATCH ?"]
+        params = [query]
+        for sql, value in (("kind = ?", kind), ("author = ? COLLATE NOCASE", author), ("created_utc >= ?", since),
+                           ("created_utc < ?", until)):
+            if value is not None:
+                filters.append(sql)
+                params.append(value)
+        params.append(limit)
+        c = (conn or self.conn).execute(
+            f"SELECT kind, id, author, created_utc, "
+            f"snippet(search_index, -1, '[', ']', '...', {int(snippet_tokens)}) AS snippet, "
+            f"{self.SEARCH_RANK} AS score FROM search_index WHERE {' AND '.join(filters)} "
+            f"ORDER BY score LIMIT ?;", params)
+        return c.fetchall()
 
     @staticmethod
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+    def df_rows(df):
+        """
+        :return: Iterator of plain Python tuples for df, with every missing value as None
+        """
+        values = df.to_numpy(dtype=object)
+        values[pd.isna(values)] = None
+        return map(tuple, values)
@@ -1,23 +1,286 @@
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
+import hashlib
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from historical_gen.ratelimit import TokenBucket
+
+try:
+    from oauth2client.service_account import ServiceAccountCredentials
+    import gspread
+except ImportError:  # Only needed to talk to the real Google Sheets; a worksheet can be passed in instead
+    ServiceAccountCredentials = None
+    gspread = None
+
+SQL_CREATE = (
+    """
+    CREATE TABLE IF NOT EXISTS gsheet_rows (
+        block TEXT,
+        row INTEGER,
+        hash INTEGER,
+        PRIMARY KEY (block, row)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS gsheet_blocks (
+        block TEXT PRIMARY KEY,
+        width INTEGER,
+        exported_utc REAL
+    );
+    """
+)
+
+
+def column_letter(number) -> str:
+    """
+    :param number: 1-based column number
+    :return: Its A1 notation letters, e.g. 1 -> A, 27 -> AA
+    """
+    letters = ''
+    while number > 0:
+        number, rem = divmod(number - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def _cell(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def row_hashes(df) -> np.ndarray:
+    """
+    :return: A 64-bit hash of every row's values as int64, vectorized per column
+    """
+    if len(df) == 0:
+        return np.zeros(0, dtype='int64')
+    return pd.util.hash_pandas_object(df, index=False).to_numpy().view('int64')
+
+
+def _header_hash(columns) -> int:
+    digest = hashlib.sha1('\x1f'.join(map(str, columns)).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little', signed=True)
 
 
 class GSheetWriter:
+    """
+    Exports DataFrames to blocks of a worksheet, sending only the rows that changed since the last export.
+
+    Every exported row's hash is kept per block in gsheet_rows, a local snapshot of what the sheet holds. An export
+    hashes the new rows, diffs them against the snapshot, merges the changed rows into contiguous ranges and sends
+    those with as few batch_update calls as the per-call cell limit allows, paced under the write quota. The
+    snapshot rows of each call are committed as soon as it succeeds, so an interrupted export resumes with only
+    what was never sent.
+    """
+
     SCOPES = [
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive'
     ]
     CREDENTIALS = "credentials.json"
     SHEET_NAME = "RBorrow Study"
+    WORKSHEET_NAME = "rBorrow RAW"
+
+    def __init__(self, db, worksheet=None, sheet_name=SHEET_NAME, worksheet_name=WORKSHEET_NAME,
+                 credentials=CREDENTIALS, max_cells=40000, requests_per_minute=50, max_retries=5):
+        """
+        :param db: LoansDB holding the snapshot
+        :param worksheet: gspread Worksheet, or anything with its row_count, col_count, add_rows, add_cols and
+        batch_update, e.g. a fake in tests. Opened from the sheet and worksheet names if None.
+        :param max_cells: Max cells sent per batch_update call
+        :param requests_per_minute: Write requests allowed per minute; Sheets allows 60 per user
+        :param max_retries: Retries of a call the quota rejected (429), each after a minute's pause
+        """
+        if worksheet is None:
+            if gspread is None:
+                raise ImportError("Exporting to Google Sheets requires the gspread and oauth2client packages.")
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(credentials, self.SCOPES)
+            worksheet = gspread.authorize(credentials).open(sheet_name).worksheet(worksheet_name)
+        self.db = db
+        self.worksheet = worksheet
+        self.sheet_name = sheet_name
+        self.worksheet_name = worksheet_name
+        self.max_cells = max_cells
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_minute / 60)
+        self.calls = 0
+        with self.db.conn:
+            for sql in SQL_CREATE:
+                self.db.conn.execute(sql)
+
+    def export(self, df, first_column=1, first_row=1) -> int:
+        """
+        Make the worksheet block starting at first_column, first_row hold df's header and rows, sending only what
+        differs from the last export of that block. Rows past the end of df that the last export wrote are blanked.
+
+        :param df: DataFrame in a stable row order, e.g. sorted by id, so unchanged rows keep their place
+        :param first_column: 1-based column the block starts at
+        :param first_row: 1-based row of the header
+        :return: Number of rows sent
+        """
+        started = time.monotonic()
+        calls = self.calls
+        block = f"{self.sheet_name}/{self.worksheet_name}/{column_letter(first_column)}{first_row}"
+        width = len(df.columns)
+        state = self.db.conn.execute("SELECT width FROM gsheet_blocks WHERE block = ?;", (block,)).fetchone()
+        old_width = state['width'] if state is not None else width
+        pad = max(old_width - width, 0)  # Columns a narrower block leaves behind, blanked
+
+        new = np.r_[_header_hash(df.columns), row_hashes(df)]
+        old = self.db.query_df("SELECT row, hash FROM gsheet_rows WHERE block = ?;", (block,),
+                               dtypes={'row': 'int64', 'hash': 'int64'})
+        stored = np.zeros(len(new), dtype='int64')
+        have = np.zeros(len(new), dtype=bool)
+        inside = old['row'].to_numpy() < len(new)
+        stored[old['row'].to_numpy()[inside]] = old['hash'].to_numpy()[inside]
+        have[old['row'].to_numpy()[inside]] = old_width == width  # Every row changes shape with the width
+        changed = np.flatnonzero(~have | (stored != new))
+        removed = np.sort(old['row'].to_numpy()[~inside])
+
+        self._fit(first_row + max(len(new), removed[-1] + 1 if len(removed) else 0) - 1,
+                  first_column + width + pad - 1)
+        blank = [''] * (width + pad)
+
+        def values(lo, hi):
+            out = []
+            if lo == 0:
+                out.append(list(map(str, df.columns)) + [''] * pad)
+                lo = 1
+            end = min(hi, len(new) - 1)
+            if lo <= end:
+                out.extend([_cell(v) for v in row] + [''] * pad
+                           for row in df.iloc[lo - 1:end].itertuples(index=False, name=None))
+            out.extend(blank for _ in range(max(lo, len(new)), hi + 1))
+            return out
+
+        rows = np.r_[changed, removed].astype('int64')
+        for batch in self._batches(rows, width + pad):
+            updates = [{'range': f"{column_letter(first_column)}{first_row + lo}:"
+                                 f"{column_letter(first_column + width + pad - 1)}{first_row + hi}",
+                        'values': values(lo, hi)} for lo, hi in batch]
+            self._send(updates)
+            sent = np.concatenate([np.arange(lo, hi + 1) for lo, hi in batch])
+            kept = sent[sent < len(new)]
+            gone = sent[sent >= len(new)]
+            with self.db.conn:
+                self.db.conn.executemany(
+                    "INSERT INTO gsheet_rows (block, row, hash) VALUES (?, ?, ?) "
+                    "ON CONFLICT (block, row) DO UPDATE SET hash = excluded.hash;",
+                    [(block, int(row), int(new[row])) for row in kept])
+                self.db.conn.executemany("DELETE FROM gsheet_rows WHERE block = ? AND row = ?;",
+                                         [(block, int(row)) for row in gone])
+        with self.db.conn:
+            self.db.conn.execute("INSERT INTO gsheet_blocks (block, width, exported_utc) VALUES (?, ?, ?) "
+                                 "ON CONFLICT (block) DO UPDATE SET width = excluded.width, "
+                                 "exported_utc = excluded.exported_utc;", (block, width, time.time()))
+        logging.info("Exported %s: %d of %d rows changed, %d blanked, in %d calls and %.1fs.", block,
+                     len(changed), len(new), len(removed), self.calls - calls, time.monotonic() - started)
+        return len(rows)
+
+    def _fit(self, rows, cols):
+        """
+        Grow the worksheet to at least rows x cols, as updates past its grid are rejected.
+        """
+        if rows > self.worksheet.row_count:
+            self.worksheet.add_rows(rows - self.worksheet.row_count)
+        if cols > self.worksheet.col_count:
+            self.worksheet.add_cols(cols - self.worksheet.col_count)
+
+    def _batches(self, rows, width):
+        """
+        :param rows: Sorted block row numbers to send
+        :return: Generator of lists of (first row, last row) ranges, each list at most max_cells cells
+        """
+        if len(rows) == 0:
+            return
+        per_range = max(self.max_cells // max(width, 1), 1)
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        batch = []
+        cells = 0
+        for run in np.split(rows, breaks):
+            for i in range(0, len(run), per_range):
+                lo, hi = int(run[i]), int(run[min(i + per_range, len(run)) - 1])
+                size = (hi - lo + 1) * width
+                if batch and cells + size > self.max_cells:
+                    yield batch
+                    batch = []
+                    cells = 0
+                batch.append((lo, hi))
+                cells += size
+        yield batch
+
+    def _send(self, updates):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                self.worksheet.batch_update(updates, value_input_option='RAW')
+                self.calls += 1
+                return
+            except Exception as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status != 429 or attempt == self.max_retries:
+                    raise
+                logging.warning("Sheets write quota exceeded; pausing for a minute.")
+                self.bucket.pause(60)
+
+
+def loan_summary(db) -> pd.DataFrame:
+    """
+    :return: One row per loan, by id, with its parties, amounts in major units, dates and realized return. Deleted
+    loans keep their row, with status deleted, so a deletion rewrites just that row and not every one below it.
+    """
+    df = db.query_df(
+        """
+        SELECT l.id AS loan_id, lu.name AS lender, bu.name AS borrower, l.currency_code AS currency,
+            l.principal_minor AS principal, l.principal_repayment_minor AS repaid,
+            COALESCE(l.currency_exponent, 2) AS currency_exponent,
+            date(l.created_at, 'unixepoch') AS created, date(l.repaid_at, 'unixepoch') AS repaid_on,
+            date(l.unpaid_at, 'unixepoch') AS unpaid_on,
+            CASE WHEN l.deleted_at IS NOT NULL THEN 'deleted' ELSE r.status END AS status,
+            r.apr, r.irr, r.days_to_repay
+        FROM loans l
+        LEFT JOIN users lu ON lu.id = l.lender_id
+        LEFT JOIN users bu ON bu.id = l.borrower_id
+        LEFT JOIN loan_returns r ON r.loan_id = l.id
+        ORDER BY l.id;
+        """)
+    scale = 10.0 ** df.pop('currency_exponent').astype('float64')
+    df['principal'] = df['principal'] / scale
+    df['repaid'] = df['repaid'] / scale
+    return df
+
 
-    def __init__(self):
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(self.CREDENTIALS, self.SCOPES)
-        file = gspread.authorize(credentials)
-        self.sheet = file.open(self.SHEET_NAME)
-        self.worksheet = self.sheet.worksheet("rBorrow RAW")
+def borrower_summary(db) -> pd.DataFrame:
+    """
+    :return: One row per user who has ever borrowed, from user_stats, in order of their first loan, so new
+    borrowers land at the bottom and a lender taking a first loan does not shift the rows below. Totals are in
+    minor units over 100, as user_stats sums them across currencies.
+    """
+    return db.query_df(
+        """
+        SELECT u.name AS borrower, s.loans_taken, s.borrowed_minor / 100.0 AS borrowed,
+            s.borrowed_repaid_minor / 100.0 AS repaid, s.repaid_fraction, s.unpaid_taken, s.median_days_to_repay,
+            date(s.last_activity, 'unixepoch') AS last_activity
+        FROM (SELECT borrower_id, MIN(created_at) AS first_borrowed FROM loans
+              WHERE borrower_id IS NOT NULL GROUP BY borrower_id) f
+        JOIN users u ON u.id = f.borrower_id
+        LEFT JOIN user_stats s ON s.user_id = f.borrower_id
+        ORDER BY f.first_borrowed, f.borrower_id;
+        """)
 
-    def write(self):
-        self.worksheet.update('A2:B3', [["Not Ford", "Not Lancia"], ["Nothing", "Not"]])
 
+def export_summaries(writer) -> int:
+    """
+    Export the loan summary and, one blank column to its right, the borrower summary.
 
-GSheetWriter().write()
+    :param writer: GSheetWriter
+    :return: Number of rows sent
+    """
+    loans = loan_summary(writer.db)
+    borrowers = borrower_summary(writer.db)
+    return writer.export(loans) + writer.export(borrowers, first_column=len(loans.columns) + 2)
@@ -1,25 +1,43 @@
-import sys
-
-import requests
 import logging
 
+from historical_gen.transport import default_transport
+
 
 class DataRetriever:
 
-    def __init__(self, timeout=60):
+    def __init__(self, timeout=60, cache=None, transport=None, limiter=None):
+        """
+        :param timeout: Timeout before request error
+        :param cache: Optional ResponseCache that GETs are served from and stored to
+        :param transport: Transport to send requests over. Defaults to the shared process-wide one.
+        :param limiter: Optional TokenBucket acquired before every request that goes to the network
+        """
         self.timeout = timeout
+        self.cache = cache
+        self.transport = transport if transport is not None else default_transport()
+        self.limiter = limiter
 
     def req_call(self, url, headers, params, max_retries=3):
-        retry_count = 0
-        while retry_count <= max_retries:
-            try:
-                logging.info(f"API call to %s with header %s and params %s.", url, headers, params)
-                r = requests.get(url, headers=headers, timeout=self.timeout, params=params)
-                r.raise_for_status()
-                return r
-            except Exception as e:
-                logging.error("Error fetching data; error:")
-                logging.error("%s", str(e))
-                retry_count += 1
-        logging.error("Max retries exceeded. Exiting.")
+        """
+        GET url. 429s, 5xx and connection errors are retried by the transport with jittered exponential
+        backoff; other client errors are not retried.
+
+        :return: The response, or None on error (or an offline cache miss)
+        """
+        def send(conditional):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            return self.transport.get(url, headers={**headers, **conditional}, params=params, timeout=self.timeout,
+                                      retries=max_retries)
+
+        try:
+            logging.info(f"API call to %s with header %s and params %s.", url, headers, params)
+            r = self.cache.fetch(url, params, send) if self.cache is not None else send({})
+            if r is None:
+                return None
+            r.raise_for_status()
+            return r
+        except Exception as e:
+            logging.error("Error fetching data; error:")
+            logging.error("%s", str(e))
         return None
@@ -0,0 +1,136 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['user_id', 'loans_taken', 'loans_given', 'borrowed_minor', 'borrowed_repaid_minor', 'lent_minor',
+           'lent_repaid_minor', 'repaid_fraction', 'unpaid_taken', 'unpaid_given', 'median_days_to_repay',
+           'last_activity']
+
+_LOAN_COLUMNS = ("l.created_at, l.principal_minor, l.principal_repayment_minor, l.last_repaid_at, l.repaid_at, "
+                 "l.unpaid_at")
+
+_DTYPES = {'user_id': 'int64', 'created_at': 'float64', 'principal_minor': 'float64',
+           'principal_repayment_minor': 'float64', 'last_repaid_at': 'float64', 'repaid_at': 'float64',
+           'unpaid_at': 'float64'}
+
+
+def aggregate(borrowed, lent) -> pd.DataFrame:
+    """
+    Compute user_stats rows from loans, vectorized per role with groupby. Amounts are summed in each loan's own
+    minor units, so they are only meaningful for users who stick to one currency, which is nearly everyone.
+
+    :param borrowed: DataFrame of the loans taken, with user_id as the borrower
+    :param lent: DataFrame of the loans given, with user_id as the lender
+    :return: DataFrame of COLUMNS, one row per user in either frame
+    """
+    def role(df, count, principal, repaid, unpaid):
+        g = df.groupby('user_id')
+        return pd.DataFrame({
+            count: g.size(),
+            principal: g['principal_minor'].sum(),
+            repaid: g['principal_repayment_minor'].sum(),
+            unpaid: g['unpaid_at'].count()
+        })
+
+    taken = role(borrowed, 'loans_taken', 'borrowed_minor', 'borrowed_repaid_minor', 'unpaid_taken')
+    given = role(lent, 'loans_given', 'lent_minor', 'lent_repaid_minor', 'unpaid_given')
+    stats = taken.join(given, how='outer')
+    counts = ['loans_taken', 'loans_given', 'borrowed_minor', 'borrowed_repaid_minor', 'lent_minor',
+              'lent_repaid_minor', 'unpaid_taken', 'unpaid_given']
+    stats[counts] = stats[counts].fillna(0).astype('int64')
+
+    stats['repaid_fraction'] = (stats['borrowed_repaid_minor'] / stats['borrowed_minor'].where(
+        stats['borrowed_minor'] > 0))
+    repaid = borrowed[borrowed['repaid_at'].notna()]
+    days = (repaid['repaid_at'] - repaid['created_at']) / 86400
+    stats['median_days_to_repay'] = days.groupby(repaid['user_id']).median()
+
+    both = pd.concat([borrowed, lent])
+    activity = both[['created_at', 'last_repaid_at', 'repaid_at', 'unpaid_at']].max(axis=1)
+    stats['last_activity'] = activity.groupby(both['user_id']).max()
+
+    stats.index.name = 'user_id'
+    return stats.reset_index()[COLUMNS]
+
+
+class UserStats:
+    """
+    Maintains user_stats, one row of borrower/lender aggregates per user, so a per-user lookup is a primary key
+    seek. Triggers on loans and loan_events (db.MIGRATIONS) queue the users a write touches in user_stats_dirty,
+    in the same transaction as the write. A refresh recomputes just those users from their loans, reading the
+    covering borrower and lender indexes, rather than rebuilding the table.
+    """
+
+    def __init__(self, db, chunk_users=20000):
+        """
+        :param db: LoansDB
+        :param chunk_users: Dirty users recomputed per committed chunk
+        """
+        self.db = db
+        self.chunk_users = chunk_users
+
+    def refresh(self) -> int:
+        """
+        :return: Number of users recomputed
+        """
+        started = time.monotonic()
+        done = 0
+        while True:
+            users = [row[0] for row in self.db.conn.execute(
+                "SELECT user_id FROM user_stats_dirty ORDER BY user_id LIMIT ?;", (self.chunk_users,))]
+            if not users:
+                break
+            lo, hi = users[0], users[-1]
+            stats = self._compute("JOIN user_stats_dirty d ON d.user_id = l.{role} WHERE d.user_id BETWEEN ? AND ?",
+                                  (lo, hi))
+            with self.db.conn:
+                self.db.conn.execute("DELETE FROM user_stats WHERE user_id BETWEEN ? AND ? AND user_id IN "
+                                     "(SELECT user_id FROM user_stats_dirty);", (lo, hi))
+                self.db.bulk_upsert('user_stats', stats, key=('user_id',), join_transaction=True)
+                self.db.conn.execute("DELETE FROM user_stats_dirty WHERE user_id BETWEEN ? AND ?;", (lo, hi))
+            done += len(users)
+            logging.debug("Recomputed stats of %d users.", done)
+        if done:
+            logging.info("Recomputed stats of %d users in %.1fs.", done, time.monotonic() - started)
+        return done
+
+    def rebuild(self) -> int:
+        """
+        Mark every user with a loan dirty and refresh.
+        """
+        with self.db.conn:
+            self.db.conn.execute("INSERT OR IGNORE INTO user_stats_dirty (user_id) "
+                                 "SELECT borrower_id FROM loans WHERE borrower_id IS NOT NULL "
+                                 "UNION SELECT lender_id FROM loans WHERE lender_id IS NOT NULL;")
+        return self.refresh()
+
+    def check(self, tolerance=1e-9) -> list:
+        """
+        Compare user_stats with a full recompute from loans.
+
+        :return: Ids of the users whose stored row is missing, extra or different
+        """
+        expected = self._compute("WHERE l.{role} IS NOT NULL", ()).set_index('user_id')
+        stored = self.db.query_df(f"SELECT {', '.join(COLUMNS)} FROM user_stats;").set_index('user_id')
+        missing = expected.index.difference(stored.index)
+        extra = stored.index.difference(expected.index)
+        common = expected.index.intersection(stored.index)
+        a = expected.loc[common, COLUMNS[1:]].astype('float64').to_numpy()
+        b = stored.loc[common, COLUMNS[1:]].astype('float64').to_numpy()
+        same = np.isclose(a, b, rtol=tolerance, atol=tolerance, equal_nan=True).all(axis=1)
+        bad = sorted(set(missing) | set(extra) | set(common[~same]))
+        if bad:
+            logging.warning("user_stats differs from a full recompute for %d users, e.g. %s.", len(bad), bad[:10])
+        else:
+            logging.info("user_stats matches a full recompute for all %d users.", len(expected))
+        return bad
+
+    def _compute(self, where, params) -> pd.DataFrame:
+        frames = []
+        for role in ('borrower_id', 'lender_id'):
+            frames.append(self.db.query_df(
+                f"SELECT l.{role} AS user_id, {_LOAN_COLUMNS} FROM loans l {where.format(role=role)} "
+                "AND l.deleted_at IS NULL;", params, dtypes=_DTYPES))
+        return aggregate(*frames)
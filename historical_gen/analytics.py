@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+from historical_gen.columnar import StagingSchema
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the analytics export
+    pa = None
+    pq = None
+
+MANIFEST = 'manifest.json'
+
+# Dataset and the core table it exports (db.MIGRATIONS), epoch seconds column it is partitioned by, and user name
+# columns added from users, each with the user id column it resolves
+DATASETS = (
+    ('submissions', 'created_utc', (('author', 'author_id'),)),
+    ('comments', 'created_utc', (('author', 'author_id'),)),
+    ('loans', 'created_at', (('lender', 'lender_id'), ('borrower', 'borrower_id'))),
+    ('loan_events', 'occurred_at', ()),
+)
+
+SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS analytics_dirty (
+        dataset TEXT,
+        partition INTEGER,
+        PRIMARY KEY (dataset, partition)
+    ) WITHOUT ROWID;
+    """
+
+
+def _partition_sql(row, time_col):
+    # YYYYMM of a row's timestamp; 0 for rows without one
+    return f"COALESCE(CAST(strftime('%Y%m', {row}{time_col}, 'unixepoch') AS INTEGER), 0)"
+
+
+def _sql_triggers(name, time_col):
+    """
+    :return: Triggers queueing the partitions every write to the core table touches in analytics_dirty
+    """
+    def mark(row):
+        return (f"INSERT INTO analytics_dirty (dataset, partition) VALUES ('{name}', {_partition_sql(row, time_col)}) "
+                f"ON CONFLICT (dataset, partition) DO NOTHING;")
+
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {name}_analytics_insert AFTER INSERT ON {name} BEGIN {mark('NEW.')} END;",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_analytics_update AFTER UPDATE ON {name} BEGIN {mark('NEW.')} "
+        f"{mark('OLD.')} END;",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_analytics_delete AFTER DELETE ON {name} BEGIN {mark('OLD.')} END;"
+    )
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The analytics export requires the pyarrow package.")
+
+
+def partition_dir(dataset, partition) -> str:
+    """
+    :return: Hive style folder of a YYYYMM partition, relative to the export root: dataset/year=YYYY/month=MM
+    """
+    return os.path.join(dataset, f"year={partition // 100:04d}", f"month={partition % 100:02d}")
+
+
+class AnalyticsExport:
+    """
+    Exports the normalized core tables the warehouse keeps (one row per post, loan and event, with user ids
+    resolved back to names) as typed, zstd Parquet datasets partitioned by year and month, one file per month, so
+    analysts read files instead of querying the live database. Triggers on the core tables queue the partitions
+    every write touches in analytics_dirty, and an export rewrites just those, reading them in one scan of the
+    table. The first export of a dataset, one whose columns changed, or one with full, writes all of it.
+
+    manifest.json in the export root lists, per dataset, the column types and every partition's path, row count
+    and time range, so readers can prune partitions and project columns without opening SQLite; see
+    read_dataset().
+    """
+
+    def __init__(self, db, root, chunk_rows=100000):
+        """
+        :param db: LoansDB
+        :param root: Export folder
+        :param chunk_rows: Rows read from SQLite at a time
+        """
+        _require_pyarrow()
+        self.db = db
+        self.root = root
+        self.chunk_rows = chunk_rows
+
+    def run(self, full=False) -> dict:
+        """
+        :param full: Rewrite every partition of every dataset
+        :return: Dict of dataset -> # partitions written
+        """
+        os.makedirs(self.root, exist_ok=True)
+        manifest = read_manifest(self.root)
+        with self.db.conn:
+            self.db.conn.execute(SQL_CREATE)
+        summary = {}
+        for name, time_col, user_cols in DATASETS:
+            started = time.monotonic()
+            schema = self._schema(name, user_cols)
+            with self.db.conn:
+                for sql in _sql_triggers(name, time_col):
+                    self.db.conn.execute(sql)
+                dirty = [row[0] for row in self.db.conn.execute(
+                    "SELECT partition FROM analytics_dirty WHERE dataset = ?;", (name,))]
+            columns = [list(col) for col in schema.columns]
+            everything = full or manifest.get(name, {}).get('columns') != columns
+            if not everything and not dirty:
+                summary[name] = 0
+                continue
+            entry = manifest.get(name, {'partitions': {}})
+            written = self._export(name, schema, time_col, user_cols, None if everything else dirty)
+            partitions = {} if everything else entry['partitions']
+            for partition in dirty:
+                partitions.pop(str(partition), None)
+            partitions.update({str(partition): info for partition, info in written.items()})
+            manifest[name] = {
+                'table': name,
+                'time_column': time_col,
+                'columns': columns,
+                'partitions': dict(sorted(partitions.items())),
+                'exported_utc': time.time()
+            }
+            self._remove_stale(name, partitions)
+            write_manifest(self.root, manifest)
+            with self.db.conn:
+                self.db.conn.executemany("DELETE FROM analytics_dirty WHERE dataset = ? AND partition = ?;",
+                                         [(name, partition) for partition in dirty])
+            summary[name] = len(written)
+            logging.info("Exported %d partitions of %s (%d rows) in %.1fs.", len(written), name,
+                         sum(info['rows'] for info in written.values()), time.monotonic() - started)
+        return summary
+
+    def _schema(self, table, user_cols) -> StagingSchema:
+        """
+        :return: Columns and types of the core table as it is in this database, migrations included, then the
+        user name columns
+        """
+        sql = self.db.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                                   (table,)).fetchone()[0]
+        schema = StagingSchema(sql)
+        schema.columns.extend((col, 'TEXT') for col, _ in user_cols)
+        return schema
+
+    def _export(self, name, schema, time_col, user_cols, partitions) -> dict:
+        """
+        Write the given partitions of a dataset, or all of them if None, in one pass over its table. Each file is
+        written beside its final path and swapped in once the pass is done.
+
+        :return: Dict of partition -> manifest entry of each file written
+        """
+        where = ""
+        params = ()
+        if partitions is not None:
+            where = f"WHERE {_partition_sql('t.', time_col)} IN ({', '.join('?' * len(partitions))})"
+            params = tuple(partitions)
+        user_names = {col for col, _ in user_cols}
+        select = [f"t.{col}" for col in schema.names if col not in user_names]
+        joins = []
+        for i, (col, id_col) in enumerate(user_cols):
+            select.append(f"u{i}.name AS {col}")
+            joins.append(f"LEFT JOIN users u{i} ON u{i}.id = t.{id_col}")
+        arrow_schema = schema.arrow_schema()
+        writers = {}
+        info = {}
+        try:
+            for df in self.db.iter_df(f"SELECT {', '.join(select)} FROM {name} t {' '.join(joins)} {where};", params,
+                                      chunk_rows=self.chunk_rows):
+                df = schema.conform(df)
+                created = pd.to_datetime(df[time_col], unit='s')
+                keys = (created.dt.year * 100 + created.dt.month).fillna(0).astype('int64')
+                for partition, part in df.groupby(keys.to_numpy()):
+                    partition = int(partition)
+                    if partition not in writers:
+                        folder = os.path.join(self.root, partition_dir(name, partition))
+                        os.makedirs(folder, exist_ok=True)
+                        path = os.path.join(folder, f"{name}.parquet")
+                        writers[partition] = pq.ParquetWriter(path + '.tmp', arrow_schema, compression='zstd')
+                        info[partition] = {'path': os.path.relpath(path, self.root).replace(os.sep, '/'),
+                                           'rows': 0, 'min_time': None, 'max_time': None}
+                    writers[partition].write_table(pa.Table.from_pandas(part, schema=arrow_schema,
+                                                                        preserve_index=False))
+                    entry = info[partition]
+                    entry['rows'] += len(part)
+                    times = part[time_col].dropna()
+                    if len(times):
+                        lo, hi = float(times.min()), float(times.max())
+                        entry['min_time'] = lo if entry['min_time'] is None else min(entry['min_time'], lo)
+                        entry['max_time'] = hi if entry['max_time'] is None else max(entry['max_time'], hi)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        for entry in info.values():
+            path = os.path.join(self.root, entry['path'])
+            os.replace(path + '.tmp', path)
+            entry['bytes'] = os.path.getsize(path)
+        return info
+
+    def _remove_stale(self, name, partitions):
+        """
+        Delete the dataset's partition files the manifest no longer lists, e.g. months whose rows all went, and the
+        folders that leaves empty.
+        """
+        listed = {os.path.normpath(os.path.join(self.root, entry['path'])) for entry in partitions.values()}
+        folder = os.path.join(self.root, name)
+        for root, dirs, files in os.walk(folder, topdown=False):
+            for file in files:
+                path = os.path.normpath(os.path.join(root, file))
+                if file.endswith('.parquet') and path not in listed:
+                    os.remove(path)
+            if root != folder and not os.listdir(root):
+                os.rmdir(root)
+
+
+def read_manifest(root) -> dict:
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(root, manifest):
+    path = os.path.join(root, MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def read_dataset(root, name, columns=None, since=None, until=None) -> pd.DataFrame:
+    """
+    Read an exported dataset without SQLite, opening only the partitions the manifest says overlap the time range
+    and decoding only the wanted columns.
+
+    :param root: Export folder
+    :param name: Dataset, e.g. 'loans'
+    :param columns: Columns wanted; all if None
+    :param since: Only rows at or after this epoch second
+    :param until: Only rows before this epoch second
+    """
+    _require_pyarrow()
+    entry = read_manifest(root)[name]
+    time_col = entry['time_column']
+    paths = []
+    for info in entry['partitions'].values():
+        if since is not None and info['max_time'] is not None and info['max_time'] < since:
+            continue
+        if until is not None and info['min_time'] is not None and info['min_time'] >= until:
+            continue
+        paths.append(os.path.join(root, info['path']))
+    wanted = None if columns is None else list(dict.fromkeys(list(columns) + [time_col]))
+    if not paths:
+        return pd.DataFrame(columns=wanted or [col for col, _ in entry['columns']])
+    pandas_types = {pa.int64(): pd.Int64Dtype(), pa.string(): pd.StringDtype()}
+    df = pq.read_table(paths, columns=wanted, partitioning=None).to_pandas(types_mapper=pandas_types.get)
+    if since is not None:
+        df = df[df[time_col] >= since]
+    if until is not None:
+        df = df[df[time_col] < until]
+    return df.reset_index(drop=True)[list(columns)] if columns is not None else df.reset_index(drop=True)
@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from historical_gen.aggregates import UserStats
+from historical_gen.analytics import AnalyticsExport
+from historical_gen.columnar import CSV
+from historical_gen.ingest import IngestComments, IngestLoanBasic, IngestLoanEvents, IngestSubmissions
+from historical_gen.links import ThreadLinker
+from historical_gen.returns import LoanReturns
+from historical_gen.search import COMMENT
+from historical_gen.survival import HISTORY, PRINCIPAL, SurvivalCurves
+from historical_gen.synthetic import write_batch
+from historical_gen.titles import parse_new_titles
+from historical_gen.warehouse import Warehouse
+
+SEARCH_QUERIES = ('paypal', '"happy to answer"', 'repay*', 'venmo NOT zelle', 'NEAR(loan gbp, 2)', 'unpaid')
+
+
+def rss_mb():
+    """
+    :return: Current resident set size of this process in MiB, from /proc/self/statm. None where that is missing,
+    e.g. not on Linux.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+class _RssSampler(threading.Thread):
+    """
+    Samples rss_mb() every interval seconds until stopped, keeping the highest value seen.
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._sample()
+        return self.peak
+
+    def _sample(self):
+        rss = rss_mb()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+
+def code_version():
+    """
+    :return: The checked out git commit, with a + if the tree has changes, or None outside a git checkout
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True,
+                             timeout=10, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root,
+                               capture_output=True, text=True, timeout=10, check=True).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return rev + ('+' if dirty else '')
+
+
+class Benchmark:
+    """
+    Records the wall time of every call of every stage, with the rows it handled, and reports per stage the
+    total rows, throughput, latency percentiles over its calls and the highest RSS sampled while any of its calls
+    ran. RSS is this process's only, so files parsed in ingest worker processes are not counted.
+    """
+
+    def __init__(self, params=None):
+        """
+        :param params: Dict describing the run, e.g. the data's scale, saved along with the results
+        """
+        self.params = params or {}
+        self.calls = {}  # Stage -> list of (seconds, rows)
+        self.peaks = {}  # Stage -> highest RSS sampled during its calls
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """
+        Time the block as one call of stage name.
+
+        :param rows: Rows the call handles, if known before it runs; set the yielded dict's 'rows' otherwise
+        """
+        call = {'rows': rows}
+        sampler = _RssSampler()
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            yield call
+        finally:
+            elapsed = time.perf_counter() - started
+            peak = sampler.stop()
+        self.calls.setdefault(name, []).append((elapsed, call['rows']))
+        if peak is not None:
+            self.peaks[name] = max(self.peaks.get(name, peak), peak)
+        logging.debug("%s: %d rows in %.3fs", name, call['rows'], elapsed)
+
+    def results(self) -> list[dict]:
+        out = []
+        for name, calls in self.calls.items():
+            seconds = np.array([elapsed for elapsed, _ in calls])
+            rows = int(sum(count for _, count in calls))
+            p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+            out.append({
+                'stage': name,
+                'calls': len(calls),
+                'rows': rows,
+                'seconds': float(seconds.sum()),
+                'rows_per_second': rows / seconds.sum() if rows and seconds.sum() > 0 else None,
+                'p50_ms': float(p50),
+                'p90_ms': float(p90),
+                'p99_ms': float(p99),
+                'max_ms': float(seconds.max() * 1000),
+                'peak_rss_mb': self.peaks.get(name)
+            })
+        return out
+
+    def report(self) -> str:
+        return pd.DataFrame(self.results()).set_index('stage').to_string(float_format='{:.1f}'.format)
+
+    def save(self, path) -> dict:
+        """
+        Write the results, the run's parameters and what it ran on as JSON.
+
+        :return: What was written
+        """
+        doc = {
+            'version': code_version(),
+            'started_utc': self.started,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': self.params,
+            'stages': self.results()
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(doc, f, indent=1)
+        os.replace(path + '.tmp', path)
+        return doc
+
+
+def compare(baseline, current, threshold=0.1) -> pd.DataFrame:
+    """
+    :param baseline: Saved results (Benchmark.save) of an earlier run
+    :param current: Saved results of this run
+    :param threshold: Relative change in throughput, p50 or p99 latency or peak RSS flagged as a regression
+    :return: DataFrame per stage in both runs of throughput, p50 and p99 and peak RSS, this run's over the
+    baseline's, and whether any got worse past the threshold
+    """
+    old = pd.DataFrame(baseline['stages']).set_index('stage')
+    new = pd.DataFrame(current['stages']).set_index('stage')
+    both = new.index.intersection(old.index, sort=False)
+    out = pd.DataFrame(index=both)
+    for col in ('rows_per_second', 'p50_ms', 'p99_ms', 'peak_rss_mb'):
+        out[col] = pd.to_numeric(new.loc[both, col], errors='coerce') / pd.to_numeric(old.loc[both, col],
+                                                                                      errors='coerce')
+    out['regressed'] = ((out['rows_per_second'] < 1 - threshold) | (out['p50_ms'] > 1 + threshold)
+                        | (out['p99_ms'] > 1 + threshold) | (out['peak_rss_mb'] > 1 + threshold))
+    return out
+
+
+def run_pipeline(bench, db, generator, folder, batches=10, fmt=CSV, workers=1, matcher=None, query_repeats=20):
+    """
+    Push generated data through every stage of the pipeline one batch at a time, as daily runs would, then time
+    the read paths. Every batch is one call of each stage, so stage latency percentiles are over batches.
+
+    :param bench: Benchmark to record into
+    :param db: Empty LoansDB
+    :param generator: SyntheticBorrow
+    :param folder: Empty working folder for staging files and the analytics export
+    :param batches: Number of batches
+    :param fmt: Staging file format, CSV or PARQUET
+    :param workers: Processes parsing staged files
+    :param matcher: AliasMatcher of payment methods for the titles stage; skipped if None
+    :param query_repeats: Calls of each read path
+    """
+    folders = {key: os.path.join(folder, 'staging', key)
+               for key in ('submissions', 'comments', 'loan_basic', 'loan_events')}
+    ingests = (('submissions', IngestSubmissions), ('comments', IngestComments), ('loan_basic', IngestLoanBasic),
+               ('loan_events', IngestLoanEvents))
+    try:
+        export = AnalyticsExport(db, os.path.join(folder, 'analytics'))
+    except ImportError:
+        logging.warning("pyarrow is not installed; skipping the analytics export stage.")
+        export = None
+    generated = generator.batches(batches)
+    for i in range(batches):
+        logging.info("Benchmark batch %d of %d.", i + 1, batches)
+        with bench.stage('generate') as call:
+            batch = next(generated)
+            call['rows'] = sum(len(df) for df in batch.values())
+        rows = {key: len(df) for key, df in batch.items()}
+        with bench.stage('stage files', sum(rows.values())):
+            write_batch(batch, folders, f"{i:05d}", fmt)
+        del batch
+        for key, ingest_cls in ingests:
+            with bench.stage(f'ingest {key}', rows[key]):
+                ingest_cls(folders[key], db, workers=workers).ingest()
+        if matcher is not None:
+            with bench.stage('titles') as call:
+                call['rows'] = parse_new_titles(db, matcher)
+        # Before the warehouse, as in main.sync, so each batch's links reach core in its own refresh
+        with bench.stage('link comments') as call:
+            call['rows'] = sum(ThreadLinker(db).run().values())
+        with bench.stage('warehouse') as call:
+            call['rows'] = sum(Warehouse(db).refresh().values())
+        with bench.stage('user stats') as call:
+            call['rows'] = UserStats(db).refresh()
+        with bench.stage('loan returns') as call:
+            call['rows'] = LoanReturns(db).refresh()
+        if export is not None:
+            with bench.stage('analytics export', sum(rows.values())):
+                export.run()
+
+    rng = np.random.default_rng(generator.seed)
+    for i in range(query_repeats):
+        with bench.stage('search') as call:
+            call['rows'] = len(db.search(SEARCH_QUERIES[i % len(SEARCH_QUERIES)]))
+        with bench.stage('search comments by author') as call:
+            author = generator.names[rng.choice(len(generator.names), p=generator.lender_weights)]
+            call['rows'] = len(db.search('loan OR paid', kind=COMMENT, author=author))
+        with bench.stage('borrower history') as call:
+            user = generator.names[rng.choice(len(generator.names), p=generator.borrower_weights)]
+            call['rows'] = len(db.query_df(
+                "SELECT l.* FROM loans l JOIN users u ON u.id = l.borrower_id WHERE u.name = ?;", (user,)))
+    curves = SurvivalCurves(db)
+    for i in range(max(query_repeats // 4, 1)):
+        with db.conn:
+            db.conn.execute("DELETE FROM survival_cache;")
+        with bench.stage('survival curves') as call:
+            call['rows'] = len(curves.curves(by=(PRINCIPAL, HISTORY)))
+    for i in range(query_repeats):
+        with bench.stage('survival curves (cached)') as call:
+            call['rows'] = len(curves.curves(by=(PRINCIPAL, HISTORY)))
+
@@ -0,0 +1,229 @@
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the parquet staging format
+    pa = None
+    pq = None
+
+CSV = 'csv'
+PARQUET = 'parquet'
+FORMATS = (CSV, PARQUET)
+STAGING_EXTENSIONS = ('.csv', '.parquet')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The parquet staging format requires the pyarrow package.")
+
+
+class StagingSchema:
+    """
+    Column names and types of one staging_*_raw table, read from its CREATE TABLE statement so staged files
+    cannot drift from the table they are ingested into. SQLite INTEGER / REAL / TEXT become nullable int64 /
+    float64 / string columns.
+    """
+
+    def __init__(self, sql_create, overrides=None):
+        """
+        :param sql_create: CREATE TABLE statement of the table the staged files are ingested into
+        :param overrides: Dict of column -> SQLite type for columns whose declared type does not fit the data
+        """
+        overrides = overrides or {}
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute(sql_create)
+            self.table = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';").fetchone()[0]
+            info = conn.execute(f"PRAGMA table_info({self.table});").fetchall()
+        finally:
+            conn.close()
+        self.columns = [(row[1], overrides.get(row[1], row[2].upper())) for row in info]
+
+    @property
+    def names(self) -> list[str]:
+        return [name for name, _ in self.columns]
+
+    def arrow_schema(self):
+        _require_pyarrow()
+        arrow_types = {'INTEGER': pa.int64(), 'REAL': pa.float64(), 'TEXT': pa.string()}
+        return pa.schema([(name, arrow_types[sql_type]) for name, sql_type in self.columns])
+
+    def conform(self, df) -> pd.DataFrame:
+        """
+        :return: df with exactly the schema's columns in order, missing ones null, each cast to its type. Values
+        that cannot be cast become null.
+        """
+        out = {}
+        for name, sql_type in self.columns:
+            if name in df.columns:
+                out[name] = _cast(df[name], sql_type)
+            else:
+                out[name] = _cast(pd.Series(None, index=df.index, dtype=object), sql_type)
+        return pd.DataFrame(out, index=df.index)
+
+
+def _cast(s, sql_type):
+    if sql_type == 'TEXT':
+        return s.astype('string')
+    if s.dtype == bool or pd.api.types.is_integer_dtype(s.dtype):
+        numeric = s
+    else:
+        numeric = pd.to_numeric(s.astype(object), errors='coerce')
+    if sql_type == 'REAL':
+        return numeric.astype('float64')
+    if pd.api.types.is_float_dtype(numeric.dtype):
+        numeric = numeric.round()
+    return numeric.astype('Int64')
+
+
+def staging_path(path_base, fmt) -> str:
+    return f"{path_base}.{fmt}"
+
+
+def write_staging(df, path_base, schema, fmt=CSV) -> str:
+    """
+    Write one staging file.
+
+    :param df: Rows to stage
+    :param path_base: Output path without extension
+    :param schema: StagingSchema of the target table. Parquet files are written with exactly its columns.
+    :param fmt: CSV or PARQUET
+    :return: Path written
+    """
+    path = staging_path(path_base, fmt)
+    if fmt == PARQUET:
+        _write_parquet(schema.conform(df), path, schema)
+    elif fmt == CSV:
+        df.to_csv(path, escapechar='\\', index=False)
+    else:
+        raise ValueError(f"Unknown staging format {fmt}")
+    return path
+
+
+def _write_parquet(df, path, schema):
+    _require_pyarrow()
+    table = pa.Table.from_pandas(df, schema=schema.arrow_schema(), preserve_index=False)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def read_staging(path, columns=None) -> pd.DataFrame:
+    """
+    Read a staged CSV or parquet file, parsing only the given columns.
+
+    :param path: File to read
+    :param columns: Columns wanted. Any the file lacks are simply absent from the result.
+    """
+    if path.endswith('.parquet'):
+        _require_pyarrow()
+        if columns is not None:
+            present = set(pq.read_schema(path).names)
+            columns = [col for col in columns if col in present]
+        pandas_types = {pa.int64(): pd.Int64Dtype(), pa.string(): pd.StringDtype()}
+        return pq.read_table(path, columns=columns).to_pandas(types_mapper=pandas_types.get)
+    if columns is None:
+        return pd.read_csv(path, escapechar='\\')
+    wanted = set(columns)
+    return pd.read_csv(path, escapechar='\\', usecols=lambda col: col in wanted)
+
+
+def iter_staging(path, columns=None, chunk_rows=100000):
+    """
+    Read a staged CSV or parquet file chunk_rows rows at a time, so files of any size are read in bounded memory.
+    CSV floats are parsed to round-trip exactly, as they may be part of a key.
+
+    :param path: File to read
+    :param columns: Columns wanted. Any the file lacks are simply absent from the result.
+    :param chunk_rows: Rows per DataFrame
+    :return: Iterator of DataFrames
+    """
+    if path.endswith('.parquet'):
+        _require_pyarrow()
+        parquet_file = pq.ParquetFile(path)
+        if columns is not None:
+            present = set(parquet_file.schema_arrow.names)
+            columns = [col for col in columns if col in present]
+        pandas_types = {pa.int64(): pd.Int64Dtype(), pa.string(): pd.StringDtype()}
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas(types_mapper=pandas_types.get)
+        return
+    wanted = None if columns is None else set(columns)
+    try:
+        reader = pd.read_csv(path, escapechar='\\', usecols=None if wanted is None else (lambda col: col in wanted),
+                             chunksize=chunk_rows, float_precision='round_trip')
+    except pd.errors.EmptyDataError:  # A batch of loans without a single event
+        return
+    with reader:
+        yield from reader
+
+
+def staging_files(folder) -> list[str]:
+    """
+    :return: Every staged file under folder: the compacted month partitions, then the window files at the top of
+    folder. Windows not compacted yet were fetched after every month file's rows, so ingesting in this order lets
+    them win, even where a re-fetched window overlaps a compacted month.
+    """
+    months = []
+    windows = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        names = [os.path.join(root, name) for name in sorted(files) if name.endswith(STAGING_EXTENSIONS)]
+        (windows if os.path.samefile(root, folder) else months).extend(names)
+    return months + windows
+
+
+def compact_staging(folder, schema, prefix, time_col='created_utc', key='id') -> tuple[int, int]:
+    """
+    Merge the per-window files at the top of folder into one zstd parquet file per month of time_col, at
+    folder/year=YYYY/month=MM/{prefix}_YYYY-MM.parquet. A month file that already exists is merged with the new
+    rows, and when a key appears twice the row from the newest window file wins. Window files are removed once
+    every month file is written.
+
+    :param folder: Staging folder
+    :param schema: StagingSchema of the target table
+    :param prefix: Month file name prefix
+    :param time_col: Epoch seconds column to partition by
+    :param key: Unique row key
+    :return: Tuple(# window files merged, # month files written)
+    """
+    _require_pyarrow()
+    paths = sorted(entry.path for entry in os.scandir(folder)
+                   if entry.is_file() and entry.name.endswith(STAGING_EXTENSIONS))
+
+    def month_keys(df):
+        # YYYYMM of each row; rows without a timestamp go to year=0000/month=00
+        times = df[time_col] if time_col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        created = pd.to_datetime(pd.to_numeric(times, errors='coerce'), unit='s')
+        return created.dt.year.fillna(0).astype(int) * 100 + created.dt.month.fillna(0).astype(int)
+
+    # Read just the timestamps first, so only one month's rows are held at a time below
+    months = {}
+    for path in paths:
+        for month in month_keys(read_staging(path, [time_col])).unique():
+            months.setdefault(int(month), []).append(path)
+
+    for key_month in sorted(months):
+        year, month = divmod(key_month, 100)
+        month_dir = os.path.join(folder, f"year={year:04d}", f"month={month:02d}")
+        os.makedirs(month_dir, exist_ok=True)
+        path = os.path.join(month_dir, f"{prefix}_{year:04d}-{month:02d}.parquet")
+        frames = []
+        for window in months[key_month]:
+            df = schema.conform(read_staging(window, schema.names))
+            frames.append(df[month_keys(df).to_numpy() == key_month])
+        if os.path.exists(path):
+            frames.insert(0, read_staging(path))
+        df = schema.conform(pd.concat(frames, ignore_index=True))
+        df = df.drop_duplicates(subset=key, keep='last').sort_values([time_col, key], kind='stable')
+        logging.debug("Writing %d %s to month file %s", len(df), prefix, path)
+        _write_parquet(df, path, schema)
+
+    for path in paths:
+        os.remove(path)
+    return len(paths), len(months)
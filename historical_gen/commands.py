@@ -0,0 +1,139 @@
+import logging
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+# Cheap pre-filter for comments that may hold a LoansBot command
+COMMAND_FILTER = re.compile(r'\$(?:loan|paid|confirm|unpaid)', re.IGNORECASE)
+
+CURRENCY_CODES = ('USD', 'CAD', 'EUR', 'GBP', 'AUD', 'NZD', 'JPY', 'MXN', 'INR', 'CHF', 'SEK', 'NOK', 'DKK', 'PLN',
+                  'BRL', 'ZAR', 'SGD', 'HKD', 'PHP')
+CURRENCY_SYMBOLS = {'$': 'USD', '€': 'EUR', '£': 'GBP'}
+
+# $loan <amount>, $confirm /u/<user> <amount>, $paid /u/<user> <amount>, $unpaid /u/<user>,
+# $paid_with_id <loan id> <amount>; amounts like 50, $1,250.00 or 20 EUR
+COMMAND_PATTERN = re.compile(r"""
+    \$(?:
+        (?P<with_id>paid_with_id)\s+(?P<loan_id>\d+)
+      | (?P<command>loan|paid|confirm|unpaid)(?!\w)(?:\s+/?u/(?P<user>[\w-]+))?
+    )
+    (?:\s+(?P<symbol>[$€£])?(?P<amount>\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)
+       (?:\s?(?P<code>""" + '|'.join(CURRENCY_CODES) + r"""))?(?![A-Za-z])
+    )?
+    """, re.IGNORECASE | re.VERBOSE)
+
+SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS loan_commands (
+        comment_id TEXT,
+        position INTEGER,
+        command TEXT,
+        thread_id TEXT,
+        author TEXT,
+        counterparty TEXT,
+        loan_id INTEGER,
+        amount REAL,
+        amount_minor INTEGER,
+        currency TEXT,
+        created_utc INTEGER,
+        PRIMARY KEY (comment_id, position)
+    );
+    """
+SQL_CREATE_INDEX = "CREATE INDEX IF NOT EXISTS loan_commands_thread ON loan_commands (thread_id);"
+
+COLUMNS = ['comment_id', 'position', 'command', 'thread_id', 'author', 'counterparty', 'loan_id', 'amount',
+           'amount_minor', 'currency', 'created_utc']
+
+
+def extract_commands(comments) -> pd.DataFrame:
+    """
+    Parse every LoansBot command out of a batch of comments with one vectorized regex pass.
+
+    Mentions that do not form a command, like "$confirm is to ensure...", are dropped: $loan needs an amount,
+    $paid / $confirm / $unpaid a user and $paid_with_id a loan id.
+
+    :param comments: DataFrame with id, link_id, author, body, created_utc
+    :return: DataFrame of COLUMNS, one row per command; position is its index among the comment's matches
+    """
+    comments = comments.reset_index(drop=True)
+    bodies = comments['body'].astype('string').fillna('')
+    found = bodies.str.extractall(COMMAND_PATTERN)
+    if len(found) == 0:
+        return pd.DataFrame(columns=COLUMNS)
+
+    command = found['command'].str.lower().fillna(found['with_id'].str.lower())
+    amount = pd.to_numeric(found['amount'].str.replace(',', '', regex=False), errors='coerce')
+    valid = (((command == 'loan') & amount.notna())
+             | (command.isin(['paid', 'confirm', 'unpaid']) & found['user'].notna())
+             | ((command == 'paid_with_id') & found['loan_id'].notna()))
+
+    rows = comments.iloc[found.index.get_level_values(0)]
+    currency = found['code'].str.upper().fillna(found['symbol'].map(CURRENCY_SYMBOLS))
+    currency = currency.where(currency.notna() | amount.isna(), 'USD')  # LoansBot assumes dollars
+
+    out = pd.DataFrame({
+        'comment_id': rows['id'].to_numpy(),
+        'position': found.index.get_level_values(1),
+        'command': command.to_numpy(),
+        'thread_id': rows['link_id'].astype('string').str.replace(r'^t3_', '', regex=True).to_numpy(),
+        'author': rows['author'].to_numpy(),
+        'counterparty': found['user'].to_numpy(),
+        'loan_id': pd.to_numeric(found['loan_id'], errors='coerce').astype('Int64').to_numpy(),
+        'amount': amount.to_numpy(),
+        'amount_minor': (amount * 100).round().astype('Int64').to_numpy(),
+        'currency': currency.to_numpy(),
+        'created_utc': rows['created_utc'].to_numpy()
+    })
+    return out[np.asarray(valid)].reset_index(drop=True)
+
+
+def create_tables(db):
+    db.conn.execute(SQL_CREATE)
+    db.conn.execute(SQL_CREATE_INDEX)
+
+
+def store_commands(db, comments) -> int:
+    """
+    Replace the loan_commands rows of these comments with freshly extracted ones. Nothing is committed outside
+    a bulk load's own transactions, so the commands land with the comments they came from.
+
+    :return: Number of commands stored
+    """
+    if len(comments) == 0:
+        return 0
+    commands = extract_commands(comments)
+    db.conn.executemany("DELETE FROM loan_commands WHERE comment_id = ?;", [(cid,) for cid in comments['id']])
+    return db.bulk_upsert('loan_commands', commands, key=('comment_id', 'position'))
+
+
+def remove_commands(db, comment_ids) -> int:
+    """
+    Drop the loan_commands rows of these comments, e.g. once their staging rows are deleted. Nothing is committed
+    here.
+
+    :return: Number of commands removed
+    """
+    return db.conn.executemany("DELETE FROM loan_commands WHERE comment_id = ?;",
+                               [(cid,) for cid in comment_ids]).rowcount
+
+
+def extract_stored(db, chunk_rows=200000) -> tuple[int, int]:
+    """
+    Rebuild loan_commands from every comment already in staging_comments_raw.
+
+    :return: Tuple(# comments scanned, # commands stored)
+    """
+    started = time.monotonic()
+    create_tables(db)
+    scanned = 0
+    stored = 0
+    with db.bulk_load('loan_commands'):
+        for comments in db.iter_df("SELECT id, link_id, author, body, created_utc FROM staging_comments_raw;",
+                                   chunk_rows=chunk_rows):
+            stored += store_commands(db, comments)
+            scanned += len(comments)
+            logging.debug("Scanned %d comments for commands.", scanned)
+    logging.info("Extracted %d loan commands from %d comments in %.1fs.", stored, scanned,
+                 time.monotonic() - started)
+    return scanned, stored
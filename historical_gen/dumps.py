@@ -0,0 +1,168 @@
+import datetime
+import json
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from historical_gen.columnar import CSV, write_staging
+from historical_gen.ingest import IngestSubmissions, IngestComments
+
+try:
+    import zstandard
+except ImportError:  # Only needed when reading dumps
+    zstandard = None
+
+
+class RedditDumpReader:
+    """
+    Streams one monthly Reddit dump (RS_YYYY-MM.zst submissions / RC_YYYY-MM.zst comments: zstd-compressed
+    NDJSON) from disk in constant memory, yielding only r/borrow objects.
+
+    Each line is checked for the raw bytes of '"subreddit":"borrow"' before any JSON parsing, which skips almost
+    every line of a multi-GB month without decoding it. Comments are further narrowed to bodies mentioning "loan",
+    matching the q='loan' the Pushshift comment search used, or holding one of the other LoansBot commands.
+    """
+
+    COMMENT_NEEDLES = (b'loan', b'$paid', b'$confirm', b'$unpaid')
+    READ_SIZE = 2 ** 24
+
+    def __init__(self, path, subreddit='borrow'):
+        """
+        :param path: Path to an RS_*.zst or RC_*.zst file
+        :param subreddit: Subreddit to keep
+        """
+        if zstandard is None:
+            raise ImportError("Reading Reddit dumps requires the zstandard package.")
+        self.path = path
+        self.subreddit = subreddit
+        self.kind = dump_kind(path)
+        self.needles = (f'"subreddit":"{subreddit}"'.encode(), f'"subreddit": "{subreddit}"'.encode())
+        self.lines = 0
+        self.matched = 0
+
+    def _iter_lines(self):
+        with open(self.path, 'rb') as fh:
+            # The dumps are compressed with a long window
+            reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(fh)
+            pending = b''
+            while True:
+                chunk = reader.read(self.READ_SIZE)
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                yield from lines
+            if pending:
+                yield pending
+
+    def __iter__(self):
+        needles = self.needles
+        for line in self._iter_lines():
+            self.lines += 1
+            if not any(needle in line for needle in needles):
+                continue
+            if self.kind == 'comments':
+                lowered = line.lower()
+                if not any(needle in lowered for needle in self.COMMENT_NEEDLES):
+                    continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                logging.warning("Skipping malformed line %d in %s", self.lines, self.path)
+                continue
+            if obj.get('subreddit') != self.subreddit:
+                continue
+            self.matched += 1
+            yield obj
+
+
+def dump_kind(path) -> str:
+    name = os.path.basename(path)
+    if name.startswith('RS_'):
+        return 'submissions'
+    if name.startswith('RC_'):
+        return 'comments'
+    raise ValueError(f"Cannot tell whether {path} holds submissions (RS_) or comments (RC_)")
+
+
+def _normalize_comment(obj):
+    # Fields the Pushshift comment search returned that the dumps leave out
+    if not obj.get('permalink'):
+        link_id = str(obj.get('link_id', ''))
+        obj['permalink'] = f"/r/borrow/comments/{link_id[3:]}/_/{obj.get('id')}/"
+    return obj
+
+
+def _finish(obj):
+    created_utc = int(float(obj.get('created_utc') or 0))
+    obj['created_utc'] = created_utc
+    if not obj.get('utc_datetime_str'):
+        obj['utc_datetime_str'] = datetime.datetime.utcfromtimestamp(created_utc).strftime('%Y-%m-%d %H:%M:%S')
+    return obj
+
+
+def stage_dump_file(path, output_dir, batch_rows=50000, fmt=CSV):
+    """
+    Stream one dump file into staging files of at most batch_rows rows each, projected to the columns the
+    matching Ingest class loads.
+
+    :return: Tuple(path, # lines read, # rows staged, # files written)
+    """
+    reader = RedditDumpReader(path)
+    ingest_cls = IngestSubmissions if reader.kind == 'submissions' else IngestComments
+    cols = ingest_cls.COLUMNS
+    month = re.sub(r'\.zst$', '', os.path.basename(path))
+
+    batch = []
+    part = 0
+
+    def write_batch():
+        output_file = f"{reader.kind}_dump_{month}_{part:04d}"
+        output_file_full_path = os.path.join(output_dir, output_file)
+        logging.debug("Writing %d %s to file %s", len(batch), reader.kind, output_file_full_path)
+        write_staging(pd.DataFrame(batch, columns=cols), output_file_full_path, ingest_cls.SCHEMA, fmt)
+
+    for obj in reader:
+        if reader.kind == 'comments':
+            obj = _normalize_comment(obj)
+        obj = _finish(obj)
+        batch.append({col: obj.get(col) for col in cols})
+        if len(batch) >= batch_rows:
+            write_batch()
+            batch = []
+            part += 1
+    if batch:
+        write_batch()
+        part += 1
+
+    return path, reader.lines, reader.matched, part
+
+
+def stage_dumps(paths, submissions_dir, comments_dir, workers=None, batch_rows=50000, fmt=CSV):
+    """
+    Stage several monthly dump files in parallel, one process per file.
+
+    :param paths: RS_*.zst / RC_*.zst files
+    :param submissions_dir: Staging folder for submissions
+    :param comments_dir: Staging folder for comments
+    :param workers: Number of processes. Defaults to the number of cores.
+    :param batch_rows: Max rows per staged file
+    :param fmt: Staging file format, columnar.CSV or columnar.PARQUET
+    :return: Tuple(# rows staged, # files written)
+    """
+    staged = 0
+    files = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for path in sorted(paths):
+            output_dir = submissions_dir if dump_kind(path) == 'submissions' else comments_dir
+            futures.append(executor.submit(stage_dump_file, path, output_dir, batch_rows, fmt))
+        for future in as_completed(futures):
+            path, lines, matched, parts = future.result()
+            logging.info("Staged %d of %d lines from %s into %d files", matched, lines, path, parts)
+            staged += matched
+            files += parts
+    return staged, files
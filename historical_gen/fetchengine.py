@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import time
+
+import requests
+
+from historical_gen.ratelimit import TokenBucket
+
+
+class FetchStats:
+
+    def __init__(self, allowed_rate):
+        self.allowed_rate = allowed_rate
+        self.requests = 0
+        self.cached = 0
+        self.ok = 0
+        self.not_found = 0
+        self.throttled = 0
+        self.errors = 0
+        self.failed: list = []
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def achieved_rate(self) -> float:
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        return ("%d requests in %.1fs: %.2f req/s achieved of %.2f req/s allowed (%.0f%% of budget). "
+                "%d served from cache, %d ok, %d not found, %d throttled, %d errors, %d failed."
+                % (self.requests, self.elapsed, self.achieved_rate, self.allowed_rate,
+                   100 * self.achieved_rate / self.allowed_rate, self.cached, self.ok, self.not_found,
+                   self.throttled, self.errors, len(self.failed)))
+
+
+class AsyncLoanFetcher:
+    """
+    asyncio engine for /api/loans/{id}/detailed. Every request goes through one central token bucket, so the
+    budget holds no matter how many connections are open, and any failed call (429 or otherwise) pauses the
+    bucket for backoff_delay seconds, the same rule _req_call follows. Workers share the retriever's pooled
+    Transport, so each keeps a persistent connection busy and sends its next request as soon as the bucket allows.
+    """
+
+    def __init__(self, retriever, max_connections=1, rate=1.0, burst=1, max_retries=3, backoff_delay=62):
+        """
+        :param retriever: The LoansRetriever whose base url, headers, auth and parsing are used
+        :param max_connections: Number of workers, each with its own keep-alive connection
+        :param rate: Allowed requests per second across all connections
+        :param burst: Token bucket capacity
+        :param max_retries: Retries per loan id before giving up on it
+        :param backoff_delay: Seconds to pause every worker after a failed call. Must be at least 61.
+        """
+        assert max_connections >= 1
+        assert backoff_delay >= 61
+        if max_connections > retriever.transport.pool_maxsize:
+            logging.warning("max_connections=%d is more than the transport keeps alive per host (%d).",
+                            max_connections, retriever.transport.pool_maxsize)
+        self.retriever = retriever
+        self.max_connections = max_connections
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff_delay = backoff_delay
+        self.stats = FetchStats(rate)
+
+    def run(self, ids, on_loan) -> FetchStats:
+        """
+        Fetch every id in ids.
+
+        :param ids: Loan ids to fetch
+        :param on_loan: Called as on_loan(loan_id, status, response_json) on the event loop thread once per id.
+        status is 200 or 404, or None for ids that exhausted their retries or whose response could not be
+        handled (also listed in stats.failed).
+        :return: FetchStats for the run
+        """
+        asyncio.run(self._run(ids, on_loan))
+        return self.stats
+
+    async def _run(self, ids, on_loan):
+        queue = asyncio.Queue()
+        for elm in ids:
+            queue.put_nowait((elm, 0))
+
+        self.stats.started = time.monotonic()
+        workers = [asyncio.create_task(self._worker(queue, on_loan)) for _ in range(self.max_connections)]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self.stats.finished = time.monotonic()
+
+    async def _worker(self, queue, on_loan):
+        while True:
+            elm, attempt = await queue.get()
+            try:
+                await self._fetch_one(queue, elm, attempt, on_loan)
+            except Exception as e:  # Not CancelledError: a dead worker would leave queue.join() waiting forever
+                logging.exception("Error handling loan id %s: %s", elm, str(e))
+                self.stats.errors += 1
+                self.stats.failed.append(elm)
+                try:
+                    on_loan(elm, None, None)
+                except Exception as e:
+                    logging.error("Could not record loan id %s as failed: %s", elm, str(e))
+            finally:
+                queue.task_done()
+
+    async def _fetch_one(self, queue, elm, attempt, on_loan):
+        url = self.retriever.BASE_URL + f'/api/loans/{elm}/detailed'
+        cache = self.retriever.cache
+        if cache is not None:
+            # Fresh cache hits cost no token
+            cached = cache.lookup(url)
+            if cached is not None:
+                self.stats.cached += 1
+                on_loan(elm, cached.status_code, cached.json())
+                return
+            if cache.offline:
+                return  # Not cached; leave it for an online run
+
+        await self.bucket.acquire_async()
+        await asyncio.to_thread(self.retriever._refresh_auth)
+
+        self.stats.requests += 1
+        try:
+            r = await asyncio.to_thread(self.retriever._get, url, None)
+        except requests.RequestException as e:
+            logging.error("Error fetching loan id %s: %s", elm, str(e))
+            self.stats.errors += 1
+            r = None
+
+        if r is not None and r.status_code == 200:
+            self.stats.ok += 1
+            on_loan(elm, 200, r.json())
+            return
+        if r is not None and r.status_code == 404:
+            self.stats.not_found += 1
+            on_loan(elm, 404, None)
+            return
+
+        if r is not None:
+            if r.status_code == 429:
+                self.stats.throttled += 1
+            else:
+                self.stats.errors += 1
+            logging.info("Request for loan id %s failed with status code %d. Pausing all workers for %d seconds.",
+                         elm, r.status_code, self.backoff_delay)
+        self.bucket.pause(self.backoff_delay)
+
+        if attempt < self.max_retries:
+            queue.put_nowait((elm, attempt + 1))
+        else:
+            logging.error("Max retries exceeded for loan id %s.", elm)
+            self.stats.failed.append(elm)
+            on_loan(elm, None, None)
+
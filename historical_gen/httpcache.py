@@ -0,0 +1,276 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+SECONDS_PER_HOUR = 60 * 60
+
+
+class CachedResponse:
+    """
+    The parts of requests.Response the retrievers use, rebuilt from the cache.
+    """
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.from_cache = True
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"{self.status_code} Error for url: {self.url}")
+
+
+class CachePolicy:
+
+    def __init__(self, pattern, ttl):
+        """
+        :param pattern: Regex searched against the request url
+        :param ttl: Seconds a stored response stays fresh, None to never expire, or a callable taking the decoded
+        json body and the request's query params and returning either of those
+        """
+        self.pattern = re.compile(pattern)
+        self.ttl = ttl
+
+    def ttl_for(self, content, params=None):
+        if not callable(self.ttl):
+            return self.ttl
+        try:
+            return self.ttl(json.loads(content), params or {})
+        except ValueError:
+            return 0
+
+
+def default_policies(open_loan_ttl_hours=6, window_settle_hours=48):
+    """
+    Loans that are repaid, unpaid or deleted almost never change, so their /detailed responses never expire.
+    Open loans, loan listings and thread lookups go stale quickly. A Pushshift window is only kept once it ended
+    window_settle_hours ago; the window sync is still filling, and any other recent one, is always fetched again,
+    as posts keep arriving in it.
+    """
+    def detailed_ttl(body, params):
+        basic = body.get('basic', {})
+        closed = any(basic.get(k) is not None for k in ('repaid_at', 'unpaid_at', 'deleted_at'))
+        return None if closed else open_loan_ttl_hours * SECONDS_PER_HOUR
+
+    def window_ttl(body, params):
+        until = params.get('until', params.get('before'))
+        try:
+            ended = time.time() - float(until)
+        except (TypeError, ValueError):
+            return 0
+        return 30 * 24 * SECONDS_PER_HOUR if ended > window_settle_hours * SECONDS_PER_HOUR else 0
+
+    return [
+        CachePolicy(r'/api/loans/\d+/detailed$', detailed_ttl),
+        CachePolicy(r'/api/loans/threads$', 24 * SECONDS_PER_HOUR),
+        CachePolicy(r'/api/loans$', SECONDS_PER_HOUR),
+        CachePolicy(r'/reddit/search/', window_ttl),
+    ]
+
+
+class ResponseCache:
+    """
+    On-disk cache of GET responses keyed by a hash of url + params. Bodies live in a two-level folder tree under
+    root; an sqlite index beside them tracks size, validators, expiry and last access for LRU eviction.
+
+    Stale entries with an ETag/Last-Modified are revalidated with a conditional request, and a 304 just extends
+    them. In offline mode nothing is sent: any stored response is served, stale or not, and a miss returns None.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, policies=None, offline=False, default_ttl=0):
+        """
+        :param root: Folder for the index and bodies
+        :param max_bytes: Least recently used bodies are evicted past this total size
+        :param policies: List of CachePolicy; the first whose pattern matches the url wins
+        :param offline: Never touch the network
+        :param default_ttl: TTL for urls no policy matches. 0 stores the response but always revalidates.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policies = policies if policies is not None else default_policies()
+        self.offline = offline
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                params TEXT,
+                status INTEGER,
+                headers TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                stored_utc REAL,
+                expires_utc REAL,
+                accessed_utc REAL
+            );
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_utc);")
+        c = self.conn.execute("SELECT COALESCE(SUM(size), 0) AS total FROM entries;")
+        self.total_bytes = c.fetchone()['total']
+
+    @staticmethod
+    def key_for(url, params) -> str:
+        canonical = json.dumps([url, sorted((str(k), str(v)) for k, v in (params or {}).items())])
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _body_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _policy_ttl(self, url, params, content):
+        for policy in self.policies:
+            if policy.pattern.search(url):
+                return policy.ttl_for(content, params)
+        return self.default_ttl
+
+    def _load(self, key, row):
+        try:
+            with open(self._body_path(key), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE entries SET accessed_utc = ? WHERE key = ?;", (time.time(), key))
+        return CachedResponse(row['status'], json.loads(row['headers']), content, row['url'])
+
+    def _entry(self, key):
+        with self._lock:
+            return self.conn.execute("SELECT * FROM entries WHERE key = ?;", (key,)).fetchone()
+
+    @staticmethod
+    def _is_fresh(row):
+        return row['expires_utc'] is None or row['expires_utc'] > time.time()
+
+    def lookup(self, url, params=None):
+        """
+        :return: The stored response if it is fresh (or if offline), without touching the network; else None
+        """
+        key = self.key_for(url, params)
+        row = self._entry(key)
+        if row is None or not (self.offline or self._is_fresh(row)):
+            return None
+        response = self._load(key, row)
+        if response is not None:
+            self.hits += 1
+        return response
+
+    def fetch(self, url, params, send):
+        """
+        Serve url from the cache when fresh, otherwise call send and store what comes back.
+
+        :param url: Full request url
+        :param params: Query params
+        :param send: Callable taking a dict of extra (conditional) headers and returning a requests.Response
+        :return: A response, or None if offline and nothing is stored
+        """
+        key = self.key_for(url, params)
+        row = self._entry(key)
+        if row is not None and (self.offline or self._is_fresh(row)):
+            response = self._load(key, row)
+            if response is not None:
+                self.hits += 1
+                return response
+        if self.offline:
+            logging.info("Offline and no cached response for %s with params %s.", url, params)
+            self.misses += 1
+            return None
+
+        conditional = {}
+        if row is not None:
+            if row['etag']:
+                conditional['If-None-Match'] = row['etag']
+            if row['last_modified']:
+                conditional['If-Modified-Since'] = row['last_modified']
+
+        r = send(conditional)
+        if r is not None and r.status_code == 304 and row is not None:
+            cached = self._load(key, row)
+            if cached is not None:
+                self.revalidated += 1
+                self._touch(key, url, params, cached.content)
+                return cached
+            r = send({})  # Body went missing underneath us, fetch it whole
+
+        self.misses += 1
+        if r is not None and r.status_code == 200:
+            self._store(key, url, params, r)
+        return r
+
+    def _touch(self, key, url, params, content):
+        ttl = self._policy_ttl(url, params, content)
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE entries SET stored_utc = ?, expires_utc = ?, accessed_utc = ? WHERE key = ?;",
+                              (now, None if ttl is None else now + ttl, now, key))
+
+    def _store(self, key, url, params, r):
+        content = r.content
+        ttl = self._policy_ttl(url, params, content)
+        now = time.time()
+
+        path = self._body_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        headers = {k: v for k, v in r.headers.items() if k.lower() in ('content-type', 'etag', 'last-modified')}
+        with self._lock, self.conn:
+            old = self.conn.execute("SELECT size FROM entries WHERE key = ?;", (key,)).fetchone()
+            self.total_bytes += len(content) - (old['size'] if old is not None else 0)
+            self.conn.execute("INSERT OR REPLACE INTO entries (key, url, params, status, headers, etag, last_modified, "
+                              "size, stored_utc, expires_utc, accessed_utc) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                              (key, url, json.dumps(params or {}, sort_keys=True, default=str), r.status_code,
+                               json.dumps(headers), r.headers.get('ETag'), r.headers.get('Last-Modified'),
+                               len(content), now, None if ttl is None else now + ttl, now))
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            evicted = []
+            for row in self.conn.execute("SELECT key, size FROM entries ORDER BY accessed_utc ASC;"):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted.append(row['key'])
+                self.total_bytes -= row['size']
+            with self.conn:
+                self.conn.executemany("DELETE FROM entries WHERE key = ?;", [(key,) for key in evicted])
+        for key in evicted:
+            try:
+                os.remove(self._body_path(key))
+            except FileNotFoundError:
+                pass
+        logging.debug("Evicted %d responses from the cache.", len(evicted))
+
+    def report(self) -> str:
+        return "cache: %d hits, %d misses, %d revalidated" % (self.hits, self.misses, self.revalidated)
+
+    def close(self):
+        self.conn.close()
@@ -1,28 +1,188 @@
 import logging
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-import numpy as np
 from abc import ABC, abstractmethod
 
+from historical_gen import commands, search
+from historical_gen.columnar import StagingSchema, iter_staging, read_staging, staging_files
+from historical_gen.manifest import IngestManifest, file_sha256
+
 
 class Ingest(ABC):
 
-    def __init__(self, folder, db):
+    KEY = 'id'  # Column the manifest tracks rows by
+    UPSERT_KEY = None  # Primary key columns of the table, when not just KEY
+    CHUNK_ROWS = None  # Read files this many rows at a time, in this process, instead of whole in the pool
+    REPLACE_GROUPS = False  # KEY is not unique: a changed file replaces every row of each KEY it held
+
+    def __init__(self, folder, db, workers=None):
+        """
+        :param folder: Staging folder
+        :param db: LoansDB
+        :param workers: Processes parsing new files. Defaults to the number of cores; 1 parses in this process.
+        """
         self.db = db
         self.folder = folder
+        self.workers = workers or os.cpu_count()
 
     @abstractmethod
     def ingest(self):
         pass
 
+    @classmethod
+    def create_tables(cls, db):
+        db.execute_query(cls.SQL_CREATE)
+
+    @classmethod
+    def parse(cls, file) -> pd.DataFrame:
+        """
+        Read one staged file into the rows to load. Runs in a worker process.
+        """
+        return cls.prepare(read_staging(file, cls.COLUMNS))
+
+    @classmethod
+    def parse_chunks(cls, file):
+        """
+        :return: Iterator of the DataFrames to load from file, CHUNK_ROWS rows at a time
+        """
+        for df in iter_staging(file, cls.COLUMNS, cls.CHUNK_ROWS):
+            yield cls.prepare(df)
+
+    @classmethod
+    def after_load(cls, db, df):
+        """
+        Derive further tables from rows just upserted, in the same transaction.
+        """
+        pass
+
+    @classmethod
+    def after_delete(cls, db, keys):
+        """
+        Delete what after_load derived from the rows of these KEY values, just deleted, in the same transaction.
+        """
+        pass
+
+    def _ingest_folder(self, table):
+        """
+        Load the files under folder that the manifest has not seen, or has seen with different content. Files are
+        parsed by a process pool and written here, one file at a time in path order, so later files win as before.
+        staging_files() lists compacted month files before the window files at the top of the folder, which hold the
+        rows fetched since, so a re-fetched window wins over the month file it overlaps.
+        """
+        manifest = IngestManifest(self.db)
+        paths = staging_files(self.folder)
+        manifest.forget_missing(table, self.folder, paths)
+
+        todo = []
+        for path in paths:
+            stat = os.stat(path)
+            if not manifest.unchanged(path, stat.st_size, stat.st_mtime):
+                todo.append((path, stat.st_size, stat.st_mtime))
+        logging.info("%d of %d staged files in %s are new or changed.", len(todo), len(paths), self.folder)
+
+        with self.db.bulk_load(table):
+            if self.CHUNK_ROWS:
+                parsed = ((file_sha256(path), self.parse_chunks(path)) for path, _, _ in todo)
+            else:
+                parsed = ((sha256, [df]) for sha256, df in
+                          _parse_files(type(self), [path for path, _, _ in todo], self.workers))
+            for (path, size, mtime), (sha256, chunks) in zip(todo, parsed):
+                if manifest.same_content(path, sha256):
+                    manifest.touch(path, size, mtime)
+                    continue
+                logging.info("Ingesting %s", path)
+                if self.REPLACE_GROUPS:
+                    # Drop what the file alone produced before, so rows missing from the new content go too
+                    manifest.replace(table, self.KEY, path, size, mtime, sha256, [], self.after_delete)
+                keys = {}
+                for df in chunks:
+                    keys.update(dict.fromkeys(df[self.KEY].dropna().tolist()))
+                    self.db.bulk_upsert(table, df, key=self.UPSERT_KEY or (self.KEY,))
+                    self.after_load(self.db, df)
+                manifest.replace(table, self.KEY, path, size, mtime, sha256, list(keys), self.after_delete)
+
+
+def _parse_file(ingest_cls, path):
+    return file_sha256(path), ingest_cls.parse(path)
+
+
+def _parse_files(ingest_cls, paths, workers):
+    """
+    :return: Generator of (sha256, DataFrame) per path, in order. At most two files per worker are held parsed
+    ahead of the writer.
+    """
+    if workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield _parse_file(ingest_cls, path)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(_parse_file, ingest_cls, path))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 
 class IngestSubmissions(Ingest):
 
-    def __init__(self, folder, db):
-        super().__init__(folder, db)
+    COLUMNS = [
+        "selftext",
+        "author_fullname",
+        "title",
+        "hidden",
+        "author_flair_background_color",
+        "is_original_content",
+        "is_reddit_media_domain",
+        "is_meta",
+        "link_flair_text",
+        "score",
+        "author_premium",
+        "upvote_ratio",
+        "total_awards_received",
+        "edited",
+        "is_self",
+        "removed_by_category",
+        "author_flair_type",
+        "domain",
+        "archived",
+        "no_follow",
+        "is_crosspostable",
+        "pinned",
+        "over_18",
+        "media_only",
+        "can_gild",
+        "spoiler",
+        "locked",
+        "author_flair_text",
+        "removed_by",
+        "subreddit_id",
+        "id",
+        "is_robot_indexable",
+        "author",
+        "num_comments",
+        "send_replies",
+        "contest_mode",
+        "author_patreon_flair",
+        "author_flair_text_color",
+        "permalink",
+        "stickied",
+        "url",
+        "subreddit_subscribers",
+        "created_utc",
+        "num_crossposts",
+        "is_video",
+        "retrieved_utc",
+        "updated_utc",
+        "utc_datetime_str"
+    ]
 
-    def ingest(self):
-        sql_create_staging_submissions_raw = """ 
+    SQL_CREATE = """ 
         CREATE TABLE IF NOT EXISTS staging_submissions_raw (
             selftext TEXT,
             author_fullname TEXT,
@@ -74,81 +234,53 @@ class IngestSubmissions(Ingest):
             utc_datetime_str TEXT 
         ); 
         """
-        self.db.execute_query(sql_create_staging_submissions_raw)
-        for filename in os.scandir(self.folder):
-            if filename.is_file():
-                self._ingest_file(filename.path)
-
-    def _ingest_file(self, file):
-        logging.info("Ingesting %s", file)
-        df = pd.read_csv(file, escapechar='\\')
-
-        cols = [
-            "selftext",
-            "author_fullname",
-            "title",
-            "hidden",
-            "author_flair_background_color",
-            "is_original_content",
-            "is_reddit_media_domain",
-            "is_meta",
-            "link_flair_text",
-            "score",
-            "author_premium",
-            "upvote_ratio",
-            "total_awards_received",
-            "edited",
-            "is_self",
-            "removed_by_category",
-            "author_flair_type",
-            "domain",
-            "archived",
-            "no_follow",
-            "is_crosspostable",
-            "pinned",
-            "over_18",
-            "media_only",
-            "can_gild",
-            "spoiler",
-            "locked",
-            "author_flair_text",
-            "removed_by",
-            "subreddit_id",
-            "id",
-            "is_robot_indexable",
-            "author",
-            "num_comments",
-            "send_replies",
-            "contest_mode",
-            "author_patreon_flair",
-            "author_flair_text_color",
-            "permalink",
-            "stickied",
-            "url",
-            "subreddit_subscribers",
-            "created_utc",
-            "num_crossposts",
-            "is_video",
-            "retrieved_utc",
-            "updated_utc",
-            "utc_datetime_str"
-        ]
-
-        for col in cols:
-            if col not in df.columns:
-                df[col] = np.nan
-        df = df[cols]
-
-        df.to_sql('staging_submissions_raw', self.db.conn, if_exists='append', index=False)
+
+    SCHEMA = StagingSchema(SQL_CREATE)
+
+    def __init__(self, folder, db, workers=None):
+        super().__init__(folder, db, workers)
+
+    def ingest(self):
+        self.create_tables(self.db)
+        self._ingest_folder('staging_submissions_raw')
+
+    @classmethod
+    def prepare(cls, df):
+        """
+        :return: The rows of df to load, with exactly the table's columns
+        """
+        return df.reindex(columns=cls.COLUMNS)
+
+    @classmethod
+    def after_load(cls, db, df):
+        search.index_posts(db, search.SUBMISSION, df)
+
+    @classmethod
+    def after_delete(cls, db, keys):
+        search.remove_posts(db, search.SUBMISSION, keys)
 
 
 class IngestComments(Ingest):
 
-    def __init__(self, folder, db):
-        super().__init__(folder, db)
+    COLUMNS = [
+        "id",
+        "permalink",
+        "link_id",
+        "locked",
+        "author",
+        "author_fullname",
+        "body",
+        "loan_id",
+        "created_utc",
+        "retrieved_utc",
+        "updated_utc",
+        "utc_datetime_str",
+        "nest_level",
+        "is_submitter",
+        "parent_id"
+    ]
 
-    def ingest(self):
-        sql_create_staging_submissions_raw = """ 
+    SQL_CREATE = """ 
         CREATE TABLE IF NOT EXISTS staging_comments_raw (
             id TEXT PRIMARY KEY,
             permalink TEXT,
@@ -167,60 +299,194 @@ class IngestComments(Ingest):
             parent_id INTEGER
         ); 
         """
-        self.db.execute_query(sql_create_staging_submissions_raw)
-        for filename in os.scandir(self.folder):
-            if filename.is_file():
-                self._ingest_file(filename.path)
-
-    def _ingest_file(self, file):
-        logging.info("Ingesting %s", file)
-        df = pd.read_csv(file, escapechar='\\')
-
-        cols = [
-            "id",
-            "permalink",
-            "link_id",
-            "locked",
-            "author",
-            "author_fullname",
-            "body",
-            "loan_id",
-            "created_utc",
-            "retrieved_utc",
-            "updated_utc",
-            "utc_datetime_str",
-            "nest_level",
-            "is_submitter",
-            "parent_id"
-        ]
-
-        for col in cols:
-            if col not in df.columns:
-                df[col] = np.nan
-
-        df = df[cols]
-        df = df[df['body'].str.contains("$loan", regex=False)]
-
-        df.to_sql('staging_comments_raw', self.db.conn, if_exists='append', index=False)
+
+    # parent_id holds fullnames like t1_abc123 despite its declared type
+    SCHEMA = StagingSchema(SQL_CREATE, overrides={'parent_id': 'TEXT'})
+
+    def __init__(self, folder, db, workers=None):
+        super().__init__(folder, db, workers)
+
+    def ingest(self):
+        self.create_tables(self.db)
+        self._ingest_folder('staging_comments_raw')
+
+    @classmethod
+    def prepare(cls, df):
+        """
+        :return: The rows of df to load, with exactly the table's columns
+        """
+        df = df.reindex(columns=cls.COLUMNS)
+        return df[df['body'].str.contains(commands.COMMAND_FILTER, na=False)]
+
+    @classmethod
+    def create_tables(cls, db):
+        super().create_tables(db)
+        commands.create_tables(db)
+
+    @classmethod
+    def after_load(cls, db, df):
+        commands.store_commands(db, df)
+        search.index_posts(db, search.COMMENT, df)
+
+    @classmethod
+    def after_delete(cls, db, keys):
+        commands.remove_commands(db, keys)
+        search.remove_posts(db, search.COMMENT, keys)
 
 
 class IngestLoanIDs(Ingest):
 
-    def __init__(self, folder, db):
-        super().__init__(folder, db)
+    def __init__(self, folder, db, workers=None):
+        super().__init__(folder, db, workers)
 
-    def ingest(self):
-        sql_create_staging_submissions_raw = """ 
+    SQL_CREATE = """ 
         CREATE TABLE IF NOT EXISTS staging_loan_ids (
             id INTEGER PRIMARY KEY
         ); 
         """
-        self.db.execute_query(sql_create_staging_submissions_raw)
-        for filename in os.scandir(self.folder):
-            if filename.is_file():
-                self._ingest_file(filename.path)
 
-    def _ingest_file(self, file):
-        logging.info("Ingesting %s", file)
-        df = pd.read_csv(file, escapechar='\\')
-        df.to_sql('staging_loan_ids', self.db.conn, if_exists='append', index=False)
+    def ingest(self):
+        self.create_tables(self.db)
+        self._ingest_folder('staging_loan_ids')
+
+    @classmethod
+    def parse(cls, file) -> pd.DataFrame:
+        return pd.read_csv(file, escapechar='\\')
+
+
+class IngestLoanBasic(Ingest):
+    """
+    Loads the loan_basic_*.csv files of LoansRetriever.fetch_loans_by_id_list, one row per loan.
+    """
+
+    KEY = 'loan_id'
+    CHUNK_ROWS = 50000
+
+    COLUMNS = [
+        "loan_id",
+        "lender",
+        "borrower",
+        "currency_code",
+        "currency_symbol",
+        "currency_symbol_on_left",
+        "currency_exponent",
+        "principal_minor",
+        "principal_repayment_minor",
+        "created_at",
+        "last_repaid_at",
+        "repaid_at",
+        "unpaid_at",
+        "deleted_at"
+    ]
+
+    SQL_CREATE = """
+        CREATE TABLE IF NOT EXISTS staging_loan_basic_raw (
+            loan_id INTEGER PRIMARY KEY,
+            lender TEXT,
+            borrower TEXT,
+            currency_code TEXT,
+            currency_symbol TEXT,
+            currency_symbol_on_left INTEGER,
+            currency_exponent INTEGER,
+            principal_minor INTEGER,
+            principal_repayment_minor INTEGER,
+            created_at REAL,
+            last_repaid_at REAL,
+            repaid_at REAL,
+            unpaid_at REAL,
+            deleted_at REAL
+        );
+        """
+
+    SCHEMA = StagingSchema(SQL_CREATE)
+
+    def __init__(self, folder, db, workers=None):
+        super().__init__(folder, db, workers)
+
+    def ingest(self):
+        self.create_tables(self.db)
+        self._ingest_folder('staging_loan_basic_raw')
+
+    @classmethod
+    def prepare(cls, df):
+        """
+        :return: df cast to the table's types: amounts as integer minor units, timestamps as REAL epoch seconds
+        """
+        return cls.SCHEMA.conform(df)
+
+
+class IngestLoanEvents(Ingest):
+    """
+    Loads the loan_events_*.csv files of LoansRetriever.fetch_loans_by_id_list, one row per loan event. A file
+    holds every event of its loans, so the manifest tracks it by loan_id, and when it changes the events of its
+    loans are replaced as a whole.
+    """
+
+    KEY = 'loan_id'
+    UPSERT_KEY = ('loan_id', 'event_type', 'occurred_at')
+    CHUNK_ROWS = 100000
+    REPLACE_GROUPS = True
+
+    COLUMNS = [
+        "loan_id",
+        "event_type",
+        "occurred_at",
+        "creation_type",
+        "creation_permalink",
+        "repayment_minor",
+        "unpaid",
+        "old_principal_minor",
+        "new_principal_minor",
+        "old_principal_repayment_minor",
+        "new_principal_repayment_minor",
+        "old_created_at",
+        "new_created_at",
+        "old_repaid_at",
+        "new_repaid_at",
+        "old_unpaid_at",
+        "new_unpaid_at",
+        "old_deleted_at",
+        "new_deleted_at"
+    ]
+
+    SQL_CREATE = """
+        CREATE TABLE IF NOT EXISTS staging_loan_events_raw (
+            loan_id INTEGER,
+            event_type TEXT,
+            occurred_at REAL,
+            creation_type INTEGER,
+            creation_permalink TEXT,
+            repayment_minor INTEGER,
+            unpaid INTEGER,
+            old_principal_minor INTEGER,
+            new_principal_minor INTEGER,
+            old_principal_repayment_minor INTEGER,
+            new_principal_repayment_minor INTEGER,
+            old_created_at REAL,
+            new_created_at REAL,
+            old_repaid_at REAL,
+            new_repaid_at REAL,
+            old_unpaid_at REAL,
+            new_unpaid_at REAL,
+            old_deleted_at REAL,
+            new_deleted_at REAL,
+            PRIMARY KEY (loan_id, event_type, occurred_at)
+        );
+        """
+
+    SCHEMA = StagingSchema(SQL_CREATE)
+
+    def __init__(self, folder, db, workers=None):
+        super().__init__(folder, db, workers)
+
+    def ingest(self):
+        self.create_tables(self.db)
+        self._ingest_folder('staging_loan_events_raw')
+
+    @classmethod
+    def prepare(cls, df):
+        """
+        :return: df cast to the table's types, without rows missing part of the key
+        """
+        df = cls.SCHEMA.conform(df)
+        return df.dropna(subset=list(cls.UPSERT_KEY))
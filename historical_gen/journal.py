@@ -0,0 +1,137 @@
+import logging
+import os
+import time
+
+import pandas as pd
+
+
+class LoanFetchJournal:
+    """
+    Durable per-loan progress for detail backfills, kept in the same db as staging_loan_ids. Every loan id is
+    pending until its outcome is known; ids only become fetched once their rows are on disk, so a restarted run
+    resumes from pending() + retry_queue() without refetching anything.
+
+    Fetched loans also keep their created_at and whether they were still open (not repaid, unpaid or deleted),
+    which lets the incremental sync re-poll recent open loans.
+    """
+
+    PENDING = 'pending'
+    FETCHED = 'fetched'
+    FAILED = 'failed'
+    NOT_FOUND = '404'
+
+    def __init__(self, db, max_attempts=3):
+        """
+        :param db: LoansDB
+        :param max_attempts: Failed ids stay in the retry queue until they have failed this many times
+        """
+        self.db = db
+        self.max_attempts = max_attempts
+        sql_create_loan_fetch_journal = """
+        CREATE TABLE IF NOT EXISTS loan_fetch_journal (
+            id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_utc REAL,
+            created_at REAL,
+            is_open INTEGER
+        );
+        """
+        with self.db.conn:
+            self.db.conn.execute(sql_create_loan_fetch_journal)
+            # Journals created before created_at/is_open existed
+            existing = {row['name'] for row in self.db.conn.execute("PRAGMA table_info(loan_fetch_journal);")}
+            for col, col_type in [('created_at', 'REAL'), ('is_open', 'INTEGER')]:
+                if col not in existing:
+                    self.db.conn.execute(f"ALTER TABLE loan_fetch_journal ADD COLUMN {col} {col_type};")
+            self.db.conn.execute("CREATE INDEX IF NOT EXISTS loan_fetch_journal_state ON loan_fetch_journal (state);")
+
+    def seed(self, ids):
+        """
+        Add ids as pending. Ids already in the journal keep their state.
+        """
+        with self.db.conn:
+            self.db.conn.executemany("INSERT OR IGNORE INTO loan_fetch_journal (id, state, updated_utc) "
+                                     "VALUES (?, ?, ?);",
+                                     [(int(elm), self.PENDING, time.time()) for elm in ids])
+
+    def seed_from_staging(self):
+        """
+        Add every id in staging_loan_ids that the journal has not seen yet.
+        """
+        with self.db.conn:
+            c = self.db.conn.execute("INSERT OR IGNORE INTO loan_fetch_journal (id, state, updated_utc) "
+                                     "SELECT id, ?, ? FROM staging_loan_ids;", (self.PENDING, time.time()))
+        logging.info("Seeded %d new loan ids into the fetch journal.", c.rowcount)
+
+    def adopt_staged(self, loan_basic_folder):
+        """
+        Mark ids that already have loan_basic files on disk as fetched, so a backfill started before the journal
+        existed is not repeated.
+        """
+        adopted = 0
+        for filename in os.scandir(loan_basic_folder):
+            if filename.is_file() and filename.name.endswith('.csv'):
+                df = pd.read_csv(filename.path, escapechar='\\')
+                df = df.astype(object).where(df.notna(), None)
+                basic_rows = df.to_dict('records')
+                self.seed([row['loan_id'] for row in basic_rows])
+                self.mark_fetched(basic_rows)
+                adopted += len(basic_rows)
+        logging.info("Adopted %d already staged loan ids into the fetch journal.", adopted)
+
+    def pending(self) -> list[int]:
+        c = self.db.conn.execute("SELECT id FROM loan_fetch_journal WHERE state = ? ORDER BY id ASC;",
+                                 (self.PENDING,))
+        return [row['id'] for row in c]
+
+    def retry_queue(self) -> list[int]:
+        c = self.db.conn.execute("SELECT id FROM loan_fetch_journal WHERE state = ? AND attempts < ? "
+                                 "ORDER BY id ASC;", (self.FAILED, self.max_attempts))
+        return [row['id'] for row in c]
+
+    def mark(self, ids, state, error=None):
+        """
+        Record the outcome for ids and commit immediately.
+        """
+        now = time.time()
+        if state == self.FAILED:
+            sql = ("UPDATE loan_fetch_journal SET state = ?, attempts = attempts + 1, last_error = ?, "
+                   "updated_utc = ? WHERE id = ?;")
+        else:
+            sql = "UPDATE loan_fetch_journal SET state = ?, last_error = ?, updated_utc = ? WHERE id = ?;"
+        with self.db.conn:
+            self.db.conn.executemany(sql, [(state, error, now, int(elm)) for elm in ids])
+
+    def mark_fetched(self, basic_rows):
+        """
+        Mark the loans in basic_rows (the 'basic' dicts from /detailed, with loan_id set) as fetched.
+        """
+        now = time.time()
+        params = []
+        for basic in basic_rows:
+            is_open = basic.get('repaid_at') is None and basic.get('unpaid_at') is None \
+                and basic.get('deleted_at') is None
+            params.append((self.FETCHED, now, basic.get('created_at'), int(is_open), int(basic['loan_id'])))
+        with self.db.conn:
+            self.db.conn.executemany("UPDATE loan_fetch_journal SET state = ?, last_error = NULL, updated_utc = ?, "
+                                     "created_at = ?, is_open = ? WHERE id = ?;", params)
+
+    def open_since(self, created_after) -> list[int]:
+        """
+        Fetched loans created after created_after (epoch seconds) that were still open when last fetched.
+        """
+        c = self.db.conn.execute("SELECT id FROM loan_fetch_journal WHERE state = ? AND is_open = 1 "
+                                 "AND created_at > ? ORDER BY id ASC;", (self.FETCHED, created_after))
+        return [row['id'] for row in c]
+
+    def requeue(self, ids):
+        """
+        Put fetched ids back to pending so the next fetch picks up any new events.
+        """
+        self.mark(ids, self.PENDING)
+
+    def counts(self) -> dict:
+        c = self.db.conn.execute("SELECT state, COUNT(*) AS n FROM loan_fetch_journal GROUP BY state;")
+        return {row['state']: row['n'] for row in c}
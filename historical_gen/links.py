@@ -0,0 +1,228 @@
+import json
+import logging
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+# Thread id and, when there is one, comment id of any Reddit permalink form: /r/borrow/comments/<thread>/<slug>/
+# <comment>/, www.reddit.com//r/borrow/comments/<thread>/comment/<comment>/, redd.it/<thread>, ...
+PERMALINK_PATTERN = re.compile(
+    r'(?:comments/|redd\.it/)(?P<thread>[a-z0-9]+)(?:/[^/?#\s]*/(?P<comment>[a-z0-9]+))?', re.IGNORECASE)
+
+LINK_SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS loan_links (
+        loan_id INTEGER PRIMARY KEY,
+        thread_id TEXT,
+        comment_id TEXT,
+        lender TEXT,
+        borrower TEXT
+    );
+    """
+LINK_SQL_CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS loan_links_thread ON loan_links (thread_id);",
+    "CREATE INDEX IF NOT EXISTS loan_links_comment ON loan_links (comment_id);"
+)
+LOOKUP_SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS thread_lookups (
+        url TEXT PRIMARY KEY,
+        loan_ids TEXT,
+        fetched_utc REAL
+    );
+    """
+
+LINK_COLUMNS = ['loan_id', 'thread_id', 'comment_id', 'lender', 'borrower']
+
+
+def normalize_permalink(url):
+    """
+    :return: url as the canonical https://www.reddit.com/r/borrow/comments/<thread>/comment/<comment>/ (or
+    .../comments/<thread>/ for a thread), which the LoansBot threads endpoint accepts. None if url holds no
+    thread id.
+    """
+    if not isinstance(url, str):
+        return None
+    m = PERMALINK_PATTERN.search(url)
+    if m is None:
+        return None
+    thread, comment = m.group('thread').lower(), m.group('comment')
+    if comment is None:
+        return f"https://www.reddit.com/r/borrow/comments/{thread}/"
+    return f"https://www.reddit.com/r/borrow/comments/{thread}/comment/{comment.lower()}/"
+
+
+def permalink_keys(urls) -> pd.DataFrame:
+    """
+    :param urls: Series of permalinks
+    :return: DataFrame of thread and comment ids, lowercase, null where a permalink has none
+    """
+    keys = urls.astype('string').str.extract(PERMALINK_PATTERN)
+    return pd.DataFrame({'thread': keys['thread'].str.lower(), 'comment': keys['comment'].str.lower()},
+                        index=urls.index)
+
+
+def _strip_prefix(ids):
+    return ids.astype('string').str.replace(r'^t\d_', '', regex=True).str.lower()
+
+
+def link_comments(comments, links) -> pd.Series:
+    """
+    Match comments to loans with hash joins on normalized ids, taking for each comment the first of:
+
+    1. the loan its own id created ($loan comment)
+    2. the loan its parent created (LoansBot's reply, the borrower's $confirm)
+    3. the loan in its thread whose lender or borrower wrote it, if exactly one
+    4. the only loan in its thread
+
+    :param comments: DataFrame with id, link_id, parent_id, author
+    :param links: DataFrame of LINK_COLUMNS
+    :return: Series of loan id per comment, aligned with comments; <NA> where none matched
+    """
+    comments = comments.reset_index(drop=True)
+    cid = _strip_prefix(comments['id'])
+    parent = _strip_prefix(comments['parent_id']).where(comments['parent_id'].astype('string').str.startswith('t1_'))
+    thread = _strip_prefix(comments['link_id'])
+    author = comments['author'].astype('string').str.lower()
+
+    by_comment = links.dropna(subset=['comment_id']).drop_duplicates('comment_id').set_index('comment_id')['loan_id']
+    loan = cid.map(by_comment)
+    loan = loan.fillna(parent.map(by_comment))
+
+    in_thread = links.dropna(subset=['thread_id'])
+    candidates = pd.DataFrame({'row': np.arange(len(comments)), 'thread_id': thread, 'author': author}).merge(
+        in_thread[['thread_id', 'loan_id', 'lender', 'borrower']], on='thread_id')
+    party = candidates[(candidates['author'] == candidates['lender'].astype('string').str.lower())
+                       | (candidates['author'] == candidates['borrower'].astype('string').str.lower())]
+    party = party.groupby('row')['loan_id'].agg(['first', 'size'])
+    loan = loan.fillna(party.loc[party['size'] == 1, 'first'].reindex(loan.index))
+    per_thread = in_thread.groupby('thread_id')['loan_id'].agg(['first', 'size'])
+    only = per_thread.loc[per_thread['size'] == 1, 'first']
+    loan = loan.fillna(thread.map(only))
+    return pd.to_numeric(loan, errors='coerce').astype('Int64')
+
+
+class ThreadLinker:
+    """
+    Fills staging_comments_raw.loan_id by linking comments to the loans made in their threads. Loans are keyed by
+    the normalized thread and comment ids of their creation permalinks in loan_links, so each run is a few hash
+    joins over ids rather than one /api/loans/threads call per comment. Only comments nothing local matches are
+    looked up remotely, with normalized urls, at most max_remote per run, and every answer is kept in
+    thread_lookups.
+    """
+
+    def __init__(self, db, retriever=None, max_remote=200, recheck_days=7):
+        """
+        :param db: LoansDB
+        :param retriever: LoansRetriever for the remote fallback; None to link locally only
+        :param max_remote: Max remote lookups per run
+        :param recheck_days: Ask again about a url the endpoint knew no loans for after this many days
+        """
+        self.db = db
+        self.retriever = retriever
+        self.max_remote = max_remote
+        self.recheck_days = recheck_days
+
+    def create_tables(self):
+        with self.db.conn:
+            self.db.conn.execute(LINK_SQL_CREATE)
+            for sql in LINK_SQL_CREATE_INDEXES:
+                self.db.conn.execute(sql)
+            self.db.conn.execute(LOOKUP_SQL_CREATE)
+
+    def index_loans(self, full=False) -> int:
+        """
+        Key the loans in staging whose creation permalink is not in loan_links yet.
+
+        :param full: Re-key every loan
+        :return: Number of loans keyed
+        """
+        if not self._exists('staging_loan_events_raw') or not self._exists('staging_loan_basic_raw'):
+            return 0
+        new = "" if full else "AND NOT EXISTS (SELECT 1 FROM loan_links k WHERE k.loan_id = e.loan_id)"
+        loans = self.db.query_df(
+            "SELECT e.loan_id, e.creation_permalink, b.lender, b.borrower FROM staging_loan_events_raw e "
+            "LEFT JOIN staging_loan_basic_raw b ON b.loan_id = e.loan_id "
+            f"WHERE e.event_type = 'creation' AND e.creation_permalink IS NOT NULL {new};")
+        if len(loans) == 0:
+            return 0
+        keys = permalink_keys(loans['creation_permalink'])
+        links = pd.DataFrame({'loan_id': loans['loan_id'], 'thread_id': keys['thread'], 'comment_id': keys['comment'],
+                              'lender': loans['lender'], 'borrower': loans['borrower']}, columns=LINK_COLUMNS)
+        with self.db.conn:
+            self.db.bulk_upsert('loan_links', links.drop_duplicates('loan_id', keep='last'), key=('loan_id',))
+        return len(links)
+
+    def run(self, full=False) -> dict:
+        """
+        :param full: Re-key every loan and re-link comments that already have a loan_id
+        :return: Dict of # comments linked locally, remotely, and left unlinked
+        """
+        started = time.monotonic()
+        self.create_tables()
+        keyed = self.index_loans(full)
+        if not self._exists('staging_comments_raw'):
+            return {'local': 0, 'remote': 0, 'unlinked': 0}
+        todo = "" if full else "WHERE loan_id IS NULL"
+        comments = self.db.query_df(
+            f"SELECT id, link_id, parent_id, author, permalink FROM staging_comments_raw {todo};")
+        links = self.db.query_df(f"SELECT {', '.join(LINK_COLUMNS)} FROM loan_links;")
+        loan = link_comments(comments, links)
+        local = int(loan.notna().sum())
+
+        unlinked = comments[loan.isna().to_numpy()]
+        remote = self._remote(unlinked)
+        loan = loan.fillna(comments['id'].map(remote).astype('Int64'))
+
+        linked = loan.notna().to_numpy()
+        self.db.executemany("UPDATE staging_comments_raw SET loan_id = ? WHERE id = ?;",
+                            zip(loan[linked].astype('int64').tolist(), comments.loc[linked, 'id'].tolist()))
+        summary = {'local': local, 'remote': int(linked.sum()) - local, 'unlinked': int((~linked).sum())}
+        logging.info("Keyed %d loans and linked comments to loans in %.1fs: %s", keyed, time.monotonic() - started,
+                     summary)
+        return summary
+
+    def _remote(self, comments) -> dict:
+        """
+        :return: Dict of comment id -> loan id, for the comments the threads endpoint (or an earlier answer of it)
+        names exactly one loan for
+        """
+        if len(comments) == 0:
+            return {}
+        urls = pd.Series([normalize_permalink(p) for p in comments['permalink']], index=comments.index)
+        missing = urls.isna()
+        if missing.any():  # Build the permalink from the ids
+            built = ("/comments/" + _strip_prefix(comments['link_id']) + "/comment/"
+                     + _strip_prefix(comments['id']) + "/")
+            urls[missing] = [normalize_permalink(p) for p in built[missing]]
+        urls = urls.dropna()
+
+        known = {}
+        stale_before = time.time() - self.recheck_days * 86400
+        for row in self.db.iter_rows("SELECT url, loan_ids, fetched_utc FROM thread_lookups;"):
+            ids = json.loads(row[1])
+            if ids or row[2] >= stale_before:
+                known[row[0]] = ids
+
+        asked = 0
+        if self.retriever is not None:
+            for url in dict.fromkeys(url for url in urls if url not in known):
+                if asked >= self.max_remote:
+                    logging.info("Stopped after %d remote thread lookups; the rest wait for the next run.", asked)
+                    break
+                ids = self.retriever.fetch_thread_loans(url)
+                asked += 1
+                if ids is None:
+                    continue
+                known[url] = ids
+                with self.db.conn:
+                    self.db.conn.execute("INSERT INTO thread_lookups (url, loan_ids, fetched_utc) VALUES (?, ?, ?) "
+                                         "ON CONFLICT (url) DO UPDATE SET loan_ids = excluded.loan_ids, "
+                                         "fetched_utc = excluded.fetched_utc;", (url, json.dumps(ids), time.time()))
+        logging.debug("Made %d remote thread lookups for %d unlinked comments.", asked, len(comments))
+        return {comments.at[i, 'id']: known[url][0] for i, url in urls.items()
+                if url in known and len(known[url]) == 1}
+
+    def _exists(self, table) -> bool:
+        c = self.db.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table,))
+        return c.fetchone() is not None
@@ -1,19 +1,23 @@
 import datetime
 import os
 import sys
+import threading
 
 import requests
 import logging
 import time
 import pandas as pd
 
+from historical_gen.transport import default_transport
+
 
 class LoansRetriever:
 
     #  Da rules:
     #  https://github.com/LoansBot/web-backend/blob/master/API.md
 
-    def __init__(self, chunk_size, auth=None, timeout=120, delay_major=30, delay_minor=1.2):
+    def __init__(self, chunk_size, auth=None, timeout=120, delay_major=30, delay_minor=1.2,
+                 base_url='https://redditloans.com', cache=None, transport=None):
         """
         :param chunk_size: Size of each "batch" where applicable
         :param auth: A dict that provides the auth credentials for the API. If not supplied, then we will use the
@@ -21,6 +25,9 @@ class LoansRetriever:
         :param timeout: How long to wait for a response before timing out.
         :param delay_major: How long to delay between processing each "batch" for any given process
         :param delay_minor: How long to delay between processing each element. Enabled through use_delay_minor.
+        :param base_url: Root of the LoansBot API. Point this at a local stand-in server for testing.
+        :param cache: Optional ResponseCache. In offline mode no request (including login) is ever sent.
+        :param transport: Transport to send requests over. Defaults to the shared process-wide one.
         """
         assert chunk_size > 2  # Make sure that chunks will always have a first and last element
         self.chunk_size = chunk_size
@@ -30,15 +37,19 @@ class LoansRetriever:
 
         self.auth = auth
         self.auth_data = None
+        self._auth_lock = threading.Lock()
 
         self.headers = {
             "Content-Type": "application/json; charset=utf-8",
             "User-Agent": "RBorrowResearch / 0.1, "
                           "bot description: (+https://github.com/dan7x/rborrow_study/blob/master/LOANS_API.md)"
         }
-        self.BASE_URL = 'https://redditloans.com'
+        self.BASE_URL = base_url
+        self.cache = cache
+        self.transport = transport if transport is not None else default_transport()
 
-        self.authenticate(self.auth)
+        if self.cache is None or not self.cache.offline:
+            self.authenticate(self.auth)
 
     def fetch_loan_ids(self, start_date, end_date, output_dir, endpoint='/api/loans', historical=False):
         if historical:
@@ -49,15 +60,14 @@ class LoansRetriever:
             day_ls = pd.date_range(start_date, end_date, freq='D')
         loans_count = 0
 
-        session = requests.Session()
         for date, next_date in zip(day_ls, day_ls[1:]):
             params = {
                 'after_time': int(date.timestamp()),
                 'before_time': int(next_date.timestamp()),
                 'limit': 100000
             }
-            r = self._req_call(session, endpoint, params)
-            if r.status_code == 200:
+            r = self._req_call(endpoint, params)
+            if r is not None and r.status_code == 200:
                 list_of_ids = r.json()
 
                 if len(list_of_ids) > 0:
@@ -79,61 +89,169 @@ class LoansRetriever:
 
         return loans_count
 
-    def fetch_loans_by_id_list(self, ls, output_loan_basic_dir, output_loan_events_dir, use_delay_minor=False):
+    def fetch_loan_ids_between(self, after_time, before_time, output_dir, endpoint='/api/loans', limit=100000,
+                               window_days=365):
+        """
+        Fetch the ids of loans created in [after_time, before_time) and stage them, one call and file per window
+        of at most window_days. A window that comes back with limit ids may have been cut off, so it is split in
+        half and fetched again until every window is complete.
+
+        :param after_time: Epoch seconds
+        :param before_time: Epoch seconds
+        :param output_dir: Staging folder for loan ids
+        :param limit: Most ids the API returns per call
+        :param window_days: Length of the first windows
+        :return: List of loan ids, or None if a call failed or a window could not be listed in full
+        """
+        step = window_days * 24 * 60 * 60
+        edges = list(range(int(after_time), int(before_time), step)) + [int(before_time)]
+        windows = list(zip(edges, edges[1:]))[::-1]  # Stack, oldest window on top
+        list_of_ids = []
+        while windows:
+            after, before = windows.pop()
+            params = {
+                'after_time': after,
+                'before_time': before,
+                'limit': limit
+            }
+            r = self._req_call(endpoint, params)
+            if r is None or r.status_code != 200:
+                logging.error("Failed to fetch loan ids for %s to %s", after, before)
+                return None
+            if not getattr(r, 'from_cache', False):
+                time.sleep(self.delay_minor)
+            ids = r.json()
+            if len(ids) >= limit:
+                if before - after <= 1:
+                    logging.error("More than %d loans created at %s; cannot list them all.", limit, after)
+                    return None
+                middle = (after + before) // 2
+                logging.debug("%d loan ids for %s to %s hit the limit; splitting the window.", len(ids), after, before)
+                windows.extend([(middle, before), (after, middle)])
+                continue
+            if len(ids) > 0:
+                output_file = f"loan_ids_{after}_to_{before}.csv"
+                output_file_full_path = os.path.join(output_dir, output_file)
+                logging.debug("Writing %d loan ids to file %s", len(ids), output_file_full_path)
+                pd.DataFrame({'id': ids}).to_csv(output_file_full_path, escapechar='\\', index=False)
+            list_of_ids.extend(ids)
+        return list_of_ids
+
+    def fetch_thread_loans(self, url, endpoint='/api/loans/threads'):
+        """
+        Ask LoansBot which loans were made in a thread or comment.
+
+        :param url: Reddit permalink, normalized before sending
+        :return: List of loan ids, or None if url is not a permalink or the call failed
+        """
+        from historical_gen.links import normalize_permalink
+
+        normalized = normalize_permalink(url)
+        if normalized is None:
+            logging.warning("Not looking up %r: not a Reddit permalink.", url)
+            return None
+        r = self._req_call(endpoint, {'url': normalized})
+        if r is None or r.status_code != 200:
+            return None
+        if not getattr(r, 'from_cache', False):
+            time.sleep(self.delay_minor)
+        body = r.json()
+        if isinstance(body, dict):
+            body = body.get('loans', [])
+        return [int(loan['id'] if isinstance(loan, dict) else loan) for loan in body]
+
+    def fetch_loans_by_id_list(self, ls, output_loan_basic_dir, output_loan_events_dir, use_delay_minor=False,
+                               journal=None, flush_every=None):
         """
-        :param ls:
+        :param ls: Loan ids to fetch
         :param output_loan_basic_dir:
         :param output_loan_events_dir:
         :param use_delay_minor: If true, then self.delay_minor will be used between each call.
-        :return:
+        :param journal: Optional LoanFetchJournal. Each id's outcome is recorded as soon as it is durable, and ids
+        that keep failing are marked failed for a later retry instead of exiting.
+        :param flush_every: Write buffered results to disk every this many loans. Defaults to chunk_size.
+        :return: Tuple(# loans fetched, # loans requested)
         """
         if len(ls) == 0:
             return 0, 0
 
+        sink = _DetailSink(self, output_loan_basic_dir, output_loan_events_dir, journal,
+                           flush_every or self.chunk_size)
         ls_chunks = self._divide_chunks(ls, self.chunk_size)
         for chunk in ls_chunks:
-            session = requests.Session()
-
-            session_basic_res: list[dict] = []
-            session_events_res: list[dict] = []
             for elm in chunk:
                 endpoint = f'/api/loans/{elm}/detailed'
-                response = self._req_call(session, endpoint, dict(), max_retries=3)
+                response = self._req_call(endpoint, dict(), max_retries=3)
                 if response is not None and response.status_code == 200:
-                    response_json = response.json()
-                    assert 'basic' in response_json and 'events' in response_json
-                    # Append
-                    loan_basic = response_json['basic']
-                    loan_basic['loan_id'] = elm
-                    session_basic_res.append(loan_basic)
-
-                    loan_events = response_json['events']
-                    for event in loan_events:
-                        event = self._clean_event(event, elm)
-                        session_events_res.append(event)
+                    sink.add(elm, response.json())
+                elif response is not None and response.status_code == 404:
+                    sink.not_found(elm)
+                elif response is None and self.cache is not None and self.cache.offline:
+                    continue  # Not cached; leave it pending for an online run
+                elif journal is not None:
+                    sink.failed(elm, "status %s" % (response.status_code if response is not None else None))
                 else:
+                    logging.error("Error fetching loan id %s", elm)
+                    sink.flush()
                     sys.exit(1)
-                    logging.error("404 Error fetching loan id %s", elm)
-                if use_delay_minor:
+                if use_delay_minor and not getattr(response, 'from_cache', False):
                     logging.debug("Adding delay of %s seconds between id's to comply with API.", self.delay_minor)
                     time.sleep(self.delay_minor)
 
-            chunk_start = chunk[0]
-            chunk_end = chunk[-1]
+            sink.flush()
+            if self.cache is None or not self.cache.offline:
+                time.sleep(self.delay_major)
+        return sink.fetched, len(ls)
 
-            output_basic_file = f"loan_basic_{chunk_start}_to_{chunk_end}.csv"
-            output_events_file = f"loan_events_{chunk_start}_to_{chunk_end}.csv"
-            output_basic_file_full_path = os.path.join(output_loan_basic_dir, output_basic_file)
-            output_events_file_full_path = os.path.join(output_loan_events_dir, output_events_file)
+    def fetch_loans_by_id_list_async(self, ls, output_loan_basic_dir, output_loan_events_dir, max_connections=1,
+                                     rate=None, journal=None, flush_every=None):
+        """
+        Same output as fetch_loans_by_id_list, but requests are issued by an asyncio engine that keeps the
+        connection(s) busy up to the allowed budget instead of sleeping a fixed delay between chunks.
 
-            df_basic = pd.DataFrame(session_basic_res)
-            df_events = pd.DataFrame(session_events_res)
+        :param ls: Loan ids to fetch
+        :param output_loan_basic_dir:
+        :param output_loan_events_dir:
+        :param max_connections: Number of persistent connections to keep open. The API rules allow 1.
+        :param rate: Allowed requests per second across all connections. Defaults to 1 / delay_minor.
+        :param journal: Optional LoanFetchJournal, as in fetch_loans_by_id_list
+        :param flush_every: Write buffered results to disk every this many loans. Defaults to chunk_size.
+        :return: Tuple(# loans fetched, # loans requested) and the FetchStats of the run
+        """
+        from historical_gen.fetchengine import AsyncLoanFetcher
 
-            df_basic.to_csv(output_basic_file_full_path, escapechar='\\', index=False)
-            df_events.to_csv(output_events_file_full_path, escapechar='\\', index=False)
+        if len(ls) == 0:
+            return (0, 0), None
 
-            time.sleep(self.delay_major)
-        return len(result), len(ls)
+        sink = _DetailSink(self, output_loan_basic_dir, output_loan_events_dir, journal,
+                           flush_every or self.chunk_size)
+
+        def on_loan(elm, status, response_json):
+            if status == 200:
+                sink.add(elm, response_json)
+            elif status == 404:
+                sink.not_found(elm)
+            else:
+                sink.failed(elm, "status %s" % status)
+
+        fetcher = AsyncLoanFetcher(self, max_connections=max_connections,
+                                   rate=rate if rate is not None else 1 / self.delay_minor)
+        try:
+            stats = fetcher.run(ls, on_loan)
+        finally:
+            sink.flush()
+        logging.info(stats.report())
+        return (sink.fetched, len(ls)), stats
+
+    def _parse_detailed(self, loan_id, response_json):
+        """
+        Split a /detailed response into its basic row and cleaned event rows.
+        """
+        assert 'basic' in response_json and 'events' in response_json
+        loan_basic = response_json['basic']
+        loan_basic['loan_id'] = loan_id
+        loan_events = [self._clean_event(event, loan_id) for event in response_json['events']]
+        return loan_basic, loan_events
 
     @staticmethod
     def _clean_event(event, loan_id):
@@ -172,42 +290,75 @@ class LoansRetriever:
         event.pop('reason', None)
         return event
 
-    def _req_call(self, session, endpoint, params, max_retries=3):
+    def _req_call(self, endpoint, params, max_retries=3):
         """
         Helper function for calling loansbot API. Backoff-retry algo compliance is handled automatically
         but the caller must implement delay between HTTP connections/requests.
 
-        :param session:
         :param endpoint:
         :param params:
         :param max_retries:
-        :return:
+        :return: The 200/404 response, or None once max_retries is exceeded or on a 4xx that retrying cannot fix
+        (anything but 401 and 429)
         """
         retry_count = 0
         BACKOFF_DELAY = 62
 
         while retry_count <= max_retries:
-            # Re-authenticate if required
-            if self.auth_data is not None:
-                auth_expiry = self.auth_data['expires_at_utc']
-                if auth_expiry <= datetime.datetime.now().timestamp():
-                    self.authenticate(self.auth)
-                auth_token = self.auth_data['token']
-                self.headers['Authorization'] = auth_token
+            self._refresh_auth()
             url = self.BASE_URL + endpoint
             logging.info(f"API call to %s with header %s and params %s.", url, self.headers, params)
-            r = session.get(url, headers=self.headers, timeout=self.timeout, params=params)
-            if r.status_code == 200 or r.status_code == 404:
+            try:
+                r = self._get(url, params)
+            except requests.RequestException as e:
+                logging.error("Error calling %s: %s", url, str(e))
+                r = None
+            else:
+                if r is None:
+                    return None  # Offline cache miss
+            if r is not None and (r.status_code == 200 or r.status_code == 404):
                 return r
+            if r is not None and 400 <= r.status_code < 500 and r.status_code not in (401, 429):
+                logging.error("Call to endpoint %s with params %s rejected with status code %s; not retrying.",
+                              endpoint, params, r.status_code)
+                return None
 
             retry_count += 1
-            logging.info("Request failed with status code %d. Delaying for %d seconds and retrying.",
-                         r.status_code, BACKOFF_DELAY)
+            logging.info("Request failed with status code %s. Delaying for %d seconds and retrying.",
+                         r.status_code if r is not None else None, BACKOFF_DELAY)
             time.sleep(BACKOFF_DELAY)  # Appease the backoff algo
 
-        logging.error("Max retries exceeded for call to endpoint %s with headers %s and params %s. Exiting.",
+        logging.error("Max retries exceeded for call to endpoint %s with headers %s and params %s.",
                       endpoint, self.headers, params)
-        sys.exit(1)
+        return None
+
+    def _get(self, url, params):
+        """
+        Single GET over the shared transport, served from / stored to the response cache when there is one.
+        No transport-level retries: the LoansBot backoff rules are applied by the callers.
+        """
+        headers = dict(self.headers)
+
+        def send(conditional):
+            return self.transport.get(url, headers={**headers, **conditional}, params=params, timeout=self.timeout,
+                                      retries=0)
+
+        if self.cache is None:
+            return send({})
+        return self.cache.fetch(url, params, send)
+
+    def _refresh_auth(self):
+        """
+        Re-authenticate if the token has passed expires_at_utc, then stamp the current token on the headers.
+        Safe to call from several threads at once.
+        """
+        with self._auth_lock:
+            if self.auth_data is not None:
+                auth_expiry = self.auth_data['expires_at_utc']
+                if auth_expiry <= datetime.datetime.now().timestamp():
+                    self.authenticate(self.auth)
+                auth_token = self.auth_data['token']
+                self.headers['Authorization'] = auth_token
 
     def authenticate(self, auth: dict, endpoint='/api/users/login'):
         """
@@ -228,7 +379,7 @@ class LoansRetriever:
         assert 'password_authentication_id' in auth
 
         url = self.BASE_URL + endpoint
-        response = requests.post(url, headers=self.headers, timeout=self.timeout, json=auth)
+        response = self.transport.session.post(url, headers=self.headers, timeout=self.timeout, json=auth)
         if response.status_code != 200:
             logging.error("Authentication attempt failed! Supplied params: %s", auth)
             sys.exit(1)
@@ -246,3 +397,77 @@ class LoansRetriever:
         """
         for i in range(0, len(ls), n):
             yield ls[i:i + n]
+
+
+class _DetailSink:
+    """
+    Buffers parsed /detailed results and writes them to the staging folders every flush_every loans. Files are
+    written to a temp name and renamed into place before the journal marks their ids fetched, so a crash never
+    leaves a fetched id without its rows on disk.
+
+    Each flush gets its own files, named by the UTC time of the flush and a sequence number, so repolls of ids
+    already staged never overwrite earlier files, and ingesting in path order applies them in the order they were
+    fetched. The 't' before the time sorts every such file after the older loan_basic_{first}_to_{last} ones.
+    """
+
+    def __init__(self, retriever, output_loan_basic_dir, output_loan_events_dir, journal, flush_every):
+        self.retriever = retriever
+        self.output_loan_basic_dir = output_loan_basic_dir
+        self.output_loan_events_dir = output_loan_events_dir
+        self.journal = journal
+        self.flush_every = flush_every
+        self.fetched = 0
+        self.flushes = 0
+        self.ids: list = []
+        self.basic_rows: list[dict] = []
+        self.event_rows: list[dict] = []
+
+    def add(self, loan_id, response_json):
+        loan_basic, loan_events = self.retriever._parse_detailed(loan_id, response_json)
+        self.ids.append(loan_id)
+        self.basic_rows.append(loan_basic)
+        self.event_rows.extend(loan_events)
+        if len(self.ids) >= self.flush_every:
+            self.flush()
+
+    def not_found(self, loan_id):
+        logging.error("404 Error fetching loan id %s", loan_id)
+        if self.journal is not None:
+            self.journal.mark([loan_id], self.journal.NOT_FOUND)
+
+    def failed(self, loan_id, error):
+        logging.error("Giving up on loan id %s for this run (%s)", loan_id, error)
+        if self.journal is not None:
+            self.journal.mark([loan_id], self.journal.FAILED, error)
+
+    def flush(self):
+        if len(self.ids) == 0:
+            return
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        name = f"t{stamp}_{self.flushes:06d}"
+        self.flushes += 1
+
+        output_basic_file = f"loan_basic_{name}.csv"
+        output_events_file = f"loan_events_{name}.csv"
+        output_basic_file_full_path = os.path.join(self.output_loan_basic_dir, output_basic_file)
+        output_events_file_full_path = os.path.join(self.output_loan_events_dir, output_events_file)
+
+        logging.debug("Writing %d loans to file %s", len(self.basic_rows), output_basic_file_full_path)
+        self._write_atomic(pd.DataFrame(self.event_rows), output_events_file_full_path)
+        self._write_atomic(pd.DataFrame(self.basic_rows), output_basic_file_full_path)
+
+        if self.journal is not None:
+            self.journal.mark_fetched(self.basic_rows)
+        self.fetched += len(self.ids)
+        self.ids = []
+        self.basic_rows = []
+        self.event_rows = []
+
+    @staticmethod
+    def _write_atomic(df, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', newline='') as f:
+            df.to_csv(f, escapechar='\\', index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import time
+
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Records every staged file that has been ingested: its size, mtime and content hash, and the keys of the rows it
+    produced. A file whose size and mtime match is skipped without being read; one whose stat changed but whose
+    hash did not is just re-stamped.
+
+    When a file's content does change, the rows it used to produce that it no longer does are deleted, unless
+    another file of the same table still produces them, and the rest are upserted over.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        sql_create_ingest_manifest = """
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            path TEXT PRIMARY KEY,
+            table_name TEXT,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            rows INTEGER,
+            ingested_utc REAL
+        );
+        """
+        sql_create_ingest_manifest_rows = """
+        CREATE TABLE IF NOT EXISTS ingest_manifest_rows (
+            path TEXT,
+            row_key,
+            PRIMARY KEY (path, row_key)
+        ) WITHOUT ROWID;
+        """
+        with self.db.conn:
+            self.db.conn.execute(sql_create_ingest_manifest)
+            self.db.conn.execute(sql_create_ingest_manifest_rows)
+            self.db.conn.execute("CREATE INDEX IF NOT EXISTS ingest_manifest_rows_key "
+                                 "ON ingest_manifest_rows (row_key);")
+
+    def entry(self, path):
+        c = self.db.conn.execute("SELECT path, table_name, size, mtime, sha256, rows, ingested_utc "
+                                 "FROM ingest_manifest WHERE path = ?;", (path,))
+        return c.fetchone()
+
+    def unchanged(self, path, size, mtime) -> bool:
+        entry = self.entry(path)
+        return entry is not None and entry['size'] == size and entry['mtime'] == mtime
+
+    def same_content(self, path, sha256) -> bool:
+        entry = self.entry(path)
+        return entry is not None and entry['sha256'] == sha256
+
+    def touch(self, path, size, mtime):
+        self.db.conn.execute("UPDATE ingest_manifest SET size = ?, mtime = ? WHERE path = ?;", (size, mtime, path))
+
+    def replace(self, table, key, path, size, mtime, sha256, keys, after_delete=None) -> list:
+        """
+        Record that path now produces exactly keys, deleting from table the rows it alone used to produce.
+        Nothing is committed here, so the manifest and the rows commit in the same transaction.
+
+        :param table: Table the file is ingested into
+        :param key: Key column of table
+        :param path: Staged file
+        :param keys: Keys of the rows the file produces now
+        :param after_delete: Called as after_delete(db, deleted keys) once rows are deleted, to delete what was
+        derived from them in the same transaction, e.g. Ingest.after_delete
+        :return: Keys of the rows deleted
+        """
+        old = {row['row_key'] for row in
+               self.db.conn.execute("SELECT row_key FROM ingest_manifest_rows WHERE path = ?;", (path,))}
+        stale = list(old.difference(keys))
+        kept = set()
+        for i in range(0, len(stale), 500):
+            chunk = stale[i:i + 500]
+            kept.update(row['row_key'] for row in self.db.conn.execute(
+                "SELECT r.row_key FROM ingest_manifest_rows r JOIN ingest_manifest m ON m.path = r.path "
+                f"WHERE r.row_key IN ({', '.join('?' * len(chunk))}) AND r.path != ? AND m.table_name = ?;",
+                (*chunk, path, table)))
+        deleted = [row_key for row_key in stale if row_key not in kept]
+        if deleted:
+            self.db.conn.executemany(f"DELETE FROM {table} WHERE {key} = ?;", [(row_key,) for row_key in deleted])
+            if after_delete is not None:
+                after_delete(self.db, deleted)
+            logging.info("Removed the rows of %d keys %s no longer produces.", len(deleted), path)
+
+        self.db.conn.execute("DELETE FROM ingest_manifest_rows WHERE path = ?;", (path,))
+        self.db.conn.executemany("INSERT INTO ingest_manifest_rows (path, row_key) VALUES (?, ?);",
+                                 [(path, row_key) for row_key in keys])
+        self.db.conn.execute("INSERT INTO ingest_manifest (path, table_name, size, mtime, sha256, rows, ingested_utc) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT (path) DO UPDATE SET table_name = excluded.table_name, "
+                             "size = excluded.size, mtime = excluded.mtime, sha256 = excluded.sha256, "
+                             "rows = excluded.rows, ingested_utc = excluded.ingested_utc;",
+                             (path, table, size, mtime, sha256, len(keys), time.time()))
+        return deleted
+
+    def forget_missing(self, table, folder, paths):
+        """
+        Drop the entries of files under folder that no longer exist, e.g. window files merged by compaction. Their
+        rows are left alone.
+        """
+        present = set(paths)
+        prefix = os.path.join(folder, '')
+        c = self.db.conn.execute("SELECT path FROM ingest_manifest WHERE table_name = ?;", (table,))
+        missing = [row['path'] for row in c if row['path'].startswith(prefix) and row['path'] not in present]
+        if missing:
+            with self.db.conn:
+                self.db.conn.executemany("DELETE FROM ingest_manifest_rows WHERE path = ?;", [(p,) for p in missing])
+                self.db.conn.executemany("DELETE FROM ingest_manifest WHERE path = ?;", [(p,) for p in missing])
+            logging.info("Forgot %d staged files that no longer exist under %s.", len(missing), folder)
@@ -10,8 +10,9 @@ class PushShift(DataRetriever):
         "Content-Type": "application/json; charset=utf-8"
     }
 
-    def __init__(self, start_date_unix=None, end_date_unix=None, limit=500, timeout=60):
-        super().__init__(timeout)
+    def __init__(self, start_date_unix=None, end_date_unix=None, limit=500, timeout=60, cache=None, transport=None,
+                 limiter=None):
+        super().__init__(timeout, cache, transport, limiter)
         if start_date_unix is not None:
             self.start_date_unix = start_date_unix
         if end_date_unix is not None:
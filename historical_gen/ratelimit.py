@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Central token bucket shared by every worker that talks to one API. Tokens refill at `rate` per second up to
+    `capacity`, and a backoff (e.g. after a 429) pauses the whole bucket so no worker sends until it has elapsed.
+
+    Usable from both threads (acquire) and coroutines (acquire_async).
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        """
+        :param rate: Sustained requests per second allowed
+        :param capacity: Max burst size. 1 means requests are evenly spaced at 1/rate seconds.
+        """
+        assert rate > 0 and capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()  # May sit in the future while paused
+        self.epoch = 0  # Bumped on every pause so sleepers know to re-check
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Take a token and return how many seconds the caller must wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            wait = self.updated - now
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for `seconds`. Any outstanding reservations are invalidated.
+        """
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self.updated:
+                self.updated = until
+            self.tokens = min(self.tokens, 0)
+            self.epoch += 1
+
+    def acquire(self):
+        while True:
+            epoch = self.epoch
+            wait = self._reserve()
+            if wait > 0:
+                time.sleep(wait)
+            if epoch == self.epoch:
+                return
+
+    async def acquire_async(self):
+        while True:
+            epoch = self.epoch
+            wait = self._reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if epoch == self.epoch:
+                return
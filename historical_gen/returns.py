@@ -0,0 +1,223 @@
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['loan_id', 'status', 'principal_minor', 'repaid_minor', 'profit_minor', 'term_days', 'days_to_repay',
+           'apr', 'irr', 'loss_given_default']
+
+DELETED = 'deleted'
+REPAID = 'repaid'
+UNPAID = 'unpaid'
+OPEN = 'open'
+
+_DAY = 86400.0
+_YEAR = 365 * _DAY
+
+# Bounds on the IRR solver's continuously compounded annual rate, ln(1 + irr). Loans repaid within hours of being
+# made annualize to rates past these, which are reported as null rather than as meaningless numbers.
+_MAX_LOG_RATE = 50.0
+_MAX_ITERATIONS = 60
+_TOLERANCE = 1e-10
+
+_LOAN_DTYPES = {'id': 'int64', 'principal_minor': 'float64', 'principal_repayment_minor': 'float64',
+                'created_at': 'float64', 'last_repaid_at': 'float64', 'repaid_at': 'float64', 'unpaid_at': 'float64',
+                'deleted_at': 'float64'}
+_EVENT_DTYPES = {'loan_id': 'int64', 'occurred_at': 'float64', 'repayment_minor': 'float64',
+                 'new_principal_minor': 'float64', 'old_principal_repayment_minor': 'float64',
+                 'new_principal_repayment_minor': 'float64'}
+
+
+def compute_returns(loans, events) -> pd.DataFrame:
+    """
+    Compute the realized return of every loan in one vectorized pass. Each loan's cash flows are the principal
+    lent at created_at, then every repayment event and every admin correction of the repaid total at the time it
+    happened. The loan's own principal_repayment_minor is authoritative: whatever the events leave unaccounted
+    for is taken as repaid at last_repaid_at. An admin correction of the principal replaces the principal lent,
+    with the loan's current principal_minor winning over the events.
+
+    apr is the simple annualized return over the loan's term, irr the annual rate at which the cash flows have
+    zero net present value. Both are only given for repaid and unpaid loans; days_to_repay only for repaid ones
+    and loss_given_default, the fraction of principal never repaid, only for unpaid ones. Deleted loans keep
+    their amounts but get no returns.
+
+    :param loans: DataFrame with id, principal_minor, principal_repayment_minor, created_at, last_repaid_at,
+    repaid_at, unpaid_at, deleted_at
+    :param events: DataFrame with loan_id, occurred_at, repayment_minor, new_principal_minor,
+    old_principal_repayment_minor, new_principal_repayment_minor. Events of loans not in loans are ignored.
+    :return: DataFrame of COLUMNS, one row per loan
+    """
+    loans = loans.sort_values('id')
+    ids = loans['id'].to_numpy()
+    n = len(ids)
+
+    def col(df, name):
+        return df[name].to_numpy(dtype='float64', na_value=np.nan)
+
+    created = col(loans, 'created_at')
+    repaid_at = col(loans, 'repaid_at')
+    unpaid_at = col(loans, 'unpaid_at')
+
+    # Every event as an index into loans, dropping the events of other loans
+    pos = np.searchsorted(ids, events['loan_id'].to_numpy()).clip(0, max(n - 1, 0))
+    known = (ids[pos] == events['loan_id'].to_numpy()) if n else np.zeros(len(events), dtype=bool)
+    pos = pos[known]
+    occurred = col(events, 'occurred_at')[known]
+
+    # The last admin correction of each loan's principal, for loans without a principal of their own
+    principal = col(loans, 'principal_minor')
+    corrected = col(events, 'new_principal_minor')[known]
+    has = ~np.isnan(corrected)
+    if has.any():
+        order = np.lexsort((occurred[has], pos[has]))
+        last = np.full(n, np.nan)
+        last[pos[has][order]] = corrected[has][order]  # Later assignments win
+        principal = np.where(np.isnan(principal), last, principal)
+
+    # Inflows: repayments, then repaid total corrections as the difference they made
+    amounts = np.nan_to_num(col(events, 'repayment_minor')[known])
+    amounts += np.nan_to_num(col(events, 'new_principal_repayment_minor')[known]
+                             - col(events, 'old_principal_repayment_minor')[known])
+    flow = amounts != 0
+    flow_pos, flow_at, flow_amount = pos[flow], occurred[flow], amounts[flow]
+
+    repaid = col(loans, 'principal_repayment_minor')
+    from_events = np.bincount(flow_pos, weights=flow_amount, minlength=n)
+    repaid = np.where(np.isnan(repaid), from_events, repaid)
+    residual = repaid - from_events
+    settle_at = col(loans, 'last_repaid_at')
+    for fallback in (repaid_at, unpaid_at, created):
+        settle_at = np.where(np.isnan(settle_at), fallback, settle_at)
+    extra = np.flatnonzero(residual != 0)
+    flow_pos = np.concatenate([flow_pos, extra])
+    flow_at = np.concatenate([flow_at, settle_at[extra]])
+    flow_amount = np.concatenate([flow_amount, residual[extra]])
+
+    status = np.full(n, OPEN, dtype=object)
+    status[~np.isnan(unpaid_at)] = UNPAID
+    status[~np.isnan(repaid_at)] = REPAID
+    status[~np.isnan(col(loans, 'deleted_at'))] = DELETED
+    closed = (status == REPAID) | (status == UNPAID)
+
+    end = np.where(status == REPAID, repaid_at, np.where(status == UNPAID, unpaid_at, np.nan))
+    term_days = (end - created) / _DAY
+    lent = closed & (principal > 0) & (term_days > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        apr = np.where(lent, (repaid - principal) / principal * 365 / term_days, np.nan)
+        loss = np.where(status == UNPAID, np.clip((principal - repaid) / principal, 0, 1), np.nan)
+
+    years = np.maximum(flow_at - created[flow_pos], 0) / _YEAR
+    irr = _irr(principal, flow_pos, years, flow_amount, lent)
+
+    return pd.DataFrame({
+        'loan_id': ids,
+        'status': status,
+        'principal_minor': pd.array(np.round(principal), dtype='Int64'),
+        'repaid_minor': pd.array(np.round(repaid), dtype='Int64'),
+        'profit_minor': pd.array(np.round(repaid - principal), dtype='Int64'),
+        'term_days': np.where(closed, term_days, np.nan),
+        'days_to_repay': np.where(status == REPAID, term_days, np.nan),
+        'apr': apr,
+        'irr': irr,
+        'loss_given_default': loss
+    }, columns=COLUMNS)
+
+
+def _irr(principal, flow_pos, years, amounts, solve) -> np.ndarray:
+    """
+    Solve every loan's IRR at once with Newton's method on g = ln(1 + irr), where the net present value
+    -principal + sum(amount * exp(-g * years)) is convex and, for inflows, decreasing, so the iteration converges
+    from any start. Each step is one pass over all cash flows with np.bincount doing the per-loan sums. The start
+    is exact for a loan repaid in one payment.
+
+    :param solve: Mask of the loans to solve for; the rest get NaN
+    :return: Annual IRR per loan; -1 for loans that repaid nothing, NaN where there is no finite solution
+    """
+    n = len(principal)
+    irr = np.full(n, np.nan)
+    total = np.bincount(flow_pos, weights=amounts, minlength=n)
+    weighted = np.bincount(flow_pos, weights=amounts * years, minlength=n)
+    irr[solve & (total <= 0)] = -1.0
+    solve = solve & (total > 0) & (weighted > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g = np.log(total / principal) / (weighted / total)
+    g = np.where(solve, g, 0.0)
+    converged = ~solve
+    keep = solve[flow_pos]
+    flow_pos, years, amounts = flow_pos[keep], years[keep], amounts[keep]
+    for _ in range(_MAX_ITERATIONS):
+        if converged.all():
+            break
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):  # Rates heading out of bounds
+            discounted = amounts * np.exp(-g[flow_pos] * years)
+            npv = np.bincount(flow_pos, weights=discounted, minlength=n) - principal
+            slope = -np.bincount(flow_pos, weights=discounted * years, minlength=n)
+            step = np.where(converged, 0.0, npv / slope)
+        step = np.nan_to_num(step, nan=np.inf)
+        g = np.clip(g - step, -_MAX_LOG_RATE, _MAX_LOG_RATE)
+        converged |= np.abs(step) < _TOLERANCE
+    good = solve & converged & (np.abs(g) < _MAX_LOG_RATE)
+    irr[good] = np.expm1(g[good])
+    return irr
+
+
+class LoanReturns:
+    """
+    Maintains loan_returns, the realized return of every loan. Triggers on loans and loan_events (db.MIGRATIONS)
+    queue the loans a write touches in loan_returns_dirty, and a refresh recomputes just those, in chunks of
+    consecutive loan ids read with range seeks on both tables.
+    """
+
+    def __init__(self, db, chunk_loans=50000):
+        """
+        :param db: LoansDB
+        :param chunk_loans: Dirty loans recomputed per committed chunk
+        """
+        self.db = db
+        self.chunk_loans = chunk_loans
+
+    def refresh(self) -> int:
+        """
+        :return: Number of loans recomputed
+        """
+        started = time.monotonic()
+        done = 0
+        while True:
+            loan_ids = [row[0] for row in self.db.conn.execute(
+                "SELECT loan_id FROM loan_returns_dirty ORDER BY loan_id LIMIT ?;", (self.chunk_loans,))]
+            if not loan_ids:
+                break
+            lo, hi = loan_ids[0], loan_ids[-1]
+            returns = self._compute(lo, hi)
+            with self.db.conn:
+                self.db.conn.execute("DELETE FROM loan_returns WHERE loan_id BETWEEN ? AND ? AND loan_id IN "
+                                     "(SELECT loan_id FROM loan_returns_dirty);", (lo, hi))
+                self.db.bulk_upsert('loan_returns', returns, key=('loan_id',), join_transaction=True)
+                self.db.conn.execute("DELETE FROM loan_returns_dirty WHERE loan_id BETWEEN ? AND ?;", (lo, hi))
+            done += len(loan_ids)
+            logging.debug("Recomputed returns of %d loans.", done)
+        if done:
+            logging.info("Recomputed returns of %d loans in %.1fs.", done, time.monotonic() - started)
+        return done
+
+    def rebuild(self) -> int:
+        """
+        Mark every loan dirty and refresh.
+        """
+        with self.db.conn:
+            self.db.conn.execute("INSERT OR IGNORE INTO loan_returns_dirty (loan_id) SELECT id FROM loans;")
+        return self.refresh()
+
+    def _compute(self, lo, hi) -> pd.DataFrame:
+        loans = self.db.query_df(
+            "SELECT l.id, l.principal_minor, l.principal_repayment_minor, l.created_at, l.last_repaid_at, "
+            "l.repaid_at, l.unpaid_at, l.deleted_at FROM loans l "
+            "JOIN loan_returns_dirty d ON d.loan_id = l.id WHERE d.loan_id BETWEEN ? AND ?;",
+            (lo, hi), dtypes=_LOAN_DTYPES)
+        events = self.db.query_df(
+            "SELECT loan_id, occurred_at, repayment_minor, new_principal_minor, old_principal_repayment_minor, "
+            "new_principal_repayment_minor FROM loan_events WHERE loan_id BETWEEN ? AND ?;",
+            (lo, hi), dtypes=_EVENT_DTYPES)
+        return compute_returns(loans, events)
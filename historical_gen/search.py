@@ -0,0 +1,83 @@
+import logging
+import time
+
+SUBMISSION = 'submission'
+COMMENT = 'comment'
+
+# Staging table and text columns each kind is indexed from
+_SOURCES = ((SUBMISSION, 'staging_submissions_raw', 'title, selftext'), (COMMENT, 'staging_comments_raw', 'body'))
+
+
+def doc_rowid(kind, reddit_id):
+    """
+    :return: The search_index rowid of a post: its base36 Reddit id as an integer, doubled, plus one for comments,
+    so re-indexing a post replaces its entry by rowid. None if reddit_id is not a Reddit id.
+    """
+    try:
+        return int(reddit_id, 36) * 2 + (kind == COMMENT)
+    except (TypeError, ValueError):
+        return None
+
+
+def index_posts(db, kind, df) -> int:
+    """
+    Add posts to search_index, replacing the entries of any already in it. Nothing is committed here, so the
+    index changes with the rows it was built from.
+
+    :param db: LoansDB
+    :param kind: SUBMISSION or COMMENT
+    :param df: DataFrame with id, author, created_utc and title / selftext (submissions) or body (comments)
+    :return: Number of posts indexed
+    """
+    if len(df) == 0:
+        return 0
+    if kind == SUBMISSION:
+        df = df.reindex(columns=['id', 'author', 'created_utc', 'title', 'selftext'])
+    else:
+        df = df.reindex(columns=['id', 'author', 'created_utc', 'title', 'body'])
+    rows = []
+    for reddit_id, author, created_utc, title, body in db.df_rows(df):
+        rowid = doc_rowid(kind, reddit_id)
+        if rowid is not None:
+            rows.append((rowid, kind, reddit_id, author, created_utc, title, body))
+    db.conn.executemany("DELETE FROM search_index WHERE rowid = ?;", [(row[0],) for row in rows])
+    db.conn.executemany("INSERT INTO search_index (rowid, kind, id, author, created_utc, title, body) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+    return len(rows)
+
+
+def remove_posts(db, kind, ids) -> int:
+    """
+    Drop posts from search_index, e.g. once their staging rows are deleted. Nothing is committed here.
+
+    :param kind: SUBMISSION or COMMENT
+    :param ids: Reddit ids
+    :return: Number of entries removed
+    """
+    rowids = [(rowid,) for rowid in (doc_rowid(kind, reddit_id) for reddit_id in ids) if rowid is not None]
+    return db.conn.executemany("DELETE FROM search_index WHERE rowid = ?;", rowids).rowcount
+
+
+def rebuild_index(db, chunk_rows=50000) -> int:
+    """
+    Index every submission and comment in the staging tables from scratch, e.g. for posts ingested before the
+    index existed.
+
+    :return: Number of posts indexed
+    """
+    started = time.monotonic()
+    indexed = 0
+    with db.conn:
+        db.conn.execute("DELETE FROM search_index;")
+    for kind, table, columns in _SOURCES:
+        if db.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                           (table,)).fetchone() is None:
+            continue
+        for df in db.iter_df(f"SELECT id, author, created_utc, {columns} FROM {table};", chunk_rows=chunk_rows):
+            with db.conn:
+                indexed += index_posts(db, kind, df)
+            logging.debug("Indexed %d posts.", indexed)
+    with db.conn:
+        db.conn.execute("INSERT INTO search_index (search_index) VALUES ('optimize');")
+    logging.info("Indexed %d posts for search in %.1fs.", indexed, time.monotonic() - started)
+    return indexed
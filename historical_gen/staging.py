@@ -1,104 +1,298 @@
 import logging
+import queue
 import sys
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
+from pandas.tseries.frequencies import to_offset
 from historical_gen._dataretriever import DataRetriever
+from historical_gen.columnar import CSV, write_staging
+from historical_gen.ingest import IngestSubmissions, IngestComments
 from historical_gen.pushshift import PushShift
+from historical_gen.ratelimit import TokenBucket
+from historical_gen.windows import AdaptiveWindowPlanner
 
 
 class SubmissionRetriever(DataRetriever):
 
-    def __init__(self, start_date: str, end_date: str, timeout: int = 60, delay: int = 2):
+    SCHEMA = IngestSubmissions.SCHEMA
+
+    def __init__(self, start_date: str, end_date: str, timeout: int = 60, delay: int = 2, cache=None,
+                 transport=None, fmt=CSV):
         """
         :param start_date: Start date as 'YYYY-MM-DD'
         :param end_date: End date as 'YYYY-MM-DD'
         :param timeout: Timeout before request error
         :param delay: Delay between each request
+        :param cache: Optional ResponseCache for the Pushshift calls
+        :param transport: Transport for the Pushshift calls. Defaults to the shared one.
+        :param fmt: Staging file format, columnar.CSV or columnar.PARQUET
         """
-        super().__init__(timeout)
+        super().__init__(timeout, cache, transport)
         self.start_date = start_date
         self.end_date = end_date
         self.delay = delay
+        self.fmt = fmt
+        self.max_created_utc = None  # Newest created_utc seen by the last fetch
+        self.coverage_gaps = []  # Windows an adaptive fetch could not guarantee complete
 
-    def fetch_submissions(self, output_dir: str, freq='d') -> tuple[int, int]:
+    def fetch_submissions(self, output_dir: str, freq='d', adaptive=False, workers=1) -> tuple[int, int]:
         """
         Fetch data by submissions.
 
-        :return: Tuple(# days fetched, # total days in range)
+        :param output_dir: Staging folder
+        :param freq: Window size, or the initial window size if adaptive
+        :param adaptive: Size windows with an AdaptiveWindowPlanner instead of fixed freq windows
+        :param workers: Fetch this many fixed windows concurrently. Adaptive windows are always sequential.
+        :return: Tuple(# days fetched, # total days in range). If adaptive, (# windows with data, # windows).
         """
+        if adaptive:
+            return _fetch_adaptive(self, 'submissions', 'submissions', output_dir, freq)
+        if workers > 1:
+            return _fetch_parallel(self, 'submissions', 'submissions', output_dir, freq, '%Y-%m-%d', workers)
 
-        day_ls = pd.date_range(self.start_date, self.end_date, freq=freq)
         day_ct = 0
-        for date, next_date in zip(day_ls, day_ls[1:]):
-            logging.debug("Fetching submission from %s to %s", date, next_date)
-            pushshift = PushShift(start_date_unix=int(date.timestamp()),
-                                  end_date_unix=int(next_date.timestamp()),
-                                  timeout=self.timeout)
-
-            cur_submission_raw = pushshift.submissions()
-            if cur_submission_raw is None or cur_submission_raw.status_code != 200:
-                logging.error("Error occurred or HTTP response was not 200.")
-                sys.exit(1)
-            submissions = cur_submission_raw.json()['data']
-            submissions_df = pd.DataFrame(submissions)
-
+        for date, next_date, submissions_df in self.iter_windows(freq):
             if len(submissions_df) > 0:
                 date_str = date.strftime('%Y-%m-%d')
                 date_next_str = next_date.strftime('%Y-%m-%d')
 
-                output_file = f"submissions_{date_str}_to_{date_next_str}.csv"
+                output_file = f"submissions_{date_str}_to_{date_next_str}"
                 output_file_full_path = os.path.join(output_dir, output_file)
                 logging.debug("Writing %d submissions to file %s", len(submissions_df), output_file_full_path)
-                submissions_df.to_csv(output_file_full_path, escapechar='\\', index=False)
+                write_staging(submissions_df, output_file_full_path, self.SCHEMA, self.fmt)
                 day_ct += 1
 
-            time.sleep(self.delay)
+        return day_ct, _window_count(self, freq)
 
-        return day_ct, max(len(day_ls) - 1, 0)
+    def iter_windows(self, freq='d'):
+        """
+        Fetch fixed freq windows one after another, yielding each as soon as it arrives.
+
+        :return: Generator of (window start, window end, DataFrame of submissions)
+        """
+        return _iter_windows(self, 'submissions', 'submission', freq)
 
 
 class CommentRetriever(DataRetriever):
 
-    def __init__(self, start_date: str = None, end_date: str = None, timeout: int = 60, delay: int = 2):
+    SCHEMA = IngestComments.SCHEMA
+
+    def __init__(self, start_date: str = None, end_date: str = None, timeout: int = 60, delay: int = 2, cache=None,
+                 transport=None, fmt=CSV):
         """
         :param start_date: Start date as 'YYYY-MM-DD'
         :param end_date: End date as 'YYYY-MM-DD'
         :param timeout: Timeout before request error
         :param delay: Delay between each request
+        :param cache: Optional ResponseCache for the Pushshift calls
+        :param transport: Transport for the Pushshift calls. Defaults to the shared one.
+        :param fmt: Staging file format, columnar.CSV or columnar.PARQUET
         """
-        super().__init__(timeout)
+        super().__init__(timeout, cache, transport)
         self.start_date = start_date
         self.end_date = end_date
         self.delay = delay
+        self.fmt = fmt
+        self.max_created_utc = None  # Newest created_utc seen by the last fetch
+        self.coverage_gaps = []  # Windows an adaptive fetch could not guarantee complete
 
-    def fetch_comments(self, output_dir: str, freq='12H'):
-        day_ls = pd.date_range(self.start_date, self.end_date, freq=freq)
+    def fetch_comments(self, output_dir: str, freq='12H', adaptive=False, workers=1):
+        """
+        :param output_dir: Staging folder
+        :param freq: Window size, or the initial window size if adaptive
+        :param adaptive: Size windows with an AdaptiveWindowPlanner instead of fixed freq windows
+        :param workers: Fetch this many fixed windows concurrently. Adaptive windows are always sequential.
+        :return: Tuple(# windows fetched, # total windows in range)
+        """
+        if adaptive:
+            return _fetch_adaptive(self, 'comment', 'comments', output_dir, freq)
+        if workers > 1:
+            return _fetch_parallel(self, 'comment', 'comments', output_dir, freq, '%Y-%m-%d_%H-%M-%S', workers)
         day_ct = 0
-        for date, next_date in zip(day_ls, day_ls[1:]):
-            logging.debug("Fetching comments from %s to %s", date, next_date)
-            pushshift = PushShift(start_date_unix=int(date.timestamp()),
-                                  end_date_unix=int(next_date.timestamp()),
-                                  timeout=self.timeout)
-
-            cur_comments_raw = pushshift.comment()
-            if cur_comments_raw is None or cur_comments_raw.status_code != 200:
-                logging.error("Error occurred or HTTP response was not 200.")
-                sys.exit(1)
-            comments = cur_comments_raw.json()['data']
-            comments_df = pd.DataFrame(comments)
-
+        for date, next_date, comments_df in self.iter_windows(freq):
             if len(comments_df) > 0:
                 date_str = date.strftime('%Y-%m-%d_%H-%M-%S')
                 date_next_str = next_date.strftime('%Y-%m-%d_%H-%M-%S')
 
-                output_file = f"comments_{date_str}_to_{date_next_str}.csv"
+                output_file = f"comments_{date_str}_to_{date_next_str}"
                 output_file_full_path = os.path.join(output_dir, output_file)
                 logging.debug("Writing %d comments to file %s", len(comments_df), output_file_full_path)
-                comments_df.to_csv(output_file_full_path, escapechar='\\', index=False)
+                write_staging(comments_df, output_file_full_path, self.SCHEMA, self.fmt)
                 day_ct += 1
 
-            time.sleep(self.delay)
+        return day_ct, _window_count(self, freq)
+
+    def iter_windows(self, freq='12H'):
+        """
+        Fetch fixed freq windows one after another, yielding each as soon as it arrives.
+
+        :return: Generator of (window start, window end, DataFrame of comments)
+        """
+        return _iter_windows(self, 'comment', 'comments', freq)
+
+
+def _window_count(retriever, freq):
+    return max(len(pd.date_range(retriever.start_date, retriever.end_date, freq=freq)) - 1, 0)
+
+
+def _iter_windows(retriever, query, label, freq):
+    day_ls = pd.date_range(retriever.start_date, retriever.end_date, freq=freq)
+    pushshift = PushShift(timeout=retriever.timeout, cache=retriever.cache, transport=retriever.transport)
+    for date, next_date in zip(day_ls, day_ls[1:]):
+        logging.debug("Fetching %s from %s to %s", label, date, next_date)
+        pushshift.start_date_unix = int(date.timestamp())
+        pushshift.end_date_unix = int(next_date.timestamp())
+
+        raw = getattr(pushshift, query)()
+        if raw is None or raw.status_code != 200:
+            logging.error("Error occurred or HTTP response was not 200.")
+            sys.exit(1)
+        df = pd.DataFrame(raw.json()['data'])
+        if len(df) > 0:
+            retriever.max_created_utc = _newest_created(retriever.max_created_utc, df)
+
+        yield date, next_date, df
+
+        if not getattr(raw, 'from_cache', False):
+            time.sleep(retriever.delay)
+
+
+def _newest_created(current, df):
+    newest = int(df['created_utc'].max())
+    return newest if current is None or newest > current else current
+
+
+def _fetch_adaptive(retriever, query, prefix, output_dir, freq):
+    """
+    Walk retriever's date range with an AdaptiveWindowPlanner: full pages are bisected and refetched, and window
+    sizes follow the observed density, starting from freq.
+
+    :param retriever: SubmissionRetriever or CommentRetriever
+    :param query: PushShift method to call per window
+    :param prefix: Output file prefix
+    :return: Tuple(# windows with data, # windows accepted)
+    """
+    pushshift = PushShift(timeout=retriever.timeout, cache=retriever.cache, transport=retriever.transport)
+    planner = AdaptiveWindowPlanner(pd.Timestamp(retriever.start_date).timestamp(),
+                                    pd.Timestamp(retriever.end_date).timestamp(),
+                                    page_size=pushshift.limit,
+                                    initial_span=pd.Timedelta(to_offset(freq)).total_seconds())
+    window_ct = 0
+    for start, end in planner:
+        logging.debug("Fetching %s from %s to %s", prefix, start, end)
+        pushshift.start_date_unix = start
+        pushshift.end_date_unix = end
+
+        raw = getattr(pushshift, query)()
+        if raw is None or raw.status_code != 200:
+            logging.error("Error occurred or HTTP response was not 200.")
+            sys.exit(1)
+        df = pd.DataFrame(raw.json()['data'])
+
+        if planner.record((start, end), len(df)) and len(df) > 0:
+            retriever.max_created_utc = _newest_created(retriever.max_created_utc, df)
+            start_str = pd.Timestamp(start, unit='s').strftime('%Y-%m-%d_%H-%M-%S')
+            end_str = pd.Timestamp(end, unit='s').strftime('%Y-%m-%d_%H-%M-%S')
+
+            output_file = f"{prefix}_{start_str}_to_{end_str}"
+            output_file_full_path = os.path.join(output_dir, output_file)
+            logging.debug("Writing %d %s to file %s", len(df), prefix, output_file_full_path)
+            write_staging(df, output_file_full_path, retriever.SCHEMA, retriever.fmt)
+            window_ct += 1
+
+        if not getattr(raw, 'from_cache', False):
+            time.sleep(retriever.delay)
+
+    retriever.coverage_gaps = planner.coverage_gaps
+    logging.info("Adaptive %s fetch: %s", prefix, planner.report())
+    for start, end, count in planner.coverage_gaps:
+        logging.warning("Coverage gap: %s from %s to %s returned a full page of %d.", prefix, start, end, count)
+    return window_ct, planner.accepted
+
+
+def _fetch_parallel(retriever, query, prefix, output_dir, freq, date_fmt, workers):
+    """
+    Fetch retriever's fixed freq windows on a pool of worker threads. The workers share one TokenBucket of
+    1 / delay requests per second, so the pool as a whole never goes faster than the sequential fetch, but the
+    latency of one window overlaps the others. Fetched windows are handed to a single writer thread so CSV
+    serialization never holds up a worker.
+
+    Every window writes the same file name whatever order the windows finish in, and the counts are taken in
+    window order.
+
+    :param retriever: SubmissionRetriever or CommentRetriever
+    :param query: PushShift method to call per window
+    :param prefix: Output file prefix
+    :param date_fmt: strftime format of the window bounds in file names
+    :param workers: Number of fetch threads
+    :return: Tuple(# windows with data, # total windows in range)
+    """
+    day_ls = pd.date_range(retriever.start_date, retriever.end_date, freq=freq)
+    windows = list(zip(day_ls, day_ls[1:]))
+    limiter = TokenBucket(1 / retriever.delay) if retriever.delay > 0 else None
+    writes = queue.Queue(maxsize=2 * workers)  # Bounded so workers wait instead of piling up DataFrames
+    write_errors = []
+
+    def write():
+        while True:
+            item = writes.get()
+            if item is None:
+                return
+            path, df = item
+            if write_errors:
+                continue  # Keep draining so no worker blocks on a full queue
+            try:
+                logging.debug("Writing %d %s to file %s", len(df), prefix, path)
+                write_staging(df, path, retriever.SCHEMA, retriever.fmt)
+            except Exception as e:
+                write_errors.append(e)
+
+    def fetch(date, next_date):
+        logging.debug("Fetching %s from %s to %s", prefix, date, next_date)
+        pushshift = PushShift(int(date.timestamp()), int(next_date.timestamp()), timeout=retriever.timeout,
+                              cache=retriever.cache, transport=retriever.transport, limiter=limiter)
+        raw = getattr(pushshift, query)()
+        if raw is None or raw.status_code != 200:
+            return None
+        df = pd.DataFrame(raw.json()['data'])
+        if len(df) == 0:
+            return 0, None
+
+        output_file = f"{prefix}_{date.strftime(date_fmt)}_to_{next_date.strftime(date_fmt)}"
+        writes.put((os.path.join(output_dir, output_file), df))
+        return len(df), _newest_created(None, df)
+
+    writer = threading.Thread(target=write, name=f"{prefix}-writer", daemon=True)
+    writer.start()
+    window_ct = 0
+    failed = None
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{prefix}-fetch") as executor:
+            futures = [executor.submit(fetch, date, next_date) for date, next_date in windows]
+            try:
+                for (date, next_date), future in zip(windows, futures):
+                    result = future.result()
+                    if result is None:
+                        failed = (date, next_date)
+                        break
+                    count, newest = result
+                    if count > 0:
+                        window_ct += 1
+                        if retriever.max_created_utc is None or newest > retriever.max_created_utc:
+                            retriever.max_created_utc = newest
+            finally:
+                executor.shutdown(cancel_futures=True)  # Drop windows not yet started after a failure
+    finally:
+        writes.put(None)
+        writer.join()
 
-        return day_ct, max(len(day_ls) - 1, 0)
+    if failed is not None:
+        logging.error("Error occurred or HTTP response was not 200 for %s from %s to %s.", prefix, *failed)
+        sys.exit(1)
+    if write_errors:
+        raise write_errors[0]
+    return window_ct, len(windows)
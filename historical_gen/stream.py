@@ -0,0 +1,169 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from historical_gen.columnar import CSV, write_staging
+
+_DONE = object()
+
+
+class _Failure:
+
+    def __init__(self, error):
+        self.error = error
+
+
+class StreamingIngest:
+    """
+    Loads fetched windows straight into their staging_*_raw table while the fetch is still running, instead of
+    writing staging files and ingesting them after the whole run.
+
+    A producer thread drives the retriever's window generator and hands each DataFrame over a bounded queue. The
+    calling thread normalizes the rows with the Ingest class and bulk upserts them in transactions, committing
+    whenever batch_rows rows are waiting or the oldest waiting row is max_latency seconds old, so rows are
+    queryable seconds after their response arrives. With archive on, each raw window is also written as a staging
+    file by a separate thread, off both the network and the database paths.
+    """
+
+    def __init__(self, db, batch_rows=1000, max_latency=2.0, archive=False, archive_format=CSV, queue_size=16):
+        """
+        :param db: LoansDB
+        :param batch_rows: Commit once this many rows are waiting
+        :param max_latency: Commit once the oldest waiting row has waited this many seconds
+        :param archive: Also keep every raw window as a staging file
+        :param archive_format: Format of the archived files
+        :param queue_size: Max fetched windows held in memory before the fetch waits
+        """
+        self.db = db
+        self.batch_rows = batch_rows
+        self.max_latency = max_latency
+        self.archive = archive
+        self.archive_format = archive_format
+        self.queue_size = queue_size
+
+    def run(self, ingest_cls, windows, prefix, archive_dir=None) -> tuple[int, int]:
+        """
+        :param ingest_cls: IngestSubmissions or IngestComments; supplies the table, columns and row filter
+        :param windows: Iterator of (window start, window end, DataFrame), e.g. SubmissionRetriever.iter_windows()
+        :param prefix: Name of the rows in logs and archived file names
+        :param archive_dir: Folder for archived windows. Required if archive is on.
+        :return: Tuple(# windows, # rows loaded)
+        """
+        fetched = queue.Queue(maxsize=self.queue_size)
+        archive = _Archiver(archive_dir, ingest_cls.SCHEMA, prefix, self.archive_format) if self.archive else None
+
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for start, end, df in windows:
+                    if stop.is_set():
+                        return
+                    fetched.put((time.monotonic(), df))
+                    if archive is not None:
+                        archive.put(start, end, df)
+                fetched.put(_DONE)
+            except BaseException as e:  # Includes the SystemExit a failed window raises
+                fetched.put(_Failure(e))
+
+        with self.db.conn:
+            ingest_cls.create_tables(self.db)
+        table = ingest_cls.SCHEMA.table
+
+        producer = threading.Thread(target=produce, name=f"{prefix}-stream", daemon=True)
+        producer.start()
+        window_ct = 0
+        row_ct = 0
+        rows = []
+        oldest = None  # When the oldest uncommitted row's response arrived
+        worst_latency = 0.0
+        try:
+            with self.db.bulk_load(table, defer_indexes=False):
+                while True:
+                    timeout = None if oldest is None else max(0.0, oldest + self.max_latency - time.monotonic())
+                    try:
+                        item = fetched.get(timeout=timeout)
+                    except queue.Empty:
+                        item = None  # The oldest waiting row is due
+
+                    if isinstance(item, _Failure):
+                        raise item.error
+                    if item is not None and item is not _DONE:
+                        received, df = item
+                        window_ct += 1
+                        if len(df) > 0:
+                            df = ingest_cls.prepare(df)
+                            rows.extend(self.db.df_rows(df))
+                            ingest_cls.after_load(self.db, df)
+                            if oldest is None:
+                                oldest = received
+
+                    if rows and (item is None or item is _DONE or len(rows) >= self.batch_rows
+                                 or time.monotonic() - oldest >= self.max_latency):
+                        self.db.bulk_upsert(table, rows, ingest_cls.COLUMNS)
+                        self.db.conn.commit()
+                        latency = time.monotonic() - oldest
+                        worst_latency = max(worst_latency, latency)
+                        logging.debug("Committed %d %s, %.2fs after the oldest response.", len(rows), prefix, latency)
+                        row_ct += len(rows)
+                        rows = []
+                        oldest = None
+                    if item is _DONE:
+                        break
+        finally:
+            stop.set()
+            while producer.is_alive():  # Unblock a producer waiting on a full queue
+                try:
+                    fetched.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if archive is not None:
+                archive.close()
+
+        logging.info("Streamed %d %s from %d windows into %s; worst response-to-row latency %.2fs.", row_ct, prefix,
+                     window_ct, table, worst_latency)
+        return window_ct, row_ct
+
+
+class _Archiver:
+    """
+    Writes raw windows to staging files on its own thread.
+    """
+
+    def __init__(self, folder, schema, prefix, fmt, queue_size=16):
+        assert folder is not None, "archive needs a folder"
+        self.folder = folder
+        self.schema = schema
+        self.prefix = prefix
+        self.fmt = fmt
+        self.errors = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write, name=f"{prefix}-archive", daemon=True)
+        self._thread.start()
+
+    def put(self, start, end, df):
+        if len(df) > 0:
+            self._queue.put((start, end, df))
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if self.errors:
+                continue  # Keep draining so the producer never blocks on a full queue
+            start, end, df = item
+            output_file = f"{self.prefix}_{start:%Y-%m-%d_%H-%M-%S}_to_{end:%Y-%m-%d_%H-%M-%S}"
+            try:
+                write_staging(df, os.path.join(self.folder, output_file), self.schema, self.fmt)
+            except Exception as e:
+                logging.error("Could not archive %s: %s", output_file, str(e))
+                self.errors.append(e)
+
+    def close(self):
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,240 @@
+import io
+import json
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+REPAID = 'repaid'
+UNPAID = 'unpaid'
+
+# Strata a cohort can be split by
+PRINCIPAL = 'principal'
+HISTORY = 'history'
+CURRENCY = 'currency'
+YEAR = 'year'
+STRATA = (PRINCIPAL, HISTORY, CURRENCY, YEAR)
+
+# Principal buckets in major units, e.g. $0-99, $100-249, ... and prior loans taken by the borrower
+PRINCIPAL_BINS = (0, 100, 250, 500, 1000, np.inf)
+PRINCIPAL_LABELS = ('<100', '100-249', '250-499', '500-999', '1000+')
+HISTORY_BINS = (0, 1, 3, 10, np.inf)
+HISTORY_LABELS = ('first', '1-2', '3-9', '10+')
+
+CURVE_COLUMNS = ['time_days', 'at_risk', 'events', 'censored', 'survival', 'std_err']
+
+# Bump when the way curves are computed changes, so cached curves from older code are not served
+_CURVE_VERSION = 1
+_DAY = 86400.0
+
+
+def durations(loans, event, until=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build censored durations for every loan at once. For the repayment curve a loan's event is being repaid and it
+    is censored when it goes unpaid or is still open; the default curve is the same with the outcomes swapped, so
+    each curve is cause-specific.
+
+    :param loans: DataFrame with created_at, repaid_at, unpaid_at
+    :param event: REPAID or UNPAID
+    :param until: Epoch second open loans are censored at. Defaults to the latest time seen in loans.
+    :return: Tuple(whole days from creation to event or censoring, True where the event was observed)
+    """
+    created = loans['created_at'].to_numpy(dtype='float64', na_value=np.nan)
+    repaid = loans['repaid_at'].to_numpy(dtype='float64', na_value=np.nan)
+    unpaid = loans['unpaid_at'].to_numpy(dtype='float64', na_value=np.nan)
+    if until is None:
+        until = np.nanmax(np.concatenate([created, repaid, unpaid])) if len(created) else 0.0
+    hit, other = (repaid, unpaid) if event == REPAID else (unpaid, repaid)
+    observed = ~np.isnan(hit)
+    end = np.where(observed, hit, np.fmin(other, until))
+    days = np.floor(np.maximum(end - created, 0) / _DAY).astype('int64')
+    return days, observed
+
+
+def kaplan_meier(days, observed, strata=None) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    Kaplan-Meier estimates for every stratum in one pass: loans are counted per (stratum, day) with np.unique and
+    np.bincount, the number at risk is a reverse cumulative sum within each stratum, and the survival product is a
+    cumulative sum of log(1 - d/n) within each stratum. Standard errors use Greenwood's formula.
+
+    :param days: Integer duration per loan
+    :param observed: True where the loan's duration ended in the event rather than censoring
+    :param strata: Integer stratum code per loan; all one stratum if None
+    :return: Tuple(stratum code per row, DataFrame of CURVE_COLUMNS with one row per stratum and day on which any
+    loan's duration ended)
+    """
+    days = np.asarray(days, dtype='int64')
+    observed = np.asarray(observed, dtype=bool)
+    strata = np.zeros(len(days), dtype='int64') if strata is None else np.asarray(strata, dtype='int64')
+    if len(days) == 0:
+        return np.zeros(0, dtype='int64'), pd.DataFrame(columns=CURVE_COLUMNS)
+
+    span = int(days.max()) + 1
+    keys, inverse = np.unique(strata * span + days, return_inverse=True)
+    stratum, t = keys // span, keys % span
+    d = np.bincount(inverse, weights=observed).astype('int64')
+    total = np.bincount(inverse).astype('int64')
+
+    # Row index where each row's stratum starts and ends
+    first = np.flatnonzero(np.r_[True, stratum[1:] != stratum[:-1]])
+    segment = np.repeat(np.arange(len(first)), np.diff(np.r_[first, len(keys)]))
+    start = first[segment]
+    stop = np.r_[first[1:], len(keys)][segment]
+
+    def within(values):
+        # Cumulative sum restarting at every stratum
+        csum = np.cumsum(values)
+        return csum - np.r_[0, csum][start]
+
+    tail = np.r_[np.cumsum(total[::-1])[::-1], 0]
+    n = tail[np.arange(len(keys))] - tail[stop]
+
+    hazard = d / n
+    wiped = hazard >= 1
+    with np.errstate(divide='ignore'):
+        log_step = np.where(wiped, 0.0, np.log1p(-hazard))
+    survival = np.where(within(wiped) > 0, 0.0, np.exp(within(log_step)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        greenwood = within(np.where(n > d, d / (n * (n - d)), 0.0))
+    std_err = np.where(survival > 0, survival * np.sqrt(greenwood), np.nan)
+
+    return stratum, pd.DataFrame({
+        'time_days': t,
+        'at_risk': n,
+        'events': d,
+        'censored': total - d,
+        'survival': survival,
+        'std_err': std_err
+    }, columns=CURVE_COLUMNS)
+
+
+def stratify(loans, by) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    :param loans: DataFrame with the columns the strata need: principal_minor, prior_loans, currency_code,
+    created_at
+    :param by: Sequence of STRATA
+    :return: Tuple(stratum code per loan, DataFrame of the strata's labels indexed by code)
+    """
+    labels = {}
+    for name in by:
+        if name == PRINCIPAL:
+            labels[name] = pd.cut(loans['principal_minor'] / 100, PRINCIPAL_BINS, right=False,
+                                  labels=PRINCIPAL_LABELS).astype(object)
+        elif name == HISTORY:
+            labels[name] = pd.cut(loans['prior_loans'], HISTORY_BINS, right=False,
+                                  labels=HISTORY_LABELS).astype(object)
+        elif name == CURRENCY:
+            labels[name] = loans['currency_code'].astype(object)
+        elif name == YEAR:
+            labels[name] = pd.to_datetime(loans['created_at'], unit='s').dt.year.astype('int64')
+        else:
+            raise ValueError(f"Unknown stratum {name!r}; expected one of {STRATA}")
+    if not labels:
+        return np.zeros(len(loans), dtype='int64'), pd.DataFrame(index=pd.RangeIndex(1))
+    frame = pd.DataFrame(labels).reset_index(drop=True)
+    codes = frame.groupby(list(frame.columns), sort=True, dropna=False).ngroup().to_numpy(dtype='int64')
+    first = np.unique(codes, return_index=True)[1]
+    return codes, frame.iloc[first].reset_index(drop=True)
+
+
+class SurvivalCurves:
+    """
+    Kaplan-Meier time-to-repayment and time-to-default curves of loans, split into strata by principal bucket,
+    borrower history (loans the borrower had taken before), currency and creation year.
+
+    Curves are cached in survival_cache per cohort definition. A cached entry carries the survival_versions of the
+    creation years its cohort covers, which triggers on loans (db.MIGRATIONS) bump, and the time open loans were
+    censored at, so it is only recomputed once a loan in one of those years changes or that time moves on.
+    """
+
+    def __init__(self, db):
+        """
+        :param db: LoansDB
+        """
+        self.db = db
+
+    def curves(self, event=REPAID, by=(), years=None, currency=None, until=None) -> pd.DataFrame:
+        """
+        :param event: REPAID for time to repayment, UNPAID for time to default
+        :param by: Sequence of STRATA to split the cohort by
+        :param years: Only loans created in these years
+        :param currency: Only loans in this currency code
+        :param until: Epoch second the loans were observed at, which open loans are censored at. Defaults to the
+        start of the current UTC day, as durations are whole days, so cached curves last the day.
+        :return: DataFrame of the by columns then CURVE_COLUMNS, one row per stratum and day
+        """
+        if event not in (REPAID, UNPAID):
+            raise ValueError(f"Unknown event {event!r}; expected {REPAID!r} or {UNPAID!r}")
+        by = list(by)
+        years = sorted(int(year) for year in years) if years else None
+        cohort = json.dumps({'event': event, 'by': by, 'years': years, 'currency': currency,
+                             'version': _CURVE_VERSION}, sort_keys=True)
+        if until is None:
+            until = np.floor(time.time() / _DAY) * _DAY
+        fingerprint = self._fingerprint(years, float(until))
+        row = self.db.conn.execute("SELECT fingerprint, curves FROM survival_cache WHERE cohort = ?;",
+                                   (cohort,)).fetchone()
+        if row is not None and row['fingerprint'] == fingerprint:
+            logging.debug("Survival curves for %s served from cache.", cohort)
+            return pd.read_json(io.StringIO(row['curves']), orient='split')
+
+        started = time.monotonic()
+        loans = self._loans(years, currency, HISTORY in by)
+        codes, labels = stratify(loans, by)
+        days, observed = durations(loans, event, until)
+        stratum, curves = kaplan_meier(days, observed, codes)
+        curves = pd.concat([labels.iloc[stratum].reset_index(drop=True), curves], axis=1)
+        with self.db.conn:
+            self.db.conn.execute("INSERT INTO survival_cache (cohort, fingerprint, curves, computed_utc) "
+                                 "VALUES (?, ?, ?, ?) ON CONFLICT (cohort) DO UPDATE SET "
+                                 "fingerprint = excluded.fingerprint, curves = excluded.curves, "
+                                 "computed_utc = excluded.computed_utc;",
+                                 (cohort, fingerprint, curves.to_json(orient='split', index=False, double_precision=15),
+                                  time.time()))
+        logging.info("Computed %s survival curves of %d loans in %d strata in %.1fs.", event, len(loans),
+                     len(labels), time.monotonic() - started)
+        return curves
+
+    def _fingerprint(self, years, until) -> str:
+        rows = self.db.conn.execute("SELECT year, version FROM survival_versions ORDER BY year;").fetchall()
+        return json.dumps({'until': until,
+                           'versions': [[row['year'], row['version']] for row in rows
+                                        if years is None or row['year'] in years]})
+
+    def _loans(self, years, currency, history) -> pd.DataFrame:
+        filters = ["deleted_at IS NULL", "created_at IS NOT NULL"]
+        params = []
+        if years:
+            filters.append("CAST(strftime('%Y', created_at, 'unixepoch') AS INTEGER) IN "
+                           f"({', '.join('?' * len(years))})")
+            params.extend(years)
+        if currency is not None:
+            filters.append("currency_code = ?")
+            params.append(currency)
+        # Loans the borrower had taken before, deleted ones included, counted off the loans_borrower index
+        prior = ("COUNT(*) OVER (PARTITION BY borrower_id ORDER BY created_at "
+                 "ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING)") if history else "0"
+        return self.db.query_df(
+            f"SELECT * FROM (SELECT principal_minor, currency_code, created_at, repaid_at, unpaid_at, deleted_at, "
+            f"{prior} AS prior_loans FROM loans) WHERE {' AND '.join(filters)};", params,
+            dtypes={'principal_minor': 'float64', 'created_at': 'float64', 'repaid_at': 'float64',
+                    'unpaid_at': 'float64', 'prior_loans': 'int64'})
+
+
+def summarize(curves, by=(), days=(7, 30, 90, 180)) -> pd.DataFrame:
+    """
+    :param curves: Output of SurvivalCurves.curves()
+    :param by: The strata the curves were split by
+    :param days: Horizons to report
+    :return: DataFrame of the number of loans per stratum and, per horizon, the estimated fraction of loans whose
+    event happened within that many days (1 - survival)
+    """
+    by = list(by)
+    groups = curves.groupby(by, sort=True, dropna=False) if by else curves.groupby(np.zeros(len(curves)))
+    out = pd.DataFrame({'loans': groups['at_risk'].first()})
+    for day in days:
+        upto = curves[curves['time_days'] <= day]
+        within = upto.groupby(by, sort=True, dropna=False) if by else upto.groupby(np.zeros(len(upto)))
+        out[f'{day}d'] = 1 - within['survival'].last().reindex(out.index).fillna(1.0)
+    return out.reset_index(drop=not by)
@@ -0,0 +1,178 @@
+import logging
+import time
+
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+from historical_gen.columnar import CSV
+from historical_gen.ingest import IngestLoanIDs, IngestSubmissions, IngestComments, IngestLoanBasic, IngestLoanEvents
+from historical_gen.staging import SubmissionRetriever, CommentRetriever
+
+
+class Watermarks:
+    """
+    Per-source high-water marks, persisted in sync_watermarks so each daily run only asks for the delta.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        sql_create_sync_watermarks = """
+        CREATE TABLE IF NOT EXISTS sync_watermarks (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER,
+            last_utc REAL,
+            updated_utc REAL
+        );
+        """
+        with self.db.conn:
+            self.db.conn.execute(sql_create_sync_watermarks)
+
+    def get(self, source):
+        c = self.db.conn.execute("SELECT source, last_id, last_utc, updated_utc FROM sync_watermarks "
+                                 "WHERE source = ?;", (source,))
+        return c.fetchone()
+
+    def set(self, source, last_id=None, last_utc=None):
+        with self.db.conn:
+            self.db.conn.execute("INSERT INTO sync_watermarks (source, last_id, last_utc, updated_utc) "
+                                 "VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id, "
+                                 "last_utc = excluded.last_utc, updated_utc = excluded.updated_utc;",
+                                 (source, last_id, last_utc, time.time()))
+
+
+class IncrementalSync:
+    """
+    Daily sync. Each source resumes from its watermark (minus a small overlap for late arrivals):
+
+    - loansbot: /api/loans calls, a window at a time, for ids created since the last run, then /detailed for the
+      new ids plus every still-open loan created in the last repoll_days, since repayment/unpaid/admin events may
+      have landed.
+    - submissions / comments: Pushshift windows from the last created_utc seen up to now.
+
+    The first run of a source starts from start_date.
+    """
+
+    LOANSBOT = 'loansbot'
+    SUBMISSIONS = 'submissions'
+    COMMENTS = 'comments'
+    SOURCES = (LOANSBOT, SUBMISSIONS, COMMENTS)
+
+    def __init__(self, db, loan_retriever, journal, folders: dict, start_date='2014-09-17', repoll_days=30,
+                 overlap=3600, timeout=60, delay=1, cache=None, adaptive=False, window_workers=1,
+                 staging_format=CSV, stream=None, max_connections=1, rate=None):
+        """
+        :param db: LoansDB
+        :param loan_retriever: LoansRetriever used for the loansbot source
+        :param journal: LoanFetchJournal shared with the backfill
+        :param folders: Staging folders keyed by 'submissions', 'comments', 'loan_ids', 'loan_basic', 'loan_events'
+        :param start_date: Where a source without a watermark starts, as 'YYYY-MM-DD'
+        :param repoll_days: Open loans created within this many days are fetched again on every run
+        :param overlap: Seconds to re-cover before each watermark
+        :param timeout: Timeout for Pushshift requests
+        :param delay: Delay between Pushshift requests
+        :param cache: Optional ResponseCache for the Pushshift requests
+        :param adaptive: Size Pushshift windows adaptively instead of fixed day / 12h windows
+        :param window_workers: Fetch this many fixed Pushshift windows concurrently
+        :param staging_format: Format of the staged submission / comment files
+        :param stream: Optional StreamingIngest. Submissions / comments then go straight into their staging_*_raw
+        tables as they are fetched, over fixed windows.
+        :param max_connections: Connections the loan detail fetch keeps open
+        :param rate: Loan detail requests per second. Defaults to the retriever's 1 / delay_minor.
+        """
+        self.db = db
+        self.loan_retriever = loan_retriever
+        self.journal = journal
+        self.folders = folders
+        self.start_ts = pd.Timestamp(start_date).timestamp()
+        self.repoll_days = repoll_days
+        self.overlap = overlap
+        self.timeout = timeout
+        self.delay = delay
+        self.cache = cache
+        self.adaptive = adaptive
+        self.window_workers = window_workers
+        self.staging_format = staging_format
+        self.stream = stream
+        self.max_connections = max_connections
+        self.rate = rate
+        self.watermarks = Watermarks(db)
+
+    def run(self, sources=SOURCES) -> dict:
+        """
+        :param sources: Which sources to sync
+        :return: Dict of source -> summary of what was fetched
+        """
+        summary = {}
+        for source in sources:
+            started = time.monotonic()
+            if source == self.LOANSBOT:
+                summary[source] = self.sync_loans()
+            elif source in (self.SUBMISSIONS, self.COMMENTS):
+                summary[source] = self.sync_reddit(source)
+            else:
+                raise ValueError(f"Unknown sync source {source}")
+            logging.info("Synced %s in %.1fs: %s", source, time.monotonic() - started, summary[source])
+        return summary
+
+    def sync_loans(self):
+        wm = self.watermarks.get(self.LOANSBOT)
+        now = time.time()
+        after = wm['last_utc'] - self.overlap if wm is not None else self.start_ts
+
+        ids = self.loan_retriever.fetch_loan_ids_between(after, now, self.folders['loan_ids'])
+        if ids is None:
+            return None  # Some window failed: leave the watermark where it was and try again next run
+
+        with self.db.conn:
+            self.db.conn.execute(IngestLoanIDs.SQL_CREATE)
+        self.db.bulk_upsert('staging_loan_ids', [(int(elm),) for elm in ids], ['id'])
+        self.journal.seed(ids)
+
+        repoll = self.journal.open_since(now - self.repoll_days * 24 * 60 * 60)
+        self.journal.requeue(repoll)
+
+        to_fetch = self.journal.pending() + self.journal.retry_queue()
+        (fetched, _), _ = self.loan_retriever.fetch_loans_by_id_list_async(
+            to_fetch, self.folders['loan_basic'], self.folders['loan_events'], max_connections=self.max_connections,
+            rate=self.rate, journal=self.journal)
+        IngestLoanBasic(self.folders['loan_basic'], self.db).ingest()
+        IngestLoanEvents(self.folders['loan_events'], self.db).ingest()
+
+        last_id = max([int(elm) for elm in ids] + ([wm['last_id']] if wm is not None and wm['last_id'] else []),
+                      default=None)
+        self.watermarks.set(self.LOANSBOT, last_id=last_id, last_utc=now)
+        return {'ids_listed': len(ids), 'repolled': len(repoll), 'fetched': fetched, 'last_id': last_id}
+
+    def sync_reddit(self, source):
+        wm = self.watermarks.get(source)
+        since = wm['last_utc'] - self.overlap if wm is not None else self.start_ts
+
+        # Align windows to the same boundaries as a backfill so a re-fetched window is a superset of the old file
+        freq = 'd' if source == self.SUBMISSIONS else '12H'
+        start = pd.Timestamp(since, unit='s').floor(freq)
+        end = pd.Timestamp(time.time(), unit='s').ceil(freq)
+        if end <= start:
+            end = start + pd.Timedelta(to_offset(freq))
+
+        if source == self.SUBMISSIONS:
+            retriever = SubmissionRetriever(start, end, timeout=self.timeout, delay=self.delay,
+                                            cache=self.cache, fmt=self.staging_format)
+            ingest_cls = IngestSubmissions
+        else:
+            retriever = CommentRetriever(start, end, timeout=self.timeout, delay=self.delay,
+                                         cache=self.cache, fmt=self.staging_format)
+            ingest_cls = IngestComments
+
+        if self.stream is not None:
+            windows = self.stream.run(ingest_cls, retriever.iter_windows(freq), source, self.folders[source])
+        elif source == self.SUBMISSIONS:
+            windows = retriever.fetch_submissions(self.folders['submissions'], freq=freq,
+                                                  adaptive=self.adaptive, workers=self.window_workers)
+        else:
+            windows = retriever.fetch_comments(self.folders['comments'], freq=freq, adaptive=self.adaptive,
+                                               workers=self.window_workers)
+
+        if retriever.max_created_utc is not None:
+            self.watermarks.set(source, last_utc=retriever.max_created_utc)
+        return {'windows': windows, 'last_utc': retriever.max_created_utc}
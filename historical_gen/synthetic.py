@@ -0,0 +1,406 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+from historical_gen.columnar import CSV, write_staging
+from historical_gen.ingest import IngestComments, IngestLoanBasic, IngestLoanEvents, IngestSubmissions
+
+# Currency code, symbol, share of loans
+CURRENCIES = (
+    ('USD', '$', 0.86),
+    ('CAD', '$', 0.04),
+    ('GBP', '£', 0.04),
+    ('EUR', '€', 0.04),
+    ('AUD', '$', 0.02),
+)
+
+# Share of loans ending each way. Loans whose outcome would come after the end of the period stay open.
+OUTCOMES = {'repaid': 0.84, 'unpaid': 0.10, 'open': 0.03, 'deleted': 0.03}
+ADMIN_SHARE = 0.02  # Loans with an admin correction of their principal or repaid total
+
+LOCATIONS = ('Houston, TX, USA', 'Melvindale, MI, USA', 'Barrie, Ontario, Canada', 'Leeds, UK', 'Phoenix, AZ, USA',
+             'Berlin, Germany', 'Tampa, FL, USA', 'Brisbane, QLD, Australia', 'Columbus, OH, USA', 'Dublin, Ireland')
+PAYMENT_METHODS = ('PayPal', 'Venmo', 'Cash App', 'Zelle', 'PayPal or Zelle', 'Apple Pay')
+FILLERS = (('I can do $', ' if you still need it, check chat'), ('PM sent for $', ''), ('Sent a chat request', ''),
+           ("What's your repayment plan for the $", '?'), ('Can you do $', ' instead?'), ('Interested, chat sent', ''),
+           ('[deleted]', ''), ('Still need the $', '?'))
+
+BOT = 'LoansBot'
+_SUBREDDIT_ID = 't5_33lr0'
+_FIRST_THREAD = int('5000000', 36)  # Seven base 36 digits, like real ids of the period
+_FIRST_COMMENT = int('c000000', 36)
+_DIGITS = np.array(list('0123456789abcdefghijklmnopqrstuvwxyz'))
+_DAY = 86400.0
+
+
+def base36(numbers, width=7) -> np.ndarray:
+    """
+    :return: Zero padded, lowercase base 36 strings of numbers, e.g. Reddit ids
+    """
+    numbers = np.asarray(numbers, dtype='int64')
+    digits = np.empty((len(numbers), width), dtype='<U1')
+    for i in range(width - 1, -1, -1):
+        numbers, rem = np.divmod(numbers, 36)
+        digits[:, i] = _DIGITS[rem]
+    return digits.view(f'<U{width}').ravel().astype(object)
+
+
+def _str(values) -> np.ndarray:
+    return np.asarray(values).astype(str).astype(object)
+
+
+def _dates(epochs) -> np.ndarray:
+    # utc_datetime_str as the dumps have it, '2023-04-22 23:56:43'
+    text = np.datetime_as_string(np.asarray(epochs, dtype='int64').astype('datetime64[s]'), unit='s')
+    chars = text.astype('<U19').view('<U1').reshape(len(text), 19)
+    chars[:, 10] = ' '
+    return chars.view('<U19').ravel().astype(object)
+
+
+class SyntheticBorrow:
+    """
+    Seeded generator of realistic r/borrow data at any scale: [REQ] submissions, the $loan / $confirm / $paid /
+    $unpaid comments in their threads among plenty of chatter, and LoansBot /detailed loans with their creation,
+    repayment, unpaid and admin events, in several currencies.
+
+    Lending is skewed the way the subreddit's is: a few prolific lenders make most loans and borrowers come back,
+    both drawn from Zipf-like weights. Everything is generated with NumPy in batches covering consecutive slices of
+    time, so millions of rows take seconds and memory stays bounded by the batch. The same seed, sizes and number
+    of batches always give the same data.
+    """
+
+    def __init__(self, loans=10000, submissions=None, comments=None, users=None, start='2015-01-01',
+                 end='2023-06-01', seed=0):
+        """
+        :param loans: Loans in total
+        :param submissions: Submissions in total, at least one per loan. Defaults to 3 per loan.
+        :param comments: Comments in total. Loan commands take up to 3 per loan and the rest are chatter.
+        Defaults to 20 per loan.
+        :param users: Distinct users. Defaults to a third of the loans.
+        :param start: First day of the period, as "YYYY-MM-DD"
+        :param end: Day after the period, as "YYYY-MM-DD"
+        :param seed: Random seed
+        """
+        self.loans = loans
+        self.submissions = max(submissions if submissions is not None else 3 * loans, loans)
+        self.comments = comments if comments is not None else 20 * loans
+        self.users = max(users if users is not None else loans // 3, 100)
+        self.start = datetime.datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.end = datetime.datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.names = np.char.add('u_', base36(rng.permutation(self.users) + 36 ** 5, width=6).astype(str))
+        self.names = self.names.astype(object)
+        ranks = np.arange(1, self.users + 1)
+        # Lenders are a small pool where the top few make most loans; any user may borrow, some often
+        lenders = max(self.users // 20, 10)
+        self.lender_weights = np.zeros(self.users)
+        self.lender_weights[:lenders] = ranks[:lenders] ** -1.1
+        self.lender_weights /= self.lender_weights.sum()
+        self.borrower_weights = rng.permutation(ranks ** -0.8)
+        self.borrower_weights /= self.borrower_weights.sum()
+
+    def batches(self, n=1):
+        """
+        :param n: Number of batches
+        :return: Generator of dicts of 'submissions', 'comments', 'loan_basic' and 'loan_events' DataFrames in the
+        columns of their staging tables, each batch the loans created in the next 1/n of the period with their
+        threads. Later events of a loan, like its repayment, come in the batch it was created in, as when the
+        loan is fetched after the fact.
+        """
+        threads = comments = 0
+        for i in range(n):
+            lo, hi = self.loans * i // n, self.loans * (i + 1) // n
+            rng = np.random.default_rng([self.seed, i])
+            batch = self._batch(rng, lo, hi, self.submissions * (i + 1) // n - threads,
+                                self.comments * (i + 1) // n - comments, threads, comments, i, n)
+            threads += len(batch['submissions'])
+            comments += len(batch['comments'])
+            yield batch
+
+    def _batch(self, rng, lo, hi, n_submissions, n_comments, first_thread, first_comment, i, n) -> dict:
+        span = (self.end - self.start) / n
+        since = self.start + i * span
+        k = hi - lo
+        loans = self._loans(rng, np.arange(lo + 1, hi + 1), np.sort(rng.uniform(since, since + span, k)))
+        thread_ids = base36(_FIRST_THREAD + first_thread + np.arange(n_submissions))
+        submissions = self._submissions(rng, loans, thread_ids, since, span)
+        comments, loans['creation_comment'] = self._comments(rng, loans, submissions, n_comments, first_comment)
+        return {
+            'submissions': submissions.reindex(columns=IngestSubmissions.COLUMNS),
+            'comments': comments.reindex(columns=IngestComments.COLUMNS),
+            'loan_basic': loans.reindex(columns=IngestLoanBasic.COLUMNS),
+            'loan_events': self._events(rng, loans).reindex(columns=IngestLoanEvents.COLUMNS)
+        }
+
+    def _loans(self, rng, loan_ids, created) -> pd.DataFrame:
+        k = len(loan_ids)
+        lender = rng.choice(self.users, size=k, p=self.lender_weights)
+        borrower = rng.choice(self.users, size=k, p=self.borrower_weights)
+        borrower = np.where(borrower == lender, (borrower + 1) % self.users, borrower)
+        currency = rng.choice(len(CURRENCIES), size=k, p=[share for _, _, share in CURRENCIES])
+        # $20 to $5,000 in tens, most around $150
+        principal = np.clip(np.round(rng.lognormal(np.log(15), 0.8, k)) * 10, 20, 5000) * 100
+        owed = np.round(principal * (1 + rng.uniform(0.05, 0.35, k)) / 100) * 100
+
+        outcome = rng.choice(list(OUTCOMES), size=k, p=list(OUTCOMES.values()))
+        repaid_at = created + rng.lognormal(np.log(21), 0.7, k) * _DAY
+        unpaid_at = created + rng.lognormal(np.log(45), 0.5, k) * _DAY
+        outcome = np.where(((outcome == 'repaid') & (repaid_at > self.end))
+                           | ((outcome == 'unpaid') & (unpaid_at > self.end)), 'open', outcome)
+        # What was paid back: all of it, or part of it for some unpaid and open loans
+        partial = np.where(rng.random(k) < 0.4, np.round(owed * rng.uniform(0.1, 0.6, k) / 100) * 100, 0)
+        repaid = np.select([outcome == 'repaid', outcome == 'deleted'], [owed, 0], partial)
+        last_repaid_at = np.select([outcome == 'repaid', outcome == 'unpaid'],
+                                   [repaid_at, created + (unpaid_at - created) / 2],
+                                   created + rng.uniform(1, 10, k) * _DAY)
+        last_repaid_at = np.maximum(np.minimum(last_repaid_at, self.end - 1), created + 60)
+        last_repaid_at = np.where(repaid > 0, last_repaid_at, np.nan)
+        return pd.DataFrame({
+            'loan_id': loan_ids,
+            'lender': self.names[lender],
+            'borrower': self.names[borrower],
+            'currency_code': np.array([code for code, _, _ in CURRENCIES], dtype=object)[currency],
+            'currency_symbol': np.array([symbol for _, symbol, _ in CURRENCIES], dtype=object)[currency],
+            'currency_symbol_on_left': 1,
+            'currency_exponent': 2,
+            'principal_minor': principal.astype('int64'),
+            'principal_repayment_minor': repaid.astype('int64'),
+            'created_at': np.round(created, 3),
+            'last_repaid_at': np.round(last_repaid_at, 3),
+            'repaid_at': np.where(outcome == 'repaid', np.round(repaid_at, 3), np.nan),
+            'unpaid_at': np.where(outcome == 'unpaid', np.round(unpaid_at, 3), np.nan),
+            'deleted_at': np.where(outcome == 'deleted', np.round(created + 3600, 3), np.nan),
+            'owed_minor': owed.astype('int64'),
+            'outcome': outcome
+        })
+
+    def _submissions(self, rng, loans, thread_ids, since, span) -> pd.DataFrame:
+        """
+        One [REQ] thread per loan, made by its borrower shortly before the loan, then unfunded requests and
+        [PAID] / [UNPAID] / [META] posts.
+        """
+        k, total = len(loans), len(thread_ids)
+        created = np.empty(total)
+        created[:k] = loans['created_at'].to_numpy() - rng.uniform(0.5, 48, k) * 3600
+        created[k:] = rng.uniform(since, since + span, total - k)
+        author = np.empty(total, dtype=object)
+        author[:k] = loans['borrower'].to_numpy()
+        author[k:] = self.names[rng.choice(self.users, size=total - k, p=self.borrower_weights)]
+        amount = np.empty(total, dtype='int64')
+        amount[:k] = loans['principal_minor'].to_numpy() // 100
+        amount[k:] = np.clip(np.round(rng.lognormal(np.log(15), 0.8, total - k)) * 10, 20, 5000)
+        owed = np.empty(total, dtype='int64')
+        owed[:k] = loans['owed_minor'].to_numpy() // 100
+        owed[k:] = np.round(amount[k:] * rng.uniform(1.05, 1.35, total - k))
+        post_type = np.full(total, 'REQ', dtype=object)
+        post_type[k:] = rng.choice(['REQ', 'PAID', 'UNPAID', 'META'], size=total - k, p=[0.7, 0.2, 0.05, 0.05])
+
+        due = pd.to_datetime(created + rng.uniform(14, 45, total) * _DAY, unit='s')
+        location = np.array(LOCATIONS, dtype=object)[rng.integers(len(LOCATIONS), size=total)]
+        method = np.array(PAYMENT_METHODS, dtype=object)[rng.integers(len(PAYMENT_METHODS), size=total)]
+        title = ('[' + post_type + '] ($' + _str(amount) + ') - (#' + location + ') (Repay $' + _str(owed)
+                 + ' by ' + _str(due.month) + '/' + _str(due.day) + '/' + _str(due.year % 100) + ') ('
+                 + method + ')')
+        other = post_type != 'REQ'
+        title[other] = '[' + post_type[other] + '] (/u/' + author[other] + ') ($' + _str(amount[other]) + ')'
+        title[post_type == 'META'] = '[META] Question about ' + method[post_type == 'META']
+        slug = 'req_' + _str(amount) + '_' + np.char.replace(np.char.lower(location.astype(str)), ', ', '_')
+        permalink = '/r/borrow/comments/' + thread_ids + '/' + slug.astype(object) + '/'
+        created = created.astype('int64')
+        return pd.DataFrame({
+            'selftext': 'Repayment via ' + method + '. Happy to answer any questions.',
+            'author_fullname': 't2_' + author,
+            'title': title,
+            'link_flair_text': np.where(post_type == 'REQ', None, post_type),
+            'score': 1,
+            'upvote_ratio': '1.0',
+            'is_self': 1,
+            'domain': 'self.borrow',
+            'subreddit_id': _SUBREDDIT_ID,
+            'id': thread_ids,
+            'author': author,
+            'num_comments': 0,
+            'permalink': permalink,
+            'url': 'https://www.reddit.com' + permalink,
+            'created_utc': created,
+            'retrieved_utc': created + 12,
+            'updated_utc': created + 13,
+            'utc_datetime_str': _dates(created)
+        })
+
+    def _comments(self, rng, loans, submissions, n_comments, first_comment) -> tuple[pd.DataFrame, np.ndarray]:
+        """
+        :return: Tuple(comments, permalink of each loan's $loan comment). Per loan: the lender's $loan, LoansBot's
+        reply, the borrower's $confirm, then $paid or $unpaid, by the lender, for loans that ended so. Chatter
+        spread over every thread fills up to n_comments.
+        """
+        k = len(loans)
+        code = loans['currency_code'].to_numpy()
+        amount = _str(loans['principal_minor'].to_numpy() // 100)
+        amount = np.where(code == 'USD', amount, amount + ' ' + code)
+        lender, borrower = loans['lender'].to_numpy(), loans['borrower'].to_numpy()
+        created = loans['created_at'].to_numpy()
+        outcome = loans['outcome'].to_numpy()
+        settled = np.isin(outcome, ['repaid', 'unpaid'])
+        settled_at = np.where(outcome == 'repaid', loans['repaid_at'].to_numpy(), loans['unpaid_at'].to_numpy())
+        repaid = _str(loans['principal_repayment_minor'].to_numpy() // 100)
+
+        parts = [
+            # thread index, author, body, created, parent (-1 for the thread), nest level
+            (np.arange(k), lender, '$loan ' + amount, created - 1, None, 1),
+            (np.arange(k), np.full(k, BOT, dtype=object),
+             'Noted! I will remember that /u/' + lender + ' lent ' + amount + ' to /u/' + borrower + '.',
+             created + 20, 0, 2),
+            (np.arange(k), borrower, '$confirm /u/' + lender + ' ' + amount, created + rng.uniform(1, 12, k) * 3600,
+             1, 3),
+        ]
+        paid = np.flatnonzero(settled)
+        body = np.where(outcome[paid] == 'repaid', '$paid /u/' + borrower[paid] + ' ' + repaid[paid],
+                        '$unpaid /u/' + borrower[paid])
+        parts.append((paid, lender[paid], body, settled_at[paid] - 60, None, 1))
+        used = 3 * k + len(paid)
+        chatter = max(n_comments - used, 0)
+        if chatter:
+            on = rng.integers(len(submissions), size=chatter)
+            pick = rng.integers(len(FILLERS), size=chatter)
+            prefix = np.array([p for p, _ in FILLERS], dtype=object)[pick]
+            suffix = np.array([s for _, s in FILLERS], dtype=object)[pick]
+            with_amount = suffix != ''
+            text = prefix.copy()
+            text[with_amount] = prefix[with_amount] + _str(rng.integers(2, 50, with_amount.sum()) * 10) \
+                + suffix[with_amount]
+            authors = self.names[rng.choice(self.users, size=chatter, p=self.lender_weights)]
+            parts.append((on, authors, text, submissions['created_utc'].to_numpy()[on]
+                          + rng.uniform(60, 3 * _DAY, chatter), None, 1))
+
+        sizes = [len(part[0]) for part in parts]
+        ids = base36(_FIRST_COMMENT + first_comment + np.arange(sum(sizes)))
+        offsets = np.cumsum([0] + sizes)
+        thread_of = np.concatenate([part[0] for part in parts])
+        parent = np.concatenate([
+            np.full(size, None, dtype=object) if part[4] is None
+            else 't1_' + ids[offsets[part[4]]:offsets[part[4]] + size]
+            for part, size in zip(parts, sizes)])
+        links = submissions['id'].to_numpy()[thread_of]
+        parent = np.where(pd.isna(parent), 't3_' + links, parent)
+        authors = np.concatenate([part[1] for part in parts])
+        slugs = submissions['permalink'].to_numpy()[thread_of]
+        permalink = slugs + ids + '/'
+        at = np.concatenate([part[3] for part in parts]).astype('int64')
+        comments = pd.DataFrame({
+            'id': ids,
+            'permalink': permalink,
+            'link_id': 't3_' + links,
+            'author': authors,
+            'author_fullname': 't2_' + authors,
+            'body': np.concatenate([part[2] for part in parts]),
+            'created_utc': at,
+            'retrieved_utc': at + 30,
+            'updated_utc': at + 31,
+            'utc_datetime_str': _dates(at),
+            'nest_level': np.concatenate([np.full(size, part[5]) for part, size in zip(parts, sizes)]),
+            'is_submitter': authors == submissions['author'].to_numpy()[thread_of],
+            'parent_id': parent
+        })
+        return comments, 'https://www.reddit.com' + permalink[:k]
+
+    def _events(self, rng, loans) -> pd.DataFrame:
+        """
+        Creation, repayments (one to three for a repaid loan, one for a partly repaid one), unpaid and admin
+        events, whose repayments add up to the loan's principal_repayment_minor.
+        """
+        k = len(loans)
+        ids = loans['loan_id'].to_numpy()
+        created = loans['created_at'].to_numpy()
+        repaid = loans['principal_repayment_minor'].to_numpy()
+        last = loans['last_repaid_at'].to_numpy()
+        principal = loans['principal_minor'].to_numpy()
+        outcome = loans['outcome'].to_numpy()
+        frames = [pd.DataFrame({'loan_id': ids, 'event_type': 'creation', 'occurred_at': created,
+                                'creation_type': 0, 'creation_permalink': loans['creation_comment']})]
+
+        # A mistyped principal fixed an hour in, or a repaid total an admin raised by a unit the day after the
+        # last payment, which then fell that much short
+        admin = np.flatnonzero(rng.random(k) < ADMIN_SHARE)
+        fix_principal = rng.random(len(admin)) < 0.5
+        fix_repaid = admin[~fix_principal]
+        fix_repaid = fix_repaid[repaid[fix_repaid] >= 200]
+        short = np.zeros(k)
+        short[fix_repaid] = 100
+
+        # Split each loan's repaid total into up to three payments, the last at last_repaid_at
+        payments = np.where(outcome == 'repaid', rng.choice([1, 2, 3], size=k, p=[0.7, 0.2, 0.1]), 1)
+        payments = np.where(repaid - short > 0, payments, 0)
+        paid = repaid - short
+        which = np.repeat(np.arange(k), payments)
+        nth = np.arange(len(which)) - np.repeat(np.cumsum(payments) - payments, payments) + 1
+        share = np.floor(paid[which] / payments[which] / 100) * 100
+        amount = np.where(nth == payments[which], paid[which] - share * (payments[which] - 1), share)
+        at = created[which] + (last[which] - created[which]) * nth / payments[which]
+        frames.append(pd.DataFrame({'loan_id': ids[which], 'event_type': 'repayment', 'occurred_at': np.round(at, 3),
+                                    'repayment_minor': amount.astype('int64')}))
+
+        unpaid = outcome == 'unpaid'
+        frames.append(pd.DataFrame({'loan_id': ids[unpaid], 'event_type': 'unpaid',
+                                    'occurred_at': loans['unpaid_at'].to_numpy()[unpaid], 'unpaid': 1}))
+
+        on = admin[fix_principal]
+        frames.append(pd.DataFrame({'loan_id': ids[on], 'event_type': 'admin', 'occurred_at': created[on] + 3600,
+                                    'old_principal_minor': principal[on] * 10, 'new_principal_minor': principal[on],
+                                    'old_principal_repayment_minor': repaid[on] * 0,
+                                    'new_principal_repayment_minor': repaid[on] * 0}))
+        on = fix_repaid
+        frames.append(pd.DataFrame({'loan_id': ids[on], 'event_type': 'admin', 'occurred_at': last[on] + _DAY,
+                                    'old_principal_minor': principal[on], 'new_principal_minor': principal[on],
+                                    'old_principal_repayment_minor': repaid[on] - 100,
+                                    'new_principal_repayment_minor': repaid[on]}))
+        events = pd.concat(frames, ignore_index=True)
+        events = events.sort_values(['loan_id', 'occurred_at'], kind='stable').reset_index(drop=True)
+        return events.reindex(columns=IngestLoanEvents.COLUMNS)
+
+
+def detailed_payloads(loan_basic, loan_events):
+    """
+    :return: Generator of (loan id, /api/loans/{id}/detailed response body) for the loans of a batch, e.g. to serve
+    from a stand-in LoansBot for LoansRetriever.
+    """
+    basic_columns = [col for col in IngestLoanBasic.COLUMNS if col != 'loan_id']
+    def plain(df, schema):
+        # Python ints, floats, strings and None, as json.loads would give
+        df = schema.conform(df).astype(object)
+        return df.where(df.notna(), None)
+
+    events = plain(loan_events, IngestLoanEvents.SCHEMA)
+    by_loan = dict(iter(events.groupby('loan_id', sort=False)))
+    for row in plain(loan_basic, IngestLoanBasic.SCHEMA).itertuples(index=False):
+        row = row._asdict()
+        loan_events = by_loan.get(row['loan_id'])
+        yield row['loan_id'], {
+            'basic': {col: row[col] for col in basic_columns},
+            'events': [] if loan_events is None else [
+                {col: value for col, value in event.items() if col != 'loan_id' and value is not None}
+                for event in loan_events.to_dict('records')]
+        }
+
+
+def write_batch(batch, folders, name, fmt=CSV) -> dict:
+    """
+    Stage a batch for ingest the way the fetchers would.
+
+    :param batch: One of SyntheticBorrow.batches()
+    :param folders: Dict of 'submissions', 'comments', 'loan_basic', 'loan_events' -> staging folder
+    :param name: Distinguishes this batch's files from the others', e.g. its zero padded number
+    :param fmt: CSV or PARQUET
+    :return: Dict of the same keys -> path written
+    """
+    schemas = {'submissions': IngestSubmissions.SCHEMA, 'comments': IngestComments.SCHEMA,
+               'loan_basic': IngestLoanBasic.SCHEMA, 'loan_events': IngestLoanEvents.SCHEMA}
+    paths = {}
+    for key, schema in schemas.items():
+        os.makedirs(folders[key], exist_ok=True)
+        paths[key] = write_staging(batch[key], os.path.join(folders[key], f"{key}_synthetic_{name}"), schema, fmt)
+    return paths
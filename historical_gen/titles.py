@@ -0,0 +1,270 @@
+import logging
+import re
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from historical_gen.commands import CURRENCY_CODES, CURRENCY_SYMBOLS
+from historical_gen.ingest import IngestSubmissions
+
+POST_TYPES = ('REQ', 'PAID', 'UNPAID', 'LATE', 'META', 'OFFER')
+
+_AMOUNT = r'\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?'
+_CODES = '|'.join(CURRENCY_CODES)
+_MONTHS = {name: i + 1 for i, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))}
+_MONTH_NAMES = '|'.join(_MONTHS)
+
+# [REQ], {Req}, REQ], [paid] ... at the start of the title
+POST_TYPE_PATTERN = re.compile(r'^\W*(?P<post_type>' + '|'.join(POST_TYPES) + r')\b', re.IGNORECASE)
+
+# The first amount in the title is the one requested: ($1000), (100), ($300 CAD), (200$), (£100)
+AMOUNT_PATTERN = re.compile(r"""
+    (?<![\w#/.,$€£])(?P<symbol>[$€£])?\s?(?P<amount>""" + _AMOUNT + r""")(?![\d.\-]|/\d)
+    \s?(?P<symbol_after>[$€£])?(?:\s?(?P<code>""" + _CODES + r"""))?(?![A-Za-z])
+    """, re.IGNORECASE | re.VERBOSE)
+
+# Repay $1200, repayment of 450, pay back $250, ($500 repayment
+REPAY_PATTERN = re.compile(r"""
+    (?:repay(?:ment)?(?:\s+of)?|pay\s*back)\s*[:\-]?\s*[$€£]?\s?(?P<repay>""" + _AMOUNT + r""")(?![\d/.\-])
+  | [$€£]\s?(?P<repay_before>""" + _AMOUNT + r""")\s*(?:""" + _CODES + r""")?\s*repay
+    """, re.IGNORECASE | re.VERBOSE)
+
+# 05/23/2023, 4/28/23, 5/1, 2023-05-05, 04-28-2023, May 4, 2023, April 27, 28APR2023
+DATE_PATTERN = re.compile(r"""
+    (?<![\d$€£.,])(?:
+        (?=\d)(?:
+            (?P<iso_y>20\d{2})-(?P<iso_m>\d{1,2})-(?P<iso_d>\d{1,2})
+          | (?P<m>\d{1,2})[/\-](?P<d>\d{1,2})(?:[/\-](?P<y>\d{4}|\d{2}))?(?![\d/])
+          | (?P<day_d>\d{1,2})\s?(?P<day_m>""" + _MONTH_NAMES + r""")[a-z]*\s?(?P<day_y>20\d{2})?
+        )
+      | (?P<name_m>""" + _MONTH_NAMES + r""")[a-z]*\.?\s?(?P<name_d>\d{1,2})(?!\d)
+        (?:st|nd|rd|th)?(?:,?\s(?P<name_y>20\d{2}))?
+    )
+    """, re.IGNORECASE | re.VERBOSE)
+
+# (#Melvindale, MI, USA), [#Moncton New Brunswick Canada], #Mesa,AZ,USA)|
+LOCATION_PATTERN = re.compile(r'#\s*(?P<location>[^()\[\]|#]+?)[\s,]*[)\]|]')
+
+SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS submission_titles (
+        id TEXT PRIMARY KEY,
+        post_type TEXT,
+        amount REAL,
+        amount_minor INTEGER,
+        currency TEXT,
+        repay_amount REAL,
+        repay_minor INTEGER,
+        due_date TEXT,
+        location TEXT,
+        payment_methods TEXT,
+        created_utc INTEGER
+    );
+    """
+
+COLUMNS = ['id', 'post_type', 'amount', 'amount_minor', 'currency', 'repay_amount', 'repay_minor', 'due_date',
+           'location', 'payment_methods', 'created_utc']
+
+
+class AliasMatcher:
+    """
+    Aho-Corasick automaton over a list of aliases, so every alias in a text is found in one pass over its characters
+    rather than one substring scan per alias. Matching is case-insensitive and only counts whole words, so "wise"
+    does not match "otherwise". Each alias maps to a canonical name: the alias with everything but letters and
+    digits removed, so "cash app", "Cashapp" and "CASH-APP" are all "cashapp".
+    """
+
+    def __init__(self, aliases):
+        """
+        :param aliases: Iterable of alias strings
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # State -> [(alias length, canonical name)]
+        for alias in aliases:
+            alias = alias.strip().lower()
+            if alias:
+                self._add(alias, re.sub(r'[^a-z0-9]', '', alias))
+        self._build()
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        :param path: Text file of one alias per line, e.g. pmt_methods.txt
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(f.read().splitlines())
+
+    def _add(self, alias, canonical):
+        state = 0
+        for ch in alias:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][ch] = nxt
+            state = nxt
+        self.out[state].append((len(alias), canonical))
+
+    def _build(self):
+        # Breadth-first, so a state's fail link and transitions are final before its children need them. Every
+        # state then gets a transition for every character of the aliases, making the automaton a DFA that never
+        # follows fail links while matching.
+        alphabet = set().union(*self.goto)
+        self.delta = [dict(self.goto[0])] + [None] * (len(self.goto) - 1)
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            f = self.fail[state]
+            self.out[state] = self.out[state] + self.out[f]
+            row = {}
+            for ch in alphabet:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = self.delta[f].get(ch, 0)
+                else:
+                    self.fail[nxt] = self.delta[f].get(ch, 0)
+                    pending.append(nxt)
+                if nxt:
+                    row[ch] = nxt
+            self.delta[state] = row
+
+    def find(self, text) -> list[str]:
+        """
+        :return: Canonical names of the aliases in text, in order of first appearance, without repeats
+        """
+        text = text.lower()
+        delta, out = self.delta, self.out
+        found = []
+        state = 0
+        for i, ch in enumerate(text):
+            state = delta[state].get(ch, 0)
+            if not out[state]:
+                continue
+            for length, canonical in out[state]:
+                start = i - length + 1
+                if ((start == 0 or not text[start - 1].isalnum())
+                        and (i + 1 == len(text) or not text[i + 1].isalnum())
+                        and canonical not in found):
+                    found.append(canonical)
+        return found
+
+
+def _minor(amount):
+    return (amount * 100).round().astype('Int64')
+
+
+def _due_dates(titles, created_utc) -> pd.Series:
+    """
+    :return: The last date mentioned in each title as YYYY-MM-DD, or null. A date without a year is taken to be
+    the first one on or after a month before the post was made.
+    """
+    found = titles.str.extractall(DATE_PATTERN)
+    if len(found) == 0:
+        return pd.Series(pd.NA, index=titles.index, dtype='string')
+    found = found.groupby(level=0).last()
+
+    def num(*cols):
+        s = pd.Series(np.nan, index=found.index)
+        for col in cols:
+            s = s.fillna(pd.to_numeric(found[col], errors='coerce'))
+        return s
+
+    def month_name(col):
+        return found[col].str.lower().str[:3].map(_MONTHS)
+
+    month = num('iso_m', 'm').fillna(month_name('name_m')).fillna(month_name('day_m'))
+    day = num('iso_d', 'd', 'name_d', 'day_d')
+    year = num('iso_y', 'y', 'name_y', 'day_y')
+    year = year.where(year.isna() | (year >= 100), year + 2000)
+
+    created = pd.to_datetime(created_utc.reindex(found.index), unit='s')
+    guess = created.dt.year.astype('float64')
+    due = pd.to_datetime(pd.DataFrame({'year': year.fillna(guess), 'month': month, 'day': day}), errors='coerce')
+    rolled = year.isna() & (due < created - pd.Timedelta(days=30))
+    due = due.where(~rolled, pd.to_datetime(
+        pd.DataFrame({'year': guess + 1, 'month': month, 'day': day}), errors='coerce'))
+    return due.dt.strftime('%Y-%m-%d').astype('string').reindex(titles.index)
+
+
+def parse_titles(submissions, matcher) -> pd.DataFrame:
+    """
+    Parse a batch of submission titles following the
+    "[REQ] ($1000)-(#Melvindale, MI, USA) (Repay $1200 on 05/23/2023) (Cashapp, Venmo)" convention. The regexes run
+    vectorized over the whole batch; fields a title leaves out are null.
+
+    :param submissions: DataFrame with id, title, created_utc
+    :param matcher: AliasMatcher of payment methods
+    :return: DataFrame of COLUMNS, one row per submission
+    """
+    submissions = submissions.reset_index(drop=True)
+    titles = submissions['title'].astype('string').fillna('')
+    created_utc = pd.to_numeric(submissions['created_utc'], errors='coerce')
+
+    post_type = titles.str.extract(POST_TYPE_PATTERN)['post_type'].str.upper()
+    # Only the text after the post type holds the amount, so [PAID] (u/name123) does not read as 123
+    rest = titles.str.replace(POST_TYPE_PATTERN, '', regex=True)
+    amounts = rest.str.extract(AMOUNT_PATTERN)
+    amount = pd.to_numeric(amounts['amount'].str.replace(',', '', regex=False), errors='coerce')
+    currency = (amounts['code'].str.upper()
+                .fillna(amounts['symbol'].map(CURRENCY_SYMBOLS))
+                .fillna(amounts['symbol_after'].map(CURRENCY_SYMBOLS)))
+    currency = currency.where(currency.notna() | amount.isna(), 'USD')
+
+    repays = titles.str.extract(REPAY_PATTERN)
+    repay = pd.to_numeric(repays['repay'].fillna(repays['repay_before']).str.replace(',', '', regex=False),
+                          errors='coerce')
+
+    location = titles.str.extract(LOCATION_PATTERN)['location'].str.strip()
+    methods = [','.join(matcher.find(title)) or None for title in titles]
+
+    return pd.DataFrame({
+        'id': submissions['id'],
+        'post_type': post_type,
+        'amount': amount,
+        'amount_minor': _minor(amount),
+        'currency': currency,
+        'repay_amount': repay,
+        'repay_minor': _minor(repay),
+        'due_date': _due_dates(titles, created_utc),
+        'location': location,
+        'payment_methods': methods,
+        'created_utc': created_utc.astype('Int64')
+    }, columns=COLUMNS)
+
+
+def parse_new_titles(db, matcher, chunk_rows=50000, full=False) -> int:
+    """
+    Parse the titles of the submissions in staging_submissions_raw that have no submission_titles row yet. Every
+    chunk is picked with an anti-join against submission_titles, so an interrupted run resumes where it stopped.
+
+    :param db: LoansDB
+    :param matcher: AliasMatcher of payment methods
+    :param chunk_rows: Submissions parsed per batch
+    :param full: Drop every parsed title first and parse them all again, e.g. after pmt_methods.txt changed
+    :return: Number of titles parsed
+    """
+    started = time.monotonic()
+    with db.conn:
+        db.conn.execute(IngestSubmissions.SQL_CREATE)
+        db.conn.execute(SQL_CREATE)
+        if full:
+            db.conn.execute("DELETE FROM submission_titles;")
+    parsed = 0
+    with db.bulk_load('submission_titles'):
+        while True:
+            submissions = db.query_df("SELECT s.id, s.title, s.created_utc FROM staging_submissions_raw s "
+                                      "WHERE NOT EXISTS (SELECT 1 FROM submission_titles t WHERE t.id = s.id) "
+                                      "LIMIT ?;", (chunk_rows,))
+            if len(submissions) == 0:
+                break
+            db.bulk_upsert('submission_titles', parse_titles(submissions, matcher))
+            db.conn.commit()
+            parsed += len(submissions)
+            logging.debug("Parsed %d submission titles.", parsed)
+    logging.info("Parsed %d new submission titles in %.1fs.", parsed, time.monotonic() - started)
+    return parsed
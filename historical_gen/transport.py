@@ -0,0 +1,148 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HostStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ("requests=%d errors=%d retries=%d bytes=%d avg_latency=%.0fms"
+                % (self.requests, self.errors, self.retries, self.bytes,
+                   1000 * self.seconds / self.requests if self.requests else 0))
+
+
+class Transport:
+    """
+    One pooled keep-alive session shared by every retriever, so consecutive windows and chunks reuse open
+    TCP/TLS connections instead of handshaking again. Responses are gzip-encoded where the server supports it.
+
+    Failed calls (connection errors and RETRY_STATUSES) are retried with full-jitter exponential backoff:
+    sleep uniform(0, min(backoff_max, backoff_base * 2 ** attempt)). Callers with their own backoff rules, like
+    LoansRetriever, pass retries=0.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_connections=4, pool_maxsize=4, max_retries=3, backoff_base=1.0, backoff_max=60.0):
+        """
+        :param pool_connections: Number of hosts to keep pools for
+        :param pool_maxsize: Max open connections kept per host
+        :param max_retries: Default retries per call
+        :param backoff_base: Seconds; the first retry waits up to this long
+        :param backoff_max: Cap on any single backoff
+        """
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._host_stats: dict[str, HostStats] = {}
+        self._lock = threading.Lock()
+
+    def _stats_for(self, url) -> HostStats:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_stats:
+                self._host_stats[host] = HostStats()
+            return self._host_stats[host]
+
+    def backoff(self, attempt) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(self, url, headers=None, params=None, timeout=60, retries=None):
+        """
+        :param url: Full url
+        :param headers: Request headers, merged over the session's
+        :param params: Query params
+        :param timeout: Seconds before a request errors
+        :param retries: Override max_retries for this call
+        :return: The last response received. If the final attempt raises, the exception propagates.
+        """
+        retries = self.max_retries if retries is None else retries
+        stats = self._stats_for(url)
+        r = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = self.backoff(attempt - 1)
+                logging.info("Retrying %s in %.1f seconds (attempt %d of %d).", url, delay, attempt, retries)
+                with self._lock:
+                    stats.retries += 1
+                time.sleep(delay)
+
+            started = time.monotonic()
+            try:
+                r = self.session.get(url, headers=headers, params=params, timeout=timeout)
+            except requests.RequestException as e:
+                logging.error("Error fetching %s: %s", url, str(e))
+                with self._lock:
+                    stats.requests += 1
+                    stats.errors += 1
+                    stats.seconds += time.monotonic() - started
+                if attempt == retries:
+                    raise
+                continue
+
+            with self._lock:
+                stats.requests += 1
+                stats.seconds += time.monotonic() - started
+                stats.bytes += len(r.content)
+                if r.status_code >= 400:
+                    stats.errors += 1
+            if r.status_code not in self.RETRY_STATUSES:
+                return r
+        return r
+
+    def connections(self) -> dict:
+        """
+        :return: Dict of host -> number of connections opened so far
+        """
+        pools = self.adapter.poolmanager.pools
+        opened = {}
+        for key in pools.keys():
+            pool = pools[key]
+            host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+            opened[host] = opened.get(host, 0) + pool.num_connections
+        return opened
+
+    def report(self) -> str:
+        connections = self.connections()
+        with self._lock:
+            lines = ["%s: %r connections_opened=%d" % (host, stats, connections.get(host, 0))
+                     for host, stats in self._host_stats.items()]
+        return "transport: " + ("; ".join(lines) if lines else "no requests")
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def default_transport() -> Transport:
+    """
+    The process-wide Transport that retrievers use unless given their own.
+    """
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
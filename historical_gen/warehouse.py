@@ -0,0 +1,299 @@
+import logging
+import time
+
+# Authors Reddit no longer names
+_NO_USER = "('[deleted]', '[removed]')"
+
+
+class _Source:
+    """
+    How one staging table feeds a core table. Its SQL filters staging rows by {rows}, a condition on the staging
+    alias filled in by Warehouse: a rowid range, or the keys queued in warehouse_dirty.
+    """
+
+    def __init__(self, staging, core, alias, sql_users, sql_upsert, key=None, sql_delete=None, incremental=True,
+                 core_key=None):
+        """
+        :param staging: Staging table read from
+        :param core: Core table written to
+        :param alias: Alias of staging in the SQL
+        :param sql_users: INSERT OR IGNORE of the user names the staging rows mention
+        :param sql_upsert: Upsert of the staging rows into core, with users already resolved
+        :param key: Column of staging that triggers queue in warehouse_dirty when a staging row is updated or
+        deleted in place
+        :param sql_delete: Delete from core of the rows of a range of queued keys that staging no longer has
+        :param incremental: Only read staging rows added since the last refresh, and those queued by key. Off for
+        tables whose rows change in place often, which are merged in full and only rows that changed are written.
+        :param core_key: Column of core holding key, when not named the same
+        """
+        self.staging = staging
+        self.core = core
+        self.alias = alias
+        self.sql_users = sql_users
+        self.sql_upsert = sql_upsert
+        self.key = key
+        self.sql_delete = sql_delete
+        self.incremental = incremental
+        self.core_key = core_key or key
+
+    def sql_triggers(self) -> tuple:
+        """
+        :return: Names and CREATE statements of the triggers queueing the keys of staging rows updated, or deleted,
+        in place. Inserts need none: new rows land past the rowid watermark.
+        """
+        def mark(row):
+            return (f"INSERT INTO warehouse_dirty (source, key) VALUES ('{self.staging}', {row}.{self.key}) "
+                    f"ON CONFLICT (source, key) DO NOTHING;")
+
+        update = f"{self.staging}_warehouse_update"
+        delete = f"{self.staging}_warehouse_delete"
+        return (
+            (update, f"CREATE TRIGGER IF NOT EXISTS {update} AFTER UPDATE ON {self.staging} BEGIN {mark('NEW')} "
+                     f"{mark('OLD')} END;"),
+            (delete, f"CREATE TRIGGER IF NOT EXISTS {delete} AFTER DELETE ON {self.staging} BEGIN {mark('OLD')} END;")
+        )
+
+
+SOURCES = (
+    _Source(
+        'staging_submissions_raw', 'submissions', 's',
+        f"""
+        INSERT OR IGNORE INTO users (name)
+        SELECT s.author FROM staging_submissions_raw s
+        WHERE {{rows}} AND s.author IS NOT NULL AND s.author NOT IN {_NO_USER};
+        """,
+        """
+        INSERT INTO submissions (id, author_id, created_utc, title, link_flair_text, num_comments, score, permalink)
+        SELECT s.id, u.id, s.created_utc, s.title, s.link_flair_text, s.num_comments, s.score, s.permalink
+        FROM staging_submissions_raw s LEFT JOIN users u ON u.name = s.author
+        WHERE {rows}
+        ON CONFLICT (id) DO UPDATE SET author_id = excluded.author_id, created_utc = excluded.created_utc,
+            title = excluded.title, link_flair_text = excluded.link_flair_text,
+            num_comments = excluded.num_comments, score = excluded.score, permalink = excluded.permalink
+        WHERE author_id IS NOT excluded.author_id OR created_utc IS NOT excluded.created_utc
+            OR title IS NOT excluded.title OR link_flair_text IS NOT excluded.link_flair_text
+            OR num_comments IS NOT excluded.num_comments OR score IS NOT excluded.score
+            OR permalink IS NOT excluded.permalink;
+        """,
+        key='id',
+        sql_delete="""
+        DELETE FROM submissions
+        WHERE id IN (SELECT key FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?)
+            AND NOT EXISTS (SELECT 1 FROM staging_submissions_raw s WHERE s.id = submissions.id);
+        """),
+    _Source(
+        'staging_comments_raw', 'comments', 'c',
+        f"""
+        INSERT OR IGNORE INTO users (name)
+        SELECT c.author FROM staging_comments_raw c
+        WHERE {{rows}} AND c.author IS NOT NULL AND c.author NOT IN {_NO_USER};
+        """,
+        """
+        INSERT INTO comments (id, submission_id, parent_id, author_id, created_utc, body, loan_id)
+        SELECT c.id, CASE WHEN c.link_id LIKE 't3\\_%' ESCAPE '\\' THEN substr(c.link_id, 4) ELSE c.link_id END,
+            c.parent_id, u.id, c.created_utc, c.body, c.loan_id
+        FROM staging_comments_raw c LEFT JOIN users u ON u.name = c.author
+        WHERE {rows}
+        ON CONFLICT (id) DO UPDATE SET submission_id = excluded.submission_id, parent_id = excluded.parent_id,
+            author_id = excluded.author_id, created_utc = excluded.created_utc, body = excluded.body,
+            loan_id = excluded.loan_id
+        WHERE submission_id IS NOT excluded.submission_id OR parent_id IS NOT excluded.parent_id
+            OR author_id IS NOT excluded.author_id OR created_utc IS NOT excluded.created_utc
+            OR body IS NOT excluded.body OR loan_id IS NOT excluded.loan_id;
+        """,
+        key='id',
+        sql_delete="""
+        DELETE FROM comments
+        WHERE id IN (SELECT key FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?)
+            AND NOT EXISTS (SELECT 1 FROM staging_comments_raw c WHERE c.id = comments.id);
+        """),
+    _Source(
+        'staging_loan_basic_raw', 'loans', 'b',
+        """
+        INSERT OR IGNORE INTO users (name)
+        SELECT b.lender FROM staging_loan_basic_raw b WHERE {rows} AND b.lender IS NOT NULL
+        UNION
+        SELECT b.borrower FROM staging_loan_basic_raw b WHERE {rows} AND b.borrower IS NOT NULL;
+        """,
+        """
+        INSERT INTO loans (id, lender_id, borrower_id, currency_code, currency_exponent, principal_minor,
+                           principal_repayment_minor, created_at, last_repaid_at, repaid_at, unpaid_at, deleted_at)
+        SELECT b.loan_id, l.id, r.id, b.currency_code, b.currency_exponent, b.principal_minor,
+            b.principal_repayment_minor, b.created_at, b.last_repaid_at, b.repaid_at, b.unpaid_at, b.deleted_at
+        FROM staging_loan_basic_raw b
+        LEFT JOIN users l ON l.name = b.lender
+        LEFT JOIN users r ON r.name = b.borrower
+        WHERE {rows}
+        ON CONFLICT (id) DO UPDATE SET lender_id = excluded.lender_id, borrower_id = excluded.borrower_id,
+            currency_code = excluded.currency_code, currency_exponent = excluded.currency_exponent,
+            principal_minor = excluded.principal_minor,
+            principal_repayment_minor = excluded.principal_repayment_minor, created_at = excluded.created_at,
+            last_repaid_at = excluded.last_repaid_at, repaid_at = excluded.repaid_at,
+            unpaid_at = excluded.unpaid_at, deleted_at = excluded.deleted_at
+        WHERE principal_repayment_minor IS NOT excluded.principal_repayment_minor
+            OR last_repaid_at IS NOT excluded.last_repaid_at OR repaid_at IS NOT excluded.repaid_at
+            OR unpaid_at IS NOT excluded.unpaid_at OR deleted_at IS NOT excluded.deleted_at
+            OR principal_minor IS NOT excluded.principal_minor OR created_at IS NOT excluded.created_at
+            OR lender_id IS NOT excluded.lender_id OR borrower_id IS NOT excluded.borrower_id
+            OR currency_code IS NOT excluded.currency_code OR currency_exponent IS NOT excluded.currency_exponent;
+        """,
+        key='loan_id',
+        core_key='id',
+        sql_delete="""
+        DELETE FROM loans
+        WHERE id IN (SELECT key FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?)
+            AND NOT EXISTS (SELECT 1 FROM staging_loan_basic_raw b WHERE b.loan_id = loans.id);
+        """,
+        incremental=False),
+    _Source(
+        'staging_loan_events_raw', 'loan_events', 'e',
+        None,
+        """
+        INSERT INTO loan_events (loan_id, event_type, occurred_at, creation_type, creation_permalink,
+                                 repayment_minor, old_principal_minor, new_principal_minor,
+                                 old_principal_repayment_minor, new_principal_repayment_minor)
+        SELECT e.loan_id, e.event_type, e.occurred_at, e.creation_type, e.creation_permalink, e.repayment_minor,
+            e.old_principal_minor, e.new_principal_minor, e.old_principal_repayment_minor,
+            e.new_principal_repayment_minor
+        FROM staging_loan_events_raw e
+        WHERE {rows}
+        ON CONFLICT (loan_id, event_type, occurred_at) DO UPDATE SET creation_type = excluded.creation_type,
+            creation_permalink = excluded.creation_permalink, repayment_minor = excluded.repayment_minor,
+            old_principal_minor = excluded.old_principal_minor, new_principal_minor = excluded.new_principal_minor,
+            old_principal_repayment_minor = excluded.old_principal_repayment_minor,
+            new_principal_repayment_minor = excluded.new_principal_repayment_minor
+        WHERE creation_type IS NOT excluded.creation_type OR creation_permalink IS NOT excluded.creation_permalink
+            OR repayment_minor IS NOT excluded.repayment_minor
+            OR old_principal_minor IS NOT excluded.old_principal_minor
+            OR new_principal_minor IS NOT excluded.new_principal_minor
+            OR old_principal_repayment_minor IS NOT excluded.old_principal_repayment_minor
+            OR new_principal_repayment_minor IS NOT excluded.new_principal_repayment_minor;
+        """,
+        key='loan_id',
+        # A changed events file replaces every event of its loans (IngestLoanEvents.REPLACE_GROUPS)
+        sql_delete="""
+        DELETE FROM loan_events
+        WHERE loan_id IN (SELECT key FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?)
+            AND NOT EXISTS (SELECT 1 FROM staging_loan_events_raw e WHERE e.loan_id = loan_events.loan_id
+                            AND e.event_type = loan_events.event_type AND e.occurred_at = loan_events.occurred_at);
+        """),
+)
+
+
+class Warehouse:
+    """
+    Keeps the normalized core tables (users, submissions, comments, loans, loan_events; see db.MIGRATIONS) in
+    step with the staging tables. Each refresh reads only the staging rows added since the last one, found by
+    rowid past a per-table watermark, in chunks that each commit together with the watermark, so an interrupted
+    refresh resumes where it stopped. Author names become integer user ids on the way in.
+
+    Staging rows updated or deleted in place keep their rowid, or leave none behind, so triggers on the staging
+    tables queue their keys in warehouse_dirty (re-staged submissions and comments, comments linked to a loan, the
+    events of a loan whose file changed, rows a re-staged file dropped), and each refresh then re-reads those keys
+    too and deletes the core rows staging no longer has. Loans, most of which change after they land (they get
+    repaid), are also merged in full, writing only the rows that differ.
+    """
+
+    def __init__(self, db, chunk_rows=200000):
+        """
+        :param db: LoansDB
+        :param chunk_rows: Staging rows, or queued keys, per committed chunk
+        """
+        self.db = db
+        self.chunk_rows = chunk_rows
+
+    def refresh(self, full=False) -> dict:
+        """
+        :param full: Re-read every staging row, e.g. after a VACUUM, which may renumber staging rowids
+        :return: Dict of core table -> # rows written
+        """
+        summary = {}
+        for source in SOURCES:
+            if not self._exists(source.staging):
+                logging.debug("No %s yet; skipping %s.", source.staging, source.core)
+                continue
+            started = time.monotonic()
+            if source.key is not None:
+                self._track(source)
+            summary[source.core] = self._refresh_source(source, full or not source.incremental)
+            if source.key is not None:
+                summary[source.core] += self._refresh_dirty(source)
+            logging.info("Refreshed %s from %s: %d rows written in %.1fs.", source.core, source.staging,
+                         summary[source.core], time.monotonic() - started)
+        return summary
+
+    def _exists(self, table, kind='table') -> bool:
+        c = self.db.conn.execute("SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?;", (kind, table))
+        return c.fetchone() is not None
+
+    def _watermark(self, source) -> int:
+        row = self.db.conn.execute("SELECT last_rowid FROM warehouse_state WHERE source = ?;",
+                                   (source.staging,)).fetchone()
+        return row['last_rowid'] if row is not None else 0
+
+    def _track(self, source):
+        """
+        Put the source's triggers on its staging table. If they are new but staging was loaded before, changes made
+        until now went unrecorded, so every key core has is queued once.
+        """
+        with self.db.conn:
+            new = False
+            for name, sql in source.sql_triggers():
+                new = new or not self._exists(name, 'trigger')
+                self.db.conn.execute(sql)
+            if new and self._watermark(source) > 0:
+                c = self.db.conn.execute(f"INSERT OR IGNORE INTO warehouse_dirty (source, key) "
+                                         f"SELECT DISTINCT ?, {source.core_key} FROM {source.core};", (source.staging,))
+                logging.info("Queued all %d keys of %s to re-read once.", c.rowcount, source.core)
+
+    def _upsert(self, source, rows, params) -> int:
+        """
+        Resolve the users of, then upsert, the staging rows matching the condition rows.
+
+        :return: # core rows written
+        """
+        if source.sql_users is not None:
+            self.db.conn.execute(source.sql_users.format(rows=rows), params * source.sql_users.count('{rows}'))
+        return self.db.conn.execute(source.sql_upsert.format(rows=rows),
+                                    params * source.sql_upsert.count('{rows}')).rowcount
+
+    def _refresh_source(self, source, full) -> int:
+        last = 0 if full else self._watermark(source)
+        end = self.db.conn.execute(f"SELECT COALESCE(MAX(rowid), 0) AS n FROM {source.staging};").fetchone()['n']
+        rows = f"{source.alias}.rowid > ? AND {source.alias}.rowid <= ?"
+        written = 0
+        while last < end:
+            upto = min(last + self.chunk_rows, end)
+            with self.db.conn:
+                written += self._upsert(source, rows, (last, upto))
+                self.db.conn.execute("INSERT INTO warehouse_state (source, last_rowid, updated_utc) VALUES (?, ?, ?) "
+                                     "ON CONFLICT (source) DO UPDATE SET last_rowid = excluded.last_rowid, "
+                                     "updated_utc = excluded.updated_utc;", (source.staging, upto, time.time()))
+            logging.debug("Refreshed %s up to staging rowid %d of %d.", source.core, upto, end)
+            last = upto
+        return written
+
+    def _refresh_dirty(self, source) -> int:
+        """
+        Re-read the staging rows of the keys queued in warehouse_dirty, a key range per committed chunk, and
+        delete the core rows of those keys that staging no longer has.
+
+        :return: # core rows written or deleted
+        """
+        rows = (f"{source.alias}.{source.key} IN "
+                f"(SELECT key FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?)")
+        written = 0
+        while True:
+            keys = [row[0] for row in self.db.conn.execute(
+                "SELECT key FROM warehouse_dirty WHERE source = ? ORDER BY key LIMIT ?;",
+                (source.staging, self.chunk_rows))]
+            if not keys:
+                break
+            params = (source.staging, keys[0], keys[-1])
+            with self.db.conn:
+                if source.sql_delete is not None:
+                    written += self.db.conn.execute(source.sql_delete, params).rowcount
+                written += self._upsert(source, rows, params)
+                self.db.conn.execute("DELETE FROM warehouse_dirty WHERE source = ? AND key BETWEEN ? AND ?;", params)
+            logging.debug("Re-read %d changed keys of %s.", len(keys), source.staging)
+        return written
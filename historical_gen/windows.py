@@ -0,0 +1,96 @@
+import logging
+
+
+class AdaptiveWindowPlanner:
+    """
+    Plans [start, end) time windows for a search API that returns at most page_size results per call.
+
+    A window that comes back with a full page may have been truncated, so its results are thrown away and the
+    window is bisected and fetched again as two halves. Accepted windows update a running estimate of results
+    per second, and the next window is sized so it is expected to come back about target_fill full: sparse
+    stretches get wide windows, busy ones narrow windows. Windows that are still full at min_span are accepted
+    but reported in coverage_gaps, since completeness cannot be guaranteed for them.
+    """
+
+    def __init__(self, start_ts, end_ts, page_size=500, initial_span=24 * 60 * 60, min_span=60,
+                 max_span=30 * 24 * 60 * 60, target_fill=0.5, smoothing=0.5):
+        """
+        :param start_ts: Start of the range, epoch seconds
+        :param end_ts: End of the range (exclusive), epoch seconds
+        :param page_size: Max results the API returns per call
+        :param initial_span: Seconds covered by the first window
+        :param min_span: Windows are never bisected below this many seconds
+        :param max_span: Windows are never widened past this many seconds
+        :param target_fill: Fraction of page_size new windows aim for
+        :param smoothing: Weight of the newest observation in the density estimate
+        """
+        assert 0 < target_fill < 1
+        self.end_ts = int(end_ts)
+        self.page_size = page_size
+        self.min_span = min_span
+        self.max_span = max_span
+        self.target_fill = target_fill
+        self.smoothing = smoothing
+
+        self.cursor = int(start_ts)
+        self.span = max(min_span, min(max_span, int(initial_span)))
+        self.density = None  # Results per second
+        self.pending: list[tuple[int, int]] = []  # Bisected halves still to fetch, next one last
+        self.requests = 0
+        self.accepted = 0
+        self.coverage_gaps: list[tuple[int, int, int]] = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple[int, int]:
+        if self.pending:
+            return self.pending.pop()
+        if self.cursor >= self.end_ts:
+            raise StopIteration
+        window = (self.cursor, min(self.cursor + self.span, self.end_ts))
+        self.cursor = window[1]
+        return window
+
+    def record(self, window, count) -> bool:
+        """
+        Report how many results a window returned.
+
+        :return: True if the results are complete and should be kept, False if they must be discarded because
+        the window was split and will be fetched again in halves
+        """
+        self.requests += 1
+        start, end = window
+        span = end - start
+
+        if count >= self.page_size:
+            self._observe(self.page_size / span)
+            if span > self.min_span:
+                mid = start + span // 2
+                self.pending.append((mid, end))
+                self.pending.append((start, mid))
+                logging.debug("Window %s to %s returned a full page of %d; bisecting.", start, end, count)
+                return False
+            logging.warning("Window %s to %s is still full at the minimum span; results may be truncated.",
+                            start, end)
+            self.coverage_gaps.append((start, end, count))
+        else:
+            self._observe(count / span)
+
+        self.accepted += 1
+        if self.density:
+            self.span = int(self.target_fill * self.page_size / self.density)
+        else:
+            self.span *= 2
+        self.span = max(self.min_span, min(self.max_span, self.span))
+        return True
+
+    def _observe(self, density):
+        if self.density is None:
+            self.density = density
+        else:
+            self.density = self.smoothing * density + (1 - self.smoothing) * self.density
+
+    def report(self) -> str:
+        return "%d requests for %d windows, %d coverage gaps" % (self.requests, self.accepted,
+                                                                 len(self.coverage_gaps))
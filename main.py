@@ -1,5 +1,9 @@
 import argparse
 import datetime
+import glob
+import json
+import shutil
+import sqlite3
 import sys
 import os.path
 import logging
@@ -8,8 +12,27 @@ from db import LoansDB
 
 import yaml
 from historical_gen.staging import SubmissionRetriever, CommentRetriever
-from historical_gen.ingest import IngestSubmissions, IngestComments, IngestLoanIDs
+from historical_gen.ingest import IngestSubmissions, IngestComments, IngestLoanIDs, IngestLoanBasic, IngestLoanEvents
 from historical_gen.loansretriever import LoansRetriever
+from historical_gen.journal import LoanFetchJournal
+from historical_gen.sync import IncrementalSync
+from historical_gen.httpcache import ResponseCache, default_policies
+from historical_gen.transport import default_transport
+from historical_gen.dumps import stage_dumps
+from historical_gen.columnar import CSV, FORMATS, compact_staging
+from historical_gen.stream import StreamingIngest
+from historical_gen.commands import extract_stored
+from historical_gen.titles import AliasMatcher, parse_new_titles
+from historical_gen.warehouse import Warehouse
+from historical_gen.aggregates import UserStats
+from historical_gen.returns import LoanReturns
+from historical_gen.survival import STRATA, SurvivalCurves, summarize
+from historical_gen.links import ThreadLinker
+from gsheets import GSheetWriter, export_summaries
+from historical_gen.search import rebuild_index
+from historical_gen.analytics import AnalyticsExport
+from historical_gen.synthetic import SyntheticBorrow
+from historical_gen.benchmark import Benchmark, compare, run_pipeline
 
 
 class App:
@@ -38,6 +61,18 @@ class App:
         # Init db
         self.db = LoansDB(self.config['DATA']['DB'])
 
+        # HTTP response cache
+        self.cache = None
+        cache_cfg = self.config.get('CACHE')
+        if cache_cfg is not None and not self.args.no_cache:
+            self.cache = ResponseCache(cache_cfg['FOLDER'],
+                                       max_bytes=cache_cfg['MAX_MB'] * 1024 * 1024,
+                                       policies=default_policies(cache_cfg['OPEN_LOAN_TTL_HOURS']),
+                                       offline=self.args.offline)
+        elif self.args.offline:
+            print("--offline needs the CACHE config section and cannot be combined with --no-cache.")
+            sys.exit(1)
+
         # LoansBot auth
         self.auth = {k.lower(): v for k, v in self.config['AUTH'].items()}
 
@@ -49,6 +84,10 @@ class App:
         self.staging_loan_ids_out = os.path.join(STAGING_ROOT, STAGING_SUB['LOAN_IDS_FOLDER'])
         self.staging_loan_basic = os.path.join(STAGING_ROOT, STAGING_SUB['LOAN_BASIC_FOLDER'])
         self.staging_loan_events = os.path.join(STAGING_ROOT, STAGING_SUB['LOAN_EVENTS_FOLDER'])
+        self.staging_format = STAGING_SUB.get('FORMAT', CSV)
+        if self.staging_format not in FORMATS:
+            print(f"STAGING FORMAT must be one of {FORMATS}.")
+            sys.exit(1)
 
         Path(STAGING_ROOT).mkdir(parents=True, exist_ok=True)
         Path(self.staging_submissions_out).mkdir(parents=True, exist_ok=True)
@@ -75,23 +114,315 @@ class App:
     @staticmethod
     def _parse_args():
         parser = argparse.ArgumentParser(description='Scrape, ingest, and analyze r/borrow data.')
+        parser.add_argument('command',
+                            help='backfill: historical fetch/ingest (default). '
+                                 'sync: incremental daily sync from the stored watermarks. '
+                                 'dumps: stage r/borrow from monthly Reddit dump files in --dump-dir. '
+                                 'compact: merge staged submission/comment files into monthly parquet files. '
+                                 'commands: re-extract $loan / $paid / $confirm commands from stored comments. '
+                                 'titles: parse the [REQ] titles of newly ingested submissions. '
+                                 'warehouse: update the core tables, user stats and loan returns from staging. '
+                                 'stats: check the per-user loan stats against a full recompute. '
+                                 'returns: recompute the APR / IRR of changed loans. '
+                                 'survival: Kaplan-Meier time to repayment (or default) by --by strata. '
+                                 'link: link stored comments to the loans made in their threads. '
+                                 'gsheets: push the changed rows of the loan and borrower summaries to Google Sheets. '
+                                 'search: full-text search of submissions and comments for --query. '
+                                 'analytics: export changed months of the core tables to partitioned parquet datasets. '
+                                 'benchmark: time every stage on --loans of synthetic data, saved in --bench-dir.',
+                            nargs='?',
+                            choices=['backfill', 'sync', 'dumps', 'compact', 'commands', 'titles', 'warehouse',
+                                     'stats', 'returns', 'survival', 'link', 'gsheets', 'search',
+                                     'analytics', 'benchmark'],
+                            default='backfill')
         parser.add_argument('--start-date',
                             help='Start date as "YYYY-MM-DD"',
                             default='2014-09-17')
         parser.add_argument('--end-date',
                             help='End date as "YYYY-MM-DD"',
                             default=datetime.date.today().strftime('%Y-%m-%d'))
+        parser.add_argument('--async-fetch',
+                            help='Fetch loan details with the asyncio engine instead of one at a time',
+                            action='store_true')
+        parser.add_argument('--max-connections',
+                            help='Persistent connections used by --async-fetch',
+                            type=int,
+                            default=1)
+        parser.add_argument('--rate',
+                            help='Requests per second allowed for --async-fetch (default: 1 / delay_minor)',
+                            type=float,
+                            default=None)
+        parser.add_argument('--offline',
+                            help='Serve every request from the response cache and never touch the network',
+                            action='store_true')
+        parser.add_argument('--no-cache',
+                            help='Bypass the response cache',
+                            action='store_true')
+        parser.add_argument('--adaptive-windows',
+                            help='Size submission/comment windows from observed density, bisecting full pages',
+                            action='store_true')
+        parser.add_argument('--window-workers',
+                            help='Fetch this many fixed submission/comment windows concurrently under one rate limit',
+                            type=int,
+                            default=1)
+        parser.add_argument('--stream',
+                            help='Load submissions/comments into the db as they are fetched instead of staging files',
+                            action='store_true')
+        parser.add_argument('--archive',
+                            help='With --stream, also keep the raw windows as staging files',
+                            action='store_true')
+        parser.add_argument('--dump-dir',
+                            help='Folder of RS_YYYY-MM.zst / RC_YYYY-MM.zst Reddit dump files for the dumps command',
+                            default='dumps')
+        parser.add_argument('--workers',
+                            help='Processes used to read dump files, or staged files in benchmark '
+                                 '(default: one per core)',
+                            type=int,
+                            default=None)
+        parser.add_argument('--sources',
+                            help='Comma separated sources for sync (loansbot,submissions,comments)',
+                            default='loansbot,submissions,comments')
+        parser.add_argument('--repoll-days',
+                            help='sync re-fetches still-open loans created within this many days',
+                            type=int,
+                            default=30)
+        parser.add_argument('--full',
+                            help='titles re-parses every submission title, e.g. after pmt_methods.txt changed; '
+                                 'warehouse re-reads every staging row; stats rebuilds the stats if the check fails; '
+                                 'returns recomputes every loan; link re-links every comment; '
+                                 'search rebuilds the search index first; analytics rewrites every partition',
+                            action='store_true')
+        parser.add_argument('--max-remote',
+                            help='Max /api/loans/threads lookups for comments link cannot match locally',
+                            type=int,
+                            default=200)
+        parser.add_argument('--event',
+                            help='survival curve: time to repaid or to unpaid',
+                            choices=['repaid', 'unpaid'],
+                            default='repaid')
+        parser.add_argument('--by',
+                            help=f'Comma separated survival strata ({",".join(STRATA)})',
+                            default='')
+        parser.add_argument('--years',
+                            help='Comma separated loan creation years for survival (default: all)',
+                            default=None)
+        parser.add_argument('--query',
+                            help='search query: words, "exact phrase", prefix*, OR, NOT, NEAR(a b, 5)',
+                            default=None)
+        parser.add_argument('--author',
+                            help='Only search posts by this author',
+                            default=None)
+        parser.add_argument('--kind',
+                            help='Only search submissions or comments',
+                            choices=['submission', 'comment'],
+                            default=None)
+        parser.add_argument('--after',
+                            help='Only search posts made on or after this date, as "YYYY-MM-DD"',
+                            default=None)
+        parser.add_argument('--before',
+                            help='Only search posts made before this date, as "YYYY-MM-DD"',
+                            default=None)
+        parser.add_argument('--limit',
+                            help='Max search results',
+                            type=int,
+                            default=20)
+        parser.add_argument('--loans',
+                            help='Synthetic loans the benchmark generates',
+                            type=int,
+                            default=100000)
+        parser.add_argument('--comments',
+                            help='Synthetic comments the benchmark generates (default: 20 per loan)',
+                            type=int,
+                            default=None)
+        parser.add_argument('--batches',
+                            help='Batches the benchmark feeds the pipeline, each one call of every stage',
+                            type=int,
+                            default=10)
+        parser.add_argument('--seed',
+                            help='Seed of the synthetic data',
+                            type=int,
+                            default=0)
+        parser.add_argument('--bench-dir',
+                            help='Folder for the benchmark database, files and JSON results',
+                            default='benchmark')
+        parser.add_argument('--baseline',
+                            help='Earlier benchmark results JSON to compare this run to',
+                            default=None)
         return parser.parse_args()
 
     def main(self):
+        if self.args.command == 'sync':
+            self.sync()
+        elif self.args.command == 'dumps':
+            self.stage_dumps()
+        elif self.args.command == 'compact':
+            self.compact()
+        elif self.args.command == 'commands':
+            scanned, stored = extract_stored(self.db)
+            logging.info("Stored %d loan commands from %d comments.", stored, scanned)
+        elif self.args.command == 'titles':
+            self.parse_titles(full=self.args.full)
+        elif self.args.command == 'warehouse':
+            self.refresh_warehouse(full=self.args.full)
+        elif self.args.command == 'stats':
+            user_stats = UserStats(self.db)
+            user_stats.refresh()
+            if user_stats.check() and self.args.full:
+                user_stats.rebuild()
+        elif self.args.command == 'returns':
+            loan_returns = LoanReturns(self.db)
+            if self.args.full:
+                loan_returns.rebuild()
+            else:
+                loan_returns.refresh()
+        elif self.args.command == 'link':
+            loan_retriever = LoansRetriever(70, auth=self.auth, cache=self.cache)
+            ThreadLinker(self.db, loan_retriever, max_remote=self.args.max_remote).run(full=self.args.full)
+        elif self.args.command == 'gsheets':
+            out_cfg = self.config['OUT']
+            writer = GSheetWriter(self.db, sheet_name=out_cfg['SHEET_NAME'], worksheet_name=out_cfg['WORKSHEET_NAME'])
+            export_summaries(writer)
+        elif self.args.command == 'survival':
+            self.survival()
+        elif self.args.command == 'search':
+            self.search()
+        elif self.args.command == 'analytics':
+            folder = self.config['DATA'].get('ANALYTICS_FOLDER', 'analytics')
+            AnalyticsExport(self.db, folder).run(full=self.args.full)
+        elif self.args.command == 'benchmark':
+            self.benchmark()
+        else:
+            self.backfill()
+
+        logging.info(default_transport().report())
+        if self.cache is not None:
+            logging.info(self.cache.report())
+
+    def _open_journal(self):
+        journal = LoanFetchJournal(self.db)
+        if len(journal.counts()) == 0:
+            journal.adopt_staged(self.staging_loan_basic)
+        return journal
+
+    def sync(self):
+        loan_retriever = LoansRetriever(70, auth=self.auth, cache=self.cache)
+        folders = {
+            'submissions': self.staging_submissions_out,
+            'comments': self.staging_comments_out,
+            'loan_ids': self.staging_loan_ids_out,
+            'loan_basic': self.staging_loan_basic,
+            'loan_events': self.staging_loan_events
+        }
+        stream = None
+        if self.args.stream:
+            stream = StreamingIngest(self.db, archive=self.args.archive, archive_format=self.staging_format)
+        syncer = IncrementalSync(self.db, loan_retriever, self._open_journal(), folders,
+                                 start_date=self.args.start_date, repoll_days=self.args.repoll_days,
+                                 cache=self.cache, adaptive=self.args.adaptive_windows,
+                                 window_workers=self.args.window_workers, staging_format=self.staging_format,
+                                 stream=stream, max_connections=self.args.max_connections, rate=self.args.rate)
+        summary = syncer.run(self.args.sources.split(','))
+        logging.info("Sync complete: %s", summary)
+        if 'submissions' in summary:
+            self.parse_titles()
+        ThreadLinker(self.db, loan_retriever, max_remote=self.args.max_remote).run()
+        self.refresh_warehouse()
+
+    def refresh_warehouse(self, full=False):
+        Warehouse(self.db).refresh(full=full)
+        for derived in (UserStats(self.db), LoanReturns(self.db)):
+            if full:
+                derived.rebuild()
+            else:
+                derived.refresh()
+
+    def parse_titles(self, full=False):
+        matcher = AliasMatcher.from_file(self.config['DATA'].get('PAYMENT_METHODS', 'pmt_methods.txt'))
+        parse_new_titles(self.db, matcher, full=full)
+
+    def survival(self):
+        by = [name for name in self.args.by.split(',') if name]
+        years = [int(year) for year in self.args.years.split(',')] if self.args.years else None
+        curves = SurvivalCurves(self.db).curves(self.args.event, by, years=years)
+        print(summarize(curves, by).to_string(index=False, float_format='{:.3f}'.format))
+
+    def search(self):
+        if self.args.full:
+            rebuild_index(self.db)
+        if not self.args.query:
+            return
+
+        def epoch(date):
+            if date is None:
+                return None
+            return datetime.datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+        try:
+            results = self.db.search(self.args.query, kind=self.args.kind, author=self.args.author,
+                                     since=epoch(self.args.after), until=epoch(self.args.before),
+                                     limit=self.args.limit)
+        except sqlite3.OperationalError as e:
+            logging.error("Bad search query %r: %s", self.args.query, str(e))
+            sys.exit(1)
+        if not results and self.db.conn.execute("SELECT 1 FROM search_index LIMIT 1;").fetchone() is None:
+            logging.warning("The search index is empty; run search --full to index what is already ingested.")
+        for row in results:
+            created = datetime.datetime.fromtimestamp(row['created_utc'] or 0, datetime.timezone.utc)
+            print(f"{row['kind']} {row['id']} by {row['author']} on {created:%Y-%m-%d}: {row['snippet']}")
+
+    def benchmark(self):
+        run_dir = os.path.join(self.args.bench_dir, 'run')
+        shutil.rmtree(run_dir, ignore_errors=True)  # Left by the last benchmark
+        Path(run_dir).mkdir(parents=True)
+        generator = SyntheticBorrow(loans=self.args.loans, comments=self.args.comments, seed=self.args.seed)
+        bench = Benchmark({'loans': generator.loans, 'submissions': generator.submissions,
+                           'comments': generator.comments, 'users': generator.users, 'seed': generator.seed,
+                           'batches': self.args.batches, 'format': self.staging_format, 'workers': self.args.workers})
+        db = LoansDB(os.path.join(run_dir, 'bench.db'))
+        try:
+            matcher = AliasMatcher.from_file(self.config['DATA'].get('PAYMENT_METHODS', 'pmt_methods.txt'))
+            run_pipeline(bench, db, generator, run_dir, batches=self.args.batches, fmt=self.staging_format,
+                         workers=self.args.workers, matcher=matcher)
+        finally:
+            db.close()
+        print(bench.report())
+        path = os.path.join(self.args.bench_dir, f"benchmark_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+        results = bench.save(path)
+        logging.info("Saved benchmark results to %s", path)
+        if self.args.baseline:
+            with open(self.args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            print(f"Against {self.args.baseline} ({baseline.get('version')}), as this run over the baseline:")
+            print(compare(baseline, results).to_string(float_format='{:.2f}'.format))
+
+    def stage_dumps(self):
+        paths = sorted(glob.glob(os.path.join(self.args.dump_dir, 'R[SC]_*.zst')))
+        logging.info("Staging %d dump files from %s", len(paths), self.args.dump_dir)
+        staged, files = stage_dumps(paths, self.staging_submissions_out, self.staging_comments_out,
+                                    workers=self.args.workers, fmt=self.staging_format)
+        logging.info("Staged %d rows into %d files from Reddit dumps.", staged, files)
+
+    def compact(self):
+        for folder, ingest_cls, prefix in ((self.staging_submissions_out, IngestSubmissions, 'submissions'),
+                                           (self.staging_comments_out, IngestComments, 'comments')):
+            merged, months = compact_staging(folder, ingest_cls.SCHEMA, prefix)
+            logging.info("Compacted %d %s files in %s into %d month files.", merged, prefix, folder, months)
+
+    def backfill(self):
         # Fetch raw submissions as CSV
-        # submission_retriever = SubmissionRetriever(self.args.start_date, self.args.end_date, timeout=120, delay=1)
-        # submissions = submission_retriever.fetch_submissions(self.staging_submissions_out)
+        # submission_retriever = SubmissionRetriever(self.args.start_date, self.args.end_date, timeout=120, delay=1,
+        #                                            cache=self.cache, fmt=self.staging_format)
+        # submissions = submission_retriever.fetch_submissions(self.staging_submissions_out,
+        #                                                      adaptive=self.args.adaptive_windows,
+        #                                                      workers=self.args.window_workers)
         # logging.debug(str(submissions))
 
         # Fetch IDs of ingested submissions and fetch raw comments as CSV
-        # comment_retriever = CommentRetriever(self.args.start_date, self.args.end_date, timeout=120, delay=1)
-        # comments = comment_retriever.fetch_comments(self.staging_comments_out, freq='12H')
+        # comment_retriever = CommentRetriever(self.args.start_date, self.args.end_date, timeout=120, delay=1,
+        #                                      cache=self.cache, fmt=self.staging_format)
+        # comments = comment_retriever.fetch_comments(self.staging_comments_out, freq='12H',
+        #                                             adaptive=self.args.adaptive_windows,
+        #                                             workers=self.args.window_workers)
         # logging.debug(str(comments))
 
         # Ingest submission CSVs into db
@@ -103,7 +434,7 @@ class App:
         # comment_ingest.ingest()
 
         # Fetch loan IDs
-        loan_retriever = LoansRetriever(70, auth=self.auth)
+        loan_retriever = LoansRetriever(70, auth=self.auth, cache=self.cache)
         # loan_ids = loan_retriever.fetch_loan_ids(self.args.start_date, self.args.end_date, self.staging_loan_ids_out,
         #                                          historical=True)
         # logging.info("Identified %s loan ids", loan_ids)
@@ -112,19 +443,24 @@ class App:
         # loan_ingest = IngestLoanIDs(self.staging_loan_ids_out, self.db)
         # loan_ingest.ingest()
 
-        loan_id_query = """
-        SELECT 
-        id
-        FROM staging_loan_ids
-        WHERE id > 20813
-        ORDER BY id ASC;
-        """
-        loan_ids = self.db.execute_query(loan_id_query)
-        loan_ids = list(loan_ids)
+        # Resume the detail backfill from the fetch journal
+        journal = self._open_journal()
+        journal.seed_from_staging()
+        loan_ids = journal.pending() + journal.retry_queue()
+        logging.info("Fetch journal: %s; %d loan ids to fetch this run.", journal.counts(), len(loan_ids))
         if len(loan_ids) > 0:
-            loan_ids = [x['id'] for x in loan_ids]
-            loan_retriever.fetch_loans_by_id_list(loan_ids, self.staging_loan_basic, self.staging_loan_events)
-            breakpoint()
+            if self.args.async_fetch:
+                loan_retriever.fetch_loans_by_id_list_async(loan_ids, self.staging_loan_basic,
+                                                            self.staging_loan_events,
+                                                            max_connections=self.args.max_connections,
+                                                            rate=self.args.rate, journal=journal)
+            else:
+                loan_retriever.fetch_loans_by_id_list(loan_ids, self.staging_loan_basic, self.staging_loan_events,
+                                                      journal=journal)
+
+        # Ingest loan details
+        IngestLoanBasic(self.staging_loan_basic, self.db).ingest()
+        IngestLoanEvents(self.staging_loan_events, self.db).ingest()
 
         # Clean and consolidate data using NLP
 